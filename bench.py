@@ -0,0 +1,732 @@
+# -*- coding: utf-8 -*-
+"""
+Замер холодного старта бота.
+
+Поднимает локальную заглушку Bot API, запускает `python main.py` с пустой базой
+(cold) и с уже созданной (warm) и меряет снаружи:
+  ready  — от запуска процесса до первого getUpdates,
+  reply  — от запуска до ответа на /start, который ждал в очереди.
+Плюс метрики изнутри процесса (строка `startup:` — import / db / ready / first_update).
+
+Режим --backup: в процессе, на базе с историей заказов, меряет задержку оформления
+заказа (транзакция чекаута) без бэкапа и пока в соседнем потоке крутится make_backup.
+
+Режим --engine: одной пачкой приходит /start от N разных пользователей; меряет время
+до последнего ответа при INKO_ENGINE=sync, INKO_ENGINE=threads (пул потоков) и
+INKO_WORKERS=4 (поллер + 4 процесса) — с задержкой Bot API 60 мс и без неё, когда
+всё время уходит на базу и Python. Плюс доля времени хендлера под DB_LOCK: выше
+1/доля пул потоков не ускорит ничем.
+
+Режим --promo: промокод с лимитом, десятки потоков оформляют заказы с ним, а рядом
+крутятся истечение резервов, подтверждения и отмены; после — инварианты счётчиков:
+used не больше лимита и равен числу резервов со слотом.
+
+Режим --repo: один и тот же набор проверок хранилища (пользователи, каталог, склад,
+корзины, заказы, промокоды, партнёры, отзывы) на бэкендах SQLite и в памяти —
+оба должны пройти его одинаково; плюс время одной и той же нагрузки на корзину.
+Там же смоук клавиатур: каждая *_kb из main.py определена один раз, все её вызовы
+в коде ложатся на её сигнатуру, и она собирается с правдоподобными аргументами.
+
+    python bench.py            # по 5 запусков cold и warm
+    python bench.py -n 10
+    python bench.py --backup
+    python bench.py --engine
+    python bench.py --promo
+    python bench.py --repo
+"""
+import argparse
+import ast
+import inspect
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:BENCH"
+USER_ID = 111
+
+
+def start_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 1, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """Минимум Bot API: ожидающие /start (по умолчанию один), остальное — «ok»."""
+
+    def _params(self) -> dict:
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        size = int(self.headers.get("Content-Length") or 0)
+        if size and "form" in (self.headers.get("Content-Type") or ""):
+            params.update({k: v[-1] for k, v in parse_qs(self.rfile.read(size).decode()).items()})
+        return params
+
+    def _reply(self, result):
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # процесс бота уже убит между замерами
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        method = urlsplit(self.path).path.rsplit("/", 1)[-1]
+        params = self._params()
+        st = self.server.state
+        now = time.perf_counter()
+
+        if method == "getUpdates":
+            st.setdefault("ready", now)
+            if not st.get("delivered") and int(params.get("offset") or 0) >= 0:
+                st["delivered"] = True
+                users = st.get("users") or [USER_ID]
+                return self._reply([start_update(st["update_id"] + i, uid) for i, uid in enumerate(users)])
+            time.sleep(0.2)
+            return self._reply([])
+        if st.get("latency"):
+            time.sleep(st["latency"])  # сетевая задержка до Bot API
+        if method == "getMe":
+            return self._reply({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        if method == "getChatMember":
+            return self._reply({"status": "member", "user": {"id": USER_ID, "is_bot": False, "first_name": "b"}})
+        if method.startswith("send"):
+            users = st.get("users") or [USER_ID]
+            with self.server.lock:
+                if str(params.get("chat_id")) in map(str, users):
+                    st.setdefault("replied", set()).add(str(params.get("chat_id")))
+                if len(st.get("replied", ())) >= len(users):
+                    st.setdefault("reply", time.perf_counter())
+            return self._reply({
+                "message_id": 2, "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            })
+        return self._reply(True)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def run_once(api_url: str, server, db_path: str, timeout: float = 30, **state) -> dict:
+    # новый update_id на каждый запуск: повтор старого бот отсечёт как дубль по журналу
+    server.update_id = getattr(server, "update_id", 1000) + 1000
+    extra_env = state.pop("env", None) or {}
+    server.state = dict(state, update_id=server.update_id)
+    env = dict(os.environ, INKO_BOT_TOKEN=TOKEN, TELEGRAM_API_URL=api_url,
+               INKO_DB_PATH=db_path, PORT="", PYTHONUNBUFFERED="1", **extra_env)
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "main.py")], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    inner = {}
+
+    def read_stdout():
+        for line in proc.stdout:
+            if line.startswith("startup:"):
+                for part in line.split()[1:]:
+                    k, v = part.split("=")
+                    inner[k] = float(v.rstrip("ms"))
+
+    reader = threading.Thread(target=read_stdout, daemon=True)
+    reader.start()
+    deadline = t0 + timeout
+    while time.perf_counter() < deadline and ("reply" not in server.state or "first_update" not in inner):
+        time.sleep(0.01)
+    proc.kill()
+    proc.wait()
+
+    st = server.state
+    out = {k: round((st[k] - t0) * 1000, 1) for k in ("ready", "reply") if k in st}
+    out.update({f"in.{k}": v for k, v in inner.items()})
+    return out
+
+
+def summarize(title: str, runs: list):
+    print(f"\n{title} ({len(runs)} запусков), мс — медиана / мин / макс")
+    keys = sorted({k for r in runs for k in r}, key=lambda k: (k.startswith("in."), k))
+    for k in keys:
+        vals = [r[k] for r in runs if k in r]
+        print(f"  {k:<16} {statistics.median(vals):>8.1f} {min(vals):>8.1f} {max(vals):>8.1f}")
+
+
+def percentiles(vals: list) -> str:
+    vals = sorted(vals)
+    pick = lambda q: vals[min(len(vals) - 1, int(len(vals) * q))] * 1000
+    return f"p50 {pick(0.5):6.2f}  p95 {pick(0.95):6.2f}  p99 {pick(0.99):6.2f}  max {vals[-1] * 1000:6.2f}"
+
+
+def bench_backup(api_url: str, tmp: str, checkouts: int = 400, filler_orders: int = 300000,
+                 backup_runs: int = 3):
+    os.environ.update(INKO_BOT_TOKEN=TOKEN, TELEGRAM_API_URL=api_url, PORT="",
+                      INKO_DB_PATH=os.path.join(tmp, "store.db"), INKO_BACKUP_DIR=os.path.join(tmp, "backups"))
+    sys.path.insert(0, BASE_DIR)
+    import main as shop
+
+    shop.migrate_db()
+    pid = shop.create_product("Bench", "Футболка", "Размеры: S M L", 1990, [], False)
+    now = shop.datetime.utcnow().isoformat()
+    with shop.db_tx():
+        # история заказов, чтобы файл базы был не игрушечным
+        shop.conn.executemany(
+            "INSERT INTO orders(user_id,status,total,final_total,created_at) VALUES(?,?,?,?,?)",
+            ((10_000 + i % 5000, "выдан", 1990, 1990, now) for i in range(filler_orders)))
+        shop.conn.executemany(
+            "INSERT INTO order_items(order_id,product_id,size,qty,price) VALUES(?,?,?,?,?)",
+            ((i + 1, pid, "M", 1, 1990) for i in range(filler_orders)))
+    size_mb = os.path.getsize(shop.DB_PATH) / 1024 / 1024
+
+    def checkout(uid: int) -> float:
+        shop.add_to_cart(uid, pid, "M", 1)
+        t = time.perf_counter()
+        items = shop.get_cart(uid)
+        shop._create_order_tx(uid, items, sum(x["price"] * x["qty"] for x in items), None)
+        return time.perf_counter() - t
+
+    idle = [checkout(1_000_000 + i) for i in range(checkouts)]
+
+    backups = []
+
+    def backup_loop():
+        for _ in range(backup_runs):
+            t = time.perf_counter()
+            shop.make_backup()
+            shop.rotate_backups()
+            backups.append(time.perf_counter() - t)
+
+    th = threading.Thread(target=backup_loop, daemon=True)
+    th.start()
+    busy = []
+    while th.is_alive():
+        busy.append(checkout(2_000_000 + len(busy)))
+        time.sleep(0.001)  # живой поток заказов, а не сплошная запись
+
+    print(f"\nчекаут при бэкапе: база {size_mb:.1f} МБ, мс")
+    print(f"  без бэкапа      ({len(idle):>4} заказов) {percentiles(idle)}")
+    print(f"  во время бэкапа ({len(busy):>4} заказов) {percentiles(busy)}")
+    print(f"  бэкапов: {len(backups)}, один бэкап ≈ {statistics.median(backups) * 1000:.0f} мс")
+
+
+def promo_invariants(shop, code: str, limit: int) -> list:
+    """Счётчики промокода против строк резервов. Возвращает нарушения."""
+    row = shop.get_promo(code)
+    n = {r["status"]: r["n"] for r in shop.db_exec(
+        "SELECT status, COUNT(*) AS n FROM promo_reservations WHERE code=? GROUP BY status", (code,), fetchall=True)}
+    live = shop.db_exec(
+        "SELECT COUNT(*) AS n FROM orders o JOIN promo_reservations r ON r.order_id=o.id "
+        "WHERE r.code=? AND r.status IN ('held','confirmed') AND o.status NOT IN ('отклонён','отменён')",
+        (code,), fetchone=True)["n"]
+    errors = []
+    if row["used"] > limit:
+        errors.append(f"used {row['used']} > лимита {limit}")
+    if row["used"] != n.get("held", 0) + n.get("confirmed", 0):
+        errors.append(f"used {row['used']} != held+confirmed {n.get('held', 0) + n.get('confirmed', 0)}")
+    if row["confirmed_uses"] != n.get("confirmed", 0):
+        errors.append(f"confirmed_uses {row['confirmed_uses']} != confirmed {n.get('confirmed', 0)}")
+    if live > limit:
+        errors.append(f"живых заказов со слотом {live} > лимита {limit}")
+    return errors
+
+
+def bench_promo(api_url: str, tmp: str, threads: int = 32, per_thread: int = 25, limit: int = 20) -> bool:
+    os.environ.update(INKO_BOT_TOKEN=TOKEN, TELEGRAM_API_URL=api_url, PORT="",
+                      INKO_DB_PATH=os.path.join(tmp, "promo.db"), INKO_BACKUP_DIR=os.path.join(tmp, "backups"))
+    sys.path.insert(0, BASE_DIR)
+    import main as shop
+
+    shop.migrate_db()
+    pid = shop.create_product("Bench", "Футболка", "S M L", 1000, [])
+    errors = []
+
+    # сценарий из ревью: резерв истёк, слот забрал другой заказ, потом подтверждают первый
+    shop.REPO.promos.add("ONCE", 10, 1)
+
+    def order(uid: int, code: str) -> int:
+        shop.add_to_cart(uid, pid, "M")
+        shop.set_user_promo(uid, code, 10)
+        return shop._create_order_tx(uid, shop.get_cart(uid), 1000, code)[0]
+
+    a = order(1, "ONCE")
+    shop.release_promo_reservation(a, status="expired")
+    order(2, "ONCE")
+    shop.confirm_order_promo(shop.get_order(a))
+    shop.set_order_status(a, "отменён")
+    shop.release_promo_reservation(a)
+    c = order(3, "ONCE")
+    if shop.get_order(c)["promo_code"]:
+        errors.append("ONCE: третий заказ получил скидку по одноразовому коду")
+    errors += [f"ONCE: {e}" for e in promo_invariants(shop, "ONCE", 1)]
+
+    # параллельная нагрузка
+    shop.REPO.promos.add("LIMIT", 10, limit)
+    shop.PROMO_HOLD_TTL_HOURS = 0  # каждый проход expire снимает все резервы новых заказов
+    stop = threading.Event()
+    discounted = []
+    peak = [0]
+
+    def buyer(k: int):
+        for i in range(per_thread):
+            oid = order(100_000 + k * 1000 + i, "LIMIT")
+            if shop.get_order(oid)["promo_code"]:
+                discounted.append(oid)
+
+    def admin():
+        rnd = random.Random(1)
+        while not stop.is_set():
+            peak[0] = max(peak[0], shop.get_promo("LIMIT")["used"])
+            shop.expire_promo_reservations()
+            if discounted:
+                o = shop.get_order(rnd.choice(discounted))
+                with shop.db_tx():
+                    if rnd.random() < 0.6:
+                        shop.set_order_status(o["id"], "подтверждён")
+                        shop.confirm_order_promo(o)
+                    else:
+                        shop.set_order_status(o["id"], "отменён")
+                        shop.release_promo_reservation(o["id"])
+            time.sleep(0.001)
+
+    adm = threading.Thread(target=admin, daemon=True)
+    adm.start()
+    t = time.perf_counter()
+    workers = [threading.Thread(target=buyer, args=(k,)) for k in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    stop.set()
+    adm.join()
+    took = time.perf_counter() - t
+    errors += [f"LIMIT: {e}" for e in promo_invariants(shop, "LIMIT", limit)]
+    if peak[0] > limit:
+        errors.append(f"LIMIT: used доходил до {peak[0]} > лимита {limit}")
+
+    flagged = shop.db_exec("SELECT COUNT(*) AS n FROM promo_reservations WHERE status='over_limit'",
+                           fetchone=True)["n"]
+    print(f"\nпромокод с лимитом {limit}: {threads} потоков × {per_thread} заказов за {took:.1f} с")
+    print(f"  заказов со скидкой {len(discounted)}, used {shop.get_promo('LIMIT')['used']}, "
+          f"подтверждено {shop.get_promo('LIMIT')['confirmed_uses']}, over_limit {flagged}, пик used {peak[0]}")
+    print("  ok" if not errors else f"  {len(errors)} нарушений")
+    for e in errors:
+        print(f"    {e}")
+    return not errors
+
+
+class TimedLock:
+    """Обёртка над RLock: сколько времени его держали снаружи (без вложенных захватов)."""
+
+    def __init__(self, inner):
+        self.inner, self.held, self.depth, self.since = inner, 0.0, 0, 0.0
+
+    def acquire(self, *args, **kwargs):
+        got = self.inner.acquire(*args, **kwargs)
+        if got:
+            self.depth += 1
+            if self.depth == 1:
+                self.since = time.perf_counter()
+        return got
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth:
+            self.held += time.perf_counter() - self.since
+        self.inner.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    chat = {"id": user_id, "type": "private"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "bench", "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+        "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "x"}}}
+
+
+def db_lock_share(api_url: str, tmp: str, users: int = 200) -> float:
+    """
+    В процессе, без задержки Bot API и мимо лимитов шлюза: доля времени пути
+    /start → размер в корзину → оформление, проведённая под DB_LOCK.
+    """
+    os.environ.update(INKO_BOT_TOKEN=TOKEN, TELEGRAM_API_URL=api_url, PORT="",
+                      INKO_DB_PATH=os.path.join(tmp, "lock.db"), INKO_BACKUP_DIR=os.path.join(tmp, "backups"))
+    sys.path.insert(0, BASE_DIR)
+    import main as shop
+    from telebot import types
+
+    shop.migrate_db()
+    shop.apihelper.CUSTOM_REQUEST_SENDER = shop.OUTBOUND.inner
+    pid = shop.create_product("Bench", "Футболка", "S M L", 1990, [])
+    updates = []
+    for i in range(users):
+        uid, base = 7000 + i, 900_000 + i * 3
+        updates += [types.Update.de_json(start_update(base, uid)),
+                    types.Update.de_json(callback_update(base + 1, uid, f"size:{pid}:M")),
+                    types.Update.de_json(callback_update(base + 2, uid, "cart:checkout"))]
+    lock = shop.DB_LOCK = TimedLock(shop.DB_LOCK)
+    t = time.perf_counter()
+    for u in updates:
+        shop.bot.process_new_updates([u])
+    return lock.held / (time.perf_counter() - t)
+
+
+def bench_engine(api_url: str, server, tmp: str, runs: int, users: int = 50):
+    modes = {"sync": {"INKO_ENGINE": "sync"}, "threads": {"INKO_ENGINE": "threads"},
+             "workers": {"INKO_WORKERS": "4"}}
+    for latency in (0.06, 0):
+        print(f"\n/start от {users} пользователей одной пачкой, задержка Bot API {latency * 1000:.0f} мс")
+        for engine, env in modes.items():
+            res = []
+            for i in range(runs):
+                db = os.path.join(tmp, f"{engine}{latency}{i}.db")
+                res.append(run_once(api_url, server, db, timeout=60, users=list(range(5000, 5000 + users)),
+                                    latency=latency, env=env))
+            done = [r["reply"] - r["ready"] for r in res if "reply" in r]
+            if not done:
+                print(f"  {engine:<8} ответы не дошли")
+                continue
+            print(f"  {engine:<8} все ответы через {statistics.median(done):8.1f} мс (медиана по {len(done)})")
+
+    server.state = {}
+    share = db_lock_share(api_url, tmp)
+    print(f"\nпод DB_LOCK {share:.0%} времени пути /start → корзина → заказ без задержки сети — "
+          f"остальное Python и вызовы Bot API; потолок ускорения от потоков {1 / share:.0f}×, "
+          f"без задержки сети его съедают GIL и общий лимит отправок")
+
+
+def repo_conformance(shop) -> list:
+    """Проверки поведения хранилища через те же хелперы, что зовут хендлеры. Возвращает расхождения."""
+    errors = []
+    repo = shop.REPO
+
+    def check(what, got, want):
+        if got != want:
+            errors.append(f"{what}: {got!r} != {want!r}")
+
+    # пользователи и рефералы
+    shop.add_user(1, "ann")
+    shop.add_user(2, "bob", referrer_id=1)
+    shop.add_user(2, "bob2", referrer_id=1)
+    shop.add_user(3, "cat", referrer_id=3)
+    check("users.count", repo.users.count(), 3)
+    check("users.ids", repo.users.ids(), [1, 2, 3])
+    check("повторный add_user", repo.users.get(2)["username"], "bob")
+    check("реферал", (repo.users.get(2)["referrer_id"], repo.users.get(3)["referrer_id"]), (1, None))
+    check("get_ref_stats", shop.get_ref_stats(1), (1, shop.REFERRAL_CAP))
+    shop.mark_first_order(2)
+    shop.mark_first_order(2)
+    check("ref_converted", repo.users.get(1)["ref_converted"], 1)
+    check("leaderboard", [(r["user_id"], r["ref_count"]) for r in shop.get_referral_leaderboard()], [(1, 1)])
+    shop.update_username(3, "kit")
+    check("update_username", repo.users.get(3)["username"], "kit")
+
+    # каталог
+    tee = shop.create_product("Футболки", "Tee Black", "S M L", 1990, ["f1"])
+    hood = shop.create_product("Худи", "Худи Серое", "", 4990, [])
+    tee2 = shop.create_product(" футболки ", "tee white", "", 1590, [], source_key="exp:7")
+    cats = shop.get_categories()
+    check("категории", [c["name"] for c in cats], ["Футболки", "Худи"])
+    tees = cats[0]["id"]
+    check("товары категории", [p["id"] for p in shop.get_products_by_category(tees)], [tee2, tee])
+    check("поиск ASCII без регистра", [p["id"] for p in repo.catalog.search("TEE")], [tee2, tee])
+    check("поиск кириллица с регистром", ([p["id"] for p in repo.catalog.search("худи")],
+                                          [p["id"] for p in repo.catalog.search("Худи")]), ([], [hood]))
+    p = shop.get_product(tee2)
+    check("товар", (json.loads(p["photos_json"]), p["source_key"], p["is_preorder"]), ([], "exp:7", 0))
+    check("нет товара", shop.get_product(10 ** 6), None)
+    check("count_products", repo.catalog.count_products(), 3)
+
+    # склад
+    check("set_stock_bulk", shop.set_stock_bulk([(tee, "M", 2), (tee, "L", 0), (10 ** 6, "M", 1)]),
+          {"set": 2, "removed": 0, "unknown": 1})
+    check("size_available", [shop.size_available(tee, "M", 2), shop.size_available(tee, "M", 3),
+                             shop.size_available(tee, "S"), shop.size_available(tee, "L")],
+          [True, False, True, False])
+    check("in_stock_sizes", shop.in_stock_sizes(tee, ["S", "M", "L"]), ["S", "M"])
+    check("take_stock", [shop.take_stock(tee, "M", 5), shop.take_stock(tee, "S", 1), shop.take_stock(tee, "M", 2)],
+          [0, None, 2])
+    check("stock_map", shop.get_stock_map([tee, hood]), {(tee, "M"): 0, (tee, "L"): 0})
+    rows, _ = shop.parse_stock_table(f"{tee} L=-")
+    check("снять размер", shop.set_stock_bulk(rows), {"set": 0, "removed": 1, "unknown": 0})
+    check("stock_map после снятия", shop.get_stock_map([tee]), {(tee, "M"): 0})
+
+    # корзина
+    check("версия пустой корзины", shop.get_cart_version(1), 0)
+    shop.add_to_cart(1, hood, "M")
+    shop.add_to_cart(1, hood, "M", 2)
+    shop.add_to_cart(1, tee2, "S")
+    cart = shop.get_cart(1)
+    check("корзина", [(i["product_id"], i["size"], i["qty"], i["title"], i["price"]) for i in cart],
+          [(hood, "M", 3, "Худи Серое", 4990), (tee2, "S", 1, "tee white", 1590)])
+    check("версия корзины", shop.get_cart_version(1), 3)
+    shop.update_cart_item_qty(1, cart[0]["id"], -1)
+    shop.update_cart_item_qty(1, cart[1]["id"], -5)
+    shop.remove_cart_item(2, cart[0]["id"])
+    check("qty/удаление", [(i["product_id"], i["qty"]) for i in shop.get_cart(1)], [(hood, 2)])
+    check("чужая корзина не тронута", (shop.get_cart_version(1), shop.get_cart_version(2)), (5, 0))
+    ops = [{"op": "add", "product_id": hood, "size": "L", "qty": 2},
+           {"op": "set", "product_id": hood, "size": "M", "qty": 0},
+           {"op": "add", "product_id": 10 ** 6, "size": "M", "qty": 1},
+           {"op": "add", "product_id": tee, "size": "M", "qty": 1}]
+    check("apply_cart_ops", shop.apply_cart_ops(1, ops, batch_id="b1"), {"applied": 2, "rejected": [2, 3]})
+    check("повтор batch_id", shop.apply_cart_ops(1, ops, batch_id="b1"), {"applied": 0, "rejected": []})
+    check("корзина после ops", [(i["product_id"], i["size"], i["qty"]) for i in shop.get_cart(1)], [(hood, "L", 2)])
+
+    # заказы
+    items = shop.get_cart(1)
+    oid, _, _, final = shop._create_order_tx(1, items, 9980, None)
+    check("корзина после заказа", shop.get_cart(1), [])
+    o = shop.get_order(oid)
+    check("заказ", (o["user_id"], o["status"], o["total"], o["final_total"], o["promo_code"]),
+          (1, "новый", 9980, 9980, None))
+    page, cursor = shop.get_user_orders_page(1)
+    check("страница заказов", ([x["id"] for x in page], cursor, page[0]["items"]),
+          ([oid], None, [{"title": "Худи Серое", "size": "L", "qty": 2, "price": 4990}]))
+    shop.set_stock_bulk([(tee, "M", 1)])
+    shop.add_to_cart(2, tee, "M")
+    oid2 = shop._create_order_tx(2, shop.get_cart(2), 1990, None)[0]
+    check("склад после заказа", repo.catalog.stock_qty(tee, "M"), 0)
+    check("release_order_stock", [shop.release_order_stock(oid2), shop.release_order_stock(oid2)], [1, 0])
+    check("склад после отмены", repo.catalog.stock_qty(tee, "M"), 1)
+    shop.set_order_status(oid, "подтверждён")
+    check("recent_orders", [r["id"] for r in shop.recent_orders()], [oid2, oid])
+    page, cursor = shop.get_user_orders_page(1, limit=1)
+    check("курсор", (len(page), cursor), (1, None))
+    check("статистика заказов", (repo.orders.count(), repo.orders.revenue("подтверждён")), (2, 9980))
+
+    # избранное
+    check("toggle_favorite", [shop.toggle_favorite(1, tee), shop.toggle_favorite(1, hood)], [True, True])
+    check("избранное", [(f["product_id"], f["title"]) for f in shop.get_favorites(1)],
+          [(hood, "Худи Серое"), (tee, "Tee Black")])
+    check("toggle_favorite снова", shop.toggle_favorite(1, hood), False)
+
+    # промокоды
+    check("новый промокод", [repo.promos.add("SALE", 10, 5), repo.promos.add("SALE", 20, 1)], [True, False])
+    check("validate_promo", shop.validate_promo(" sale "), (10, "SALE"))
+    repo.promos.add("SALE", 30, 1, update=True)
+    check("обновление промокода", (shop.get_promo("sale")["discount_percent"], shop.get_promo("sale")["max_uses"]),
+          (30, 1))
+    shop.set_user_promo(1, "SALE", 25)
+    check("get_user_promo", shop.get_user_promo(1), (25, "SALE"))
+    shop.clear_user_promo(1)
+    check("clear_user_promo", shop.get_user_promo(1), (0, ""))
+    bonus = shop.create_review_bonus_promo(2, 5)
+    check("бонусный промокод", (shop.get_promo(bonus)["discount_percent"], shop.get_promo(bonus)["max_uses"]), (5, 1))
+    check("все промокоды", sorted(r["code"] for r in repo.promos.all()), sorted(["SALE", bonus]))
+    check("totals", repo.promos.totals(), (0, 0))
+
+    # партнёры
+    check("заявка", [shop.submit_partner_request(3, "kit"), shop.submit_partner_request(3, "kit")], [True, False])
+    check("статус заявки", repo.partners.request(3)["status"], "pending")
+    code, disc, comm = shop.approve_partner_request(3)
+    check("код партнёра", (code, disc, comm), ("KIT", 5, 5))
+    check("партнёр по коду", shop.get_partner_by_code("kit")["user_id"], 3)
+    check("промокод партнёра", shop.get_promo(code)["max_uses"], 0)
+    check("заявка одобрена", repo.partners.request(3)["status"], "approved")
+    shop.reject_partner_request(2)
+    check("отказ без заявки", repo.partners.request(2)["status"], "rejected")
+    check("повторная заявка после решения", shop.submit_partner_request(2, "bob"), True)
+
+    # отзывы
+    check("без инвайта", repo.reviews.open_invite(2), False)
+    repo.reviews.invite(2)
+    check("инвайт", repo.reviews.open_invite(2), True)
+    r1 = repo.reviews.add(2, "ok", ["p1"])
+    repo.reviews.use_invite(2)
+    r2 = repo.reviews.add(2, "meh", [])
+    check("инвайт использован", repo.reviews.open_invite(2), False)
+    check("очередь", (shop.get_next_pending_review()["id"], shop.get_next_pending_review(r1)["id"],
+                      shop.get_next_pending_review(r2)["id"], shop.count_pending_reviews()), (r1, r2, r1, 2))
+    shop.approve_review(r1)
+    shop.reject_review(r2)
+    check("модерация", ([r["id"] for r in shop.get_approved_reviews_all()], shop.get_review(r2),
+                        shop.count_pending_reviews()), ([r1], None, 0))
+    check("фото отзыва", json.loads(shop.get_review(r1)["photos_json"]), ["p1"])
+
+    # удаление категории
+    shop.add_to_cart(2, tee, "M")
+    v = shop.get_cart_version(2)
+    shop.delete_category_full(tees)
+    check("категория удалена", ([c["name"] for c in shop.get_categories()], shop.get_product(tee)), (["Худи"], None))
+    check("корзина/избранное без товаров", (shop.get_cart(2), [f["product_id"] for f in shop.get_favorites(1)]),
+          ([], []))
+    check("версия корзины после удаления", shop.get_cart_version(2), v + 1)
+    check("склад удалённого", shop.get_stock_map([tee]), {})
+    return errors
+
+
+# образцы аргументов клавиатур по имени параметра; новый параметр без образца — тоже расхождение
+KB_SAMPLE_ARGS = {
+    "cat_id": lambda ids: ids["cat"], "prod_id": lambda ids: ids["prod"], "sizes": lambda ids: ["S", "M"],
+    "idx": lambda ids: 0, "total": lambda ids: 2, "user_id": lambda ids: 1,
+    "order_id": lambda ids: 1, "review_id": lambda ids: 1,
+}
+
+
+def keyboard_smoke(shop) -> list:
+    """Все *_kb из main.py: одно определение, вызовы по сигнатуре, сборка и лимит callback_data."""
+    errors = []
+    with open(shop.__file__, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    defs = [n.name for n in ast.walk(tree) if isinstance(n, ast.FunctionDef) and n.name.endswith("_kb")]
+    for name in sorted({d for d in defs if defs.count(d) > 1}):
+        errors.append(f"{name}: определена {defs.count(name)} раза — поздняя затирает раннюю")
+
+    for call in ast.walk(tree):
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id.endswith("_kb")):
+            continue
+        if any(isinstance(a, ast.Starred) for a in call.args) or any(k.arg is None for k in call.keywords):
+            continue
+        fn = getattr(shop, call.func.id, None)
+        if fn is None:
+            errors.append(f"{call.func.id}(...) в строке {call.lineno}: такой клавиатуры нет")
+            continue
+        try:
+            inspect.signature(fn).bind(*call.args, **{k.arg: k.value for k in call.keywords})
+        except TypeError as e:
+            errors.append(f"{call.func.id}(...) в строке {call.lineno}: {e}")
+
+    ids = {"cat": None, "prod": shop.create_product("Смоук", "Smoke Tee", "S M L", 100, [])}
+    ids["cat"] = shop.get_product(ids["prod"])["category_id"]
+    for name in sorted(set(defs)):
+        fn = getattr(shop, name)
+        params = inspect.signature(fn).parameters.values()
+        missing = [p.name for p in params if p.default is p.empty and p.name not in KB_SAMPLE_ARGS]
+        if missing:
+            errors.append(f"{name}: нет образца для {missing} в KB_SAMPLE_ARGS")
+            continue
+        try:
+            markup = fn(*[KB_SAMPLE_ARGS[p.name](ids) for p in params if p.default is p.empty])
+        except Exception as e:
+            errors.append(f"{name}: {type(e).__name__}: {e}")
+            continue
+        if markup is None:
+            continue
+        rows = json.loads(markup if isinstance(markup, str) else markup.to_json()).get("inline_keyboard", [])
+        for b in (b for row in rows for b in row):
+            if len(b.get("callback_data", "").encode()) > 64:
+                errors.append(f"{name}: callback_data длиннее 64 байт: {b['callback_data']!r}")
+    return errors
+
+
+def cart_workload(shop, users: int = 300) -> float:
+    """Каталог → товар → корзина → изменения: то, что происходит на каждый тап."""
+    pids = [shop.create_product(f"Кат{i % 5}", f"Товар {i}", "S M L", 1000 + i, []) for i in range(50)]
+    t = time.perf_counter()
+    for uid in range(10_000, 10_000 + users):
+        shop.add_user(uid, f"u{uid}")
+        for cat in shop.get_categories()[:2]:
+            shop.get_products_by_category(cat["id"])
+        for pid in pids[uid % 10::10][:3]:
+            shop.get_product(pid)
+            shop.size_available(pid, "M")
+            shop.add_to_cart(uid, pid, "M")
+        cart = shop.get_cart(uid)
+        shop.update_cart_item_qty(uid, cart[0]["id"], 1)
+        shop.remove_cart_item(uid, cart[-1]["id"])
+        shop.get_cart(uid)
+    return time.perf_counter() - t
+
+
+def bench_repo(api_url: str, tmp: str) -> bool:
+    os.environ.update(INKO_BOT_TOKEN=TOKEN, TELEGRAM_API_URL=api_url, PORT="",
+                      INKO_DB_PATH=os.path.join(tmp, "store.db"), INKO_BACKUP_DIR=os.path.join(tmp, "backups"))
+    sys.path.insert(0, BASE_DIR)
+    import main as shop
+
+    shop.migrate_db()
+    clean = shop.make_backup("-clean")  # каждый прогон — с пустой базы: outbox и settings всегда в SQLite
+    backends = {"sqlite": shop.sqlite_storage, "memory": shop.memory_storage}
+    ok = True
+    print("\nконформность хранилища и смоук клавиатур")
+    for name, make in backends.items():
+        shop.restore_backup(clean)
+        shop.use_storage(make())
+        errors = repo_conformance(shop) + keyboard_smoke(shop)
+        ok = ok and not errors
+        print(f"  {name:<8} {'ok' if not errors else f'{len(errors)} расхождений'}")
+        for e in errors:
+            print(f"    {e}")
+
+    print("\nнагрузка на корзину (300 пользователей), с")
+    for name, make in backends.items():
+        shop.restore_backup(clean)
+        shop.use_storage(make())
+        print(f"  {name:<8} {cart_workload(shop):6.2f}")
+    return ok
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-n", type=int, default=5, help="запусков на режим")
+    ap.add_argument("--backup", action="store_true", help="задержка чекаута во время онлайн-бэкапа")
+    ap.add_argument("--engine", action="store_true", help="пачка /start: sync, asyncio и воркеры")
+    ap.add_argument("--promo", action="store_true", help="параллельные заказы с лимитным промокодом")
+    ap.add_argument("--repo", action="store_true", help="конформность и скорость бэкендов хранилища")
+    args = ap.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotApi)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    if args.backup:
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_backup(api_url, tmp)
+        server.shutdown()
+        return
+
+    if args.promo:
+        with tempfile.TemporaryDirectory() as tmp:
+            ok = bench_promo(api_url, tmp)
+        server.shutdown()
+        sys.exit(0 if ok else 1)
+
+    if args.repo:
+        with tempfile.TemporaryDirectory() as tmp:
+            ok = bench_repo(api_url, tmp)
+        server.shutdown()
+        sys.exit(0 if ok else 1)
+
+    if args.engine:
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_engine(api_url, server, tmp, min(args.n, 3))
+        server.shutdown()
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cold, warm = [], []
+        for i in range(args.n):
+            db = os.path.join(tmp, f"cold{i}.db")
+            cold.append(run_once(api_url, server, db))
+            warm.append(run_once(api_url, server, db))
+    summarize("cold: пустая база", cold)
+    summarize("warm: база уже есть", warm)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
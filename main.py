@@ -1,21 +1,47 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import sqlite3
 import json
 import re
 import time
-from datetime import datetime
-from typing import List, Tuple, Optional, Dict
+
+STARTUP_T0 = time.perf_counter()  # отсчёт метрик старта — до импорта telebot и остального
+
+import hashlib
+import hmac
+import html
+import secrets
+import tempfile
+import subprocess
+import threading
+import gzip
+import asyncio
+import heapq
+from io import BytesIO
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timedelta
+from typing import List, Tuple, Optional, Dict, Callable
 
 import telebot
-from telebot import types
+from telebot import types, apihelper
 from telebot.types import InputMediaPhoto
 
+try:
+    from PIL import Image
+except ImportError:  # без Pillow в WebApp публикуются оригиналы без превью
+    Image = None
+
 # ================== АВТО-СБРОС БАЗЫ ==================
 RESET_DB = False  # для продакшена False. если нужен чистый старт — поставь True
 
 BASE_DIR = os.path.dirname(__file__)
-DB_FILE = os.path.join(BASE_DIR, "store.db")
+DB_FILE = os.getenv("INKO_DB_PATH") or os.path.join(BASE_DIR, "store.db")
 DB_JOURNAL = DB_FILE + "-journal"
 
 try:
@@ -23,9 +49,10 @@ try:
         if os.path.exists(DB_FILE):
             os.remove(DB_FILE)
             print("⚠️ store.db — удалена для чистого запуска!")
-        if os.path.exists(DB_JOURNAL):
-            os.remove(DB_JOURNAL)
-            print("⚠️ journal файл удалён!")
+        for path in (DB_JOURNAL, DB_FILE + "-wal", DB_FILE + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+                print("⚠️ journal файл удалён!")
 except Exception as e:
     print("Ошибка при автосбросе базы:", e)
 # ====================================================
@@ -50,26 +77,638 @@ REFERRAL_BONUS = 0
 REFERRAL_CAP = 40
 
 PROMO_MAX_PERCENT = 25  # лимит скидки с промокода
+PROMO_HOLD_TTL_HOURS = 72  # через сколько снимать резерв промокода с неподтверждённого заказа
+
+PARTNER_PAYOUT_MIN = 500  # минимальный баланс партнёра для выплаты
+
+IMPORT_BATCH_SIZE = 100  # товаров на одну транзакцию при массовом импорте
+BOT_DOWNLOAD_MAX = 20 * 1024 * 1024  # больше Bot API боту файл не отдаст
+IMPORT_CLI_HINT = ("Фото из экспорта Telegram Desktop лежат файлами в папке рядом с result.json — "
+                   "такой импорт запускай на сервере со всей папкой:\n"
+                   "<code>python main.py import-export путь/к/папке/result.json</code>")
+
+ORDER_CANCEL_STATUSES = ("отклонён", "отменён")
+ORDER_CLOSED_STATUSES = ("доставлен",) + ORDER_CANCEL_STATUSES
+ORDER_ARCHIVE_DAYS = int(os.getenv("INKO_ORDER_ARCHIVE_DAYS") or 90)  # закрытые заказы старше — в архив
+
+# ✅ статика WebApp: products.json и картинки товаров
+WEBAPP_DIR = os.getenv("WEBAPP_DIR") or os.path.join(BASE_DIR, "webapp")
+MEDIA_THUMB_SIZES = {"grid": 480, "detail": 1280}
+MEDIA_WORKERS = 4
+MEDIA_SYNC_INTERVAL = 600
+
+# ✅ HTTP API каталога для WebApp (Render отдаёт порт веб-сервиса в PORT)
+API_PORT = int(os.getenv("PORT") or 0)
+API_PUBLIC_URL = (os.getenv("API_PUBLIC_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").rstrip("/")
+API_PAGE_SIZE = 40
+API_PAGE_MAX = 100
+API_GZIP_MIN = 1024  # меньше — сжимать нет смысла
+API_MAX_BODY = 64 * 1024
+WEBAPP_AUTH_TTL = 24 * 3600  # сколько живёт initData из WebApp
+CART_SYNC_MAX_OPS = 100
+
+# локальный Bot API сервер или заглушка для тестов, например http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
 # ==============================================
 
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
 bot = telebot.TeleBot(TOKEN, parse_mode="HTML", threaded=False)
 
+# ================== ИСХОДЯЩИЙ ШЛЮЗ ==================
+# Все вызовы Bot API идут через apihelper.CUSTOM_REQUEST_SENDER, поэтому лимиты
+# ставим там: общий бюджет бота и бюджет на каждый чат (token bucket).
+# Кто ждёт — пропускается по приоритету: ответы пользователю раньше уведомлений,
+# уведомления раньше рассылки. Повторные правки одного сообщения схлопываются:
+# уходит только последняя, остальные сразу возвращают ok.
+SEND_GLOBAL_RATE = 25          # сообщений в секунду на бота (лимит Telegram ~30)
+SEND_PRIVATE_RATE = 1.0        # в личный чат
+SEND_GROUP_RATE = 20 / 60      # в группу/канал
+SEND_CHAT_BURST = 3
+SEND_RETRY_MAX = 10            # дольше этого retry_after не ждём — отдаём 429 вызывающему
+
+PRIO_REPLY, PRIO_NOTIFY, PRIO_BULK = 0, 1, 2
+_SEND_CTX = threading.local()
+
+# методы без chat_id/лимитов (getUpdates, answerCallbackQuery, getFile...) идут мимо очереди.
+# deleteMessage тоже: Telegram не считает его в лимит чата, а уборка старого альбома
+# в show_product иначе съедала бы по секунде на фото до показа нового товара
+_THROTTLED_PREFIXES = ("send", "edit", "copyMessage", "forwardMessage")
+_EDIT_PREFIX = "edit"
+
+
+@contextmanager
+def send_priority(level: int):
+    prev = getattr(_SEND_CTX, "prio", PRIO_REPLY)
+    _SEND_CTX.prio = level
+    try:
+        yield
+    finally:
+        _SEND_CTX.prio = prev
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "ts", "paused_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts = burst, time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, sec: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + sec)
+        self.tokens = 0
+
+
+class _StubOk:
+    """Ответ-заглушка: правку перекрыла более свежая или колбэк уже нельзя подтвердить."""
+    status_code = 200
+    text = '{"ok":true,"result":true}'
+
+    def json(self):
+        return {"ok": True, "result": True}
+
+
+def _default_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    return apihelper._get_req_session().request(
+        method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+
+class OutboundGateway:
+    def __init__(self, inner):
+        self.inner = inner
+        self.cond = threading.Condition()
+        self.glob = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.chats: Dict[int, TokenBucket] = {}
+        self.waiting: Dict[int, Tuple[int, int]] = {}   # seq -> (prio, chat_id)
+        self.last_edit: Dict[Tuple[int, int], int] = {}  # (chat, message) -> seq последней правки
+        self.seq = 0
+        self.stats = {"sent": 0, "throttled": 0, "coalesced": 0, "429": 0, "late_answers": 0}
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self.chats.get(chat_id)
+        if b is None:
+            if len(self.chats) > 5000:
+                # выкидываем давно простаивающие чаты — у них бакет всё равно полный
+                now = time.monotonic()
+                for k in [k for k, v in self.chats.items() if now - v.ts > 60]:
+                    del self.chats[k]
+            rate = SEND_PRIVATE_RATE if chat_id > 0 else SEND_GROUP_RATE
+            b = self.chats[chat_id] = TokenBucket(rate, SEND_CHAT_BURST)
+        return b
+
+    def _blocked_by_higher(self, seq: int, prio: int, now: float) -> bool:
+        # уступаем только тем, кто уже может ехать: чужой занятый чат нас не держит
+        for other, (p, chat_id) in self.waiting.items():
+            if (p, other) < (prio, seq) and self._bucket(chat_id).wait_time(now) == 0:
+                return True
+        return False
+
+    def _acquire(self, chat_id: int, edit_key) -> bool:
+        """Ждёт своей очереди. False — правку перекрыла более свежая, слать не нужно."""
+        prio = getattr(_SEND_CTX, "prio", PRIO_REPLY)
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+            if edit_key:
+                self.last_edit[edit_key] = seq
+            self.waiting[seq] = (prio, chat_id)
+            waited = False
+            try:
+                while True:
+                    if edit_key and self.last_edit.get(edit_key) != seq:
+                        self.stats["coalesced"] += 1
+                        return False
+                    now = time.monotonic()
+                    wait = max(self._bucket(chat_id).wait_time(now), self.glob.wait_time(now))
+                    if wait == 0 and not self._blocked_by_higher(seq, prio, now):
+                        self._bucket(chat_id).take()
+                        self.glob.take()
+                        if edit_key:
+                            self.last_edit.pop(edit_key, None)
+                        if waited:
+                            self.stats["throttled"] += 1
+                        return True
+                    waited = True
+                    self.cond.wait(wait or 0.05)
+            finally:
+                del self.waiting[seq]
+                self.cond.notify_all()
+
+    def _on_429(self, chat_id: int, resp) -> float:
+        try:
+            retry_after = float(resp.json().get("parameters", {}).get("retry_after") or 1)
+        except Exception:
+            retry_after = 1.0
+        self.stats["429"] += 1
+        with self.cond:
+            self._bucket(chat_id).pause(retry_after)
+            if retry_after > 1:
+                # длинная пауза — значит упёрлись в общий лимит бота
+                self.glob.pause(retry_after)
+            self.cond.notify_all()
+        return retry_after
+
+    def _answer_callback(self, method, url, params, timeout, proxies):
+        # колбэк из журнала после рестарта давно протух: «часики» снять уже нельзя, но
+        # сам хендлер (чекаут, подтверждение заказа) должен доработать, а не упасть на ответе
+        resp = self.inner(method, url, params=params, timeout=timeout, proxies=proxies)
+        if resp.status_code == 400 and "query is too old" in (resp.text or ""):
+            self.stats["late_answers"] += 1
+            return _StubOk()
+        return resp
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        name = url.rsplit("/", 1)[-1]
+        if name == "answerCallbackQuery":
+            return self._answer_callback(method, url, params, timeout, proxies)
+        if not name.startswith(_THROTTLED_PREFIXES) or name == "sendChatAction":
+            return self.inner(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+        try:
+            chat_id = int((params or {}).get("chat_id") or 0)
+        except (TypeError, ValueError):
+            chat_id = 0  # @username канала — считаем как группу
+        edit_key = None
+        if name.startswith(_EDIT_PREFIX) and params and params.get("message_id"):
+            edit_key = (chat_id, int(params["message_id"]))
+
+        for _ in range(2):
+            if not self._acquire(chat_id, edit_key):
+                return _StubOk()
+            resp = self.inner(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+            if resp.status_code != 429:
+                self.stats["sent"] += 1
+                return resp
+            retry_after = self._on_429(chat_id, resp)
+            if retry_after > SEND_RETRY_MAX or files:
+                # файлы уже вычитаны, длинную паузу пусть решает вызывающий (outbox перепланирует)
+                break
+        return resp
+
+
+OUTBOUND = OutboundGateway(apihelper.CUSTOM_REQUEST_SENDER or _default_request_sender)
+apihelper.CUSTOM_REQUEST_SENDER = OUTBOUND
+
 # ================== БАЗА ДАННЫХ ==================
-DB_PATH = os.path.join(BASE_DIR, "store.db")
+DB_PATH = DB_FILE
 conn = sqlite3.connect(DB_PATH, check_same_thread=False)
 conn.row_factory = sqlite3.Row
+# на новой базе включает постраничный возврат места; старую переводит обслуживание
+# (VACUUM один раз, в простое бота)
+conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+# WAL + NORMAL: коммит без fsync на каждый апдейт журнала, при падении процесса данные целы
+conn.execute("PRAGMA journal_mode=WAL")
+conn.execute("PRAGMA synchronous=NORMAL")
+
+# одно соединение на процесс: фоновые задачи и хендлеры ходят в базу по очереди
+DB_LOCK = threading.RLock()
+_DB_TX = threading.local()
+
+
+def db_exec(query: str, params: tuple = (), fetchone=False, fetchall=False, commit=True, rowcount=False):
+    with DB_LOCK:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        if commit and not getattr(_DB_TX, "depth", 0):
+            conn.commit()
+        if fetchone:
+            return cur.fetchone()
+        if fetchall:
+            return cur.fetchall()
+        if rowcount:
+            return cur.rowcount
+        return None
 
 
-def db_exec(query: str, params: tuple = (), fetchone=False, fetchall=False, commit=True):
-    cur = conn.cursor()
-    cur.execute(query, params)
-    if commit:
-        conn.commit()
-    if fetchone:
-        return cur.fetchone()
-    if fetchall:
-        return cur.fetchall()
-    return None
+@contextmanager
+def db_tx():
+    """Все db_exec внутри блока — одна транзакция: коммит в конце, откат при ошибке."""
+    with DB_LOCK:
+        _DB_TX.depth = getattr(_DB_TX, "depth", 0) + 1
+        try:
+            yield
+        except BaseException:
+            _DB_TX.depth -= 1
+            if not _DB_TX.depth:
+                conn.rollback()
+            raise
+        _DB_TX.depth -= 1
+        if not _DB_TX.depth:
+            conn.commit()
+
+
+# ================== ФОНОВЫЕ ЗАДАЧИ ==================
+BACKGROUND_JOBS: List[Tuple[str, int, Callable]] = []
+
+
+def background_job(interval_sec: int):
+    """Регистрирует функцию, которую надо периодически запускать в фоне."""
+    def deco(fn):
+        BACKGROUND_JOBS.append((fn.__name__, interval_sec, fn))
+        return fn
+    return deco
+
+
+def _job_loop(name: str, interval_sec: int, fn: Callable):
+    while True:
+        time.sleep(interval_sec)
+        try:
+            fn()
+        except Exception as e:
+            print(f"job {name} fail:", e)
+
+
+def start_background_jobs():
+    for name, interval_sec, fn in BACKGROUND_JOBS:
+        threading.Thread(target=_job_loop, args=(name, interval_sec, fn),
+                         name=f"job:{name}", daemon=True).start()
+
+
+# ================== ОБСЛУЖИВАНИЕ БАЗЫ ==================
+# Задачи очистки регистрируются через @maintenance_task и возвращают число удалённых
+# строк. Удаляем пачками по MAINT_BATCH с паузой: DB_LOCK между пачками отпускается,
+# хендлеры не ждут. После очистки — incremental_vacuum, чтобы файл реально худел.
+MAINT_INTERVAL = 6 * 3600
+MAINT_BATCH = 500
+MAINT_PAUSE = 0.05
+VACUUM_STEP_PAGES = 512
+VACUUM_IDLE_SEC = 600  # полный VACUUM — только если столько не было ни одного апдейта
+CART_TTL_DAYS = int(os.getenv("INKO_CART_TTL_DAYS") or 30)
+REVIEW_INVITE_TTL_DAYS = int(os.getenv("INKO_REVIEW_INVITE_TTL_DAYS") or 14)
+
+MAINTENANCE_TASKS: List[Tuple[str, Callable[[], int]]] = []
+_MAINT_LOCK = threading.Lock()
+
+
+def maintenance_task(fn):
+    MAINTENANCE_TASKS.append((fn.__name__, fn))
+    return fn
+
+
+def _days_ago(days: int) -> str:
+    return (datetime.utcnow() - timedelta(days=days)).isoformat()
+
+
+def delete_in_batches(table: str, where: str, params: tuple = ()) -> int:
+    total = 0
+    while True:
+        n = db_exec(
+            f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT {MAINT_BATCH})",
+            params, rowcount=True
+        )
+        total += n
+        if n < MAINT_BATCH:
+            return total
+        time.sleep(MAINT_PAUSE)
+
+
+def _db_bytes() -> int:
+    return db_exec("PRAGMA page_count", fetchone=True)[0] * db_exec("PRAGMA page_size", fetchone=True)[0]
+
+
+def _bot_idle() -> bool:
+    """Никто не ждёт ответа: очередь пуста и в журнал давно ничего не приходило."""
+    if SCHED.pending() or SCHED.busy:
+        return False
+    last = db_exec("SELECT MAX(received_at) AS m FROM update_journal", fetchone=True)["m"]
+    return not last or last < (datetime.utcnow() - timedelta(seconds=VACUUM_IDLE_SEC)).isoformat()
+
+
+def incremental_vacuum() -> Optional[int]:
+    """
+    Возвращает, сколько мс держал DB_LOCK полный VACUUM, -1 — он отложен, None — не нужен.
+    Полный VACUUM переписывает файл целиком под DB_LOCK и замораживает все хендлеры,
+    поэтому он только для перевода старой базы в auto_vacuum и только в простое бота.
+    """
+    full = None
+    if db_exec("PRAGMA auto_vacuum", fetchone=True)[0] != 2:
+        # база создана до auto_vacuum: режим меняется только полным VACUUM, это один раз
+        if not _bot_idle():
+            print("maintenance: full VACUUM postponed, bot is not idle")
+            full = -1
+        else:
+            t0 = time.perf_counter()
+            db_exec("PRAGMA auto_vacuum=INCREMENTAL")
+            db_exec("VACUUM")
+            full = round((time.perf_counter() - t0) * 1000)
+            print(f"maintenance: full VACUUM held DB_LOCK {full} ms, db {_db_bytes() // 1024} KB")
+    else:
+        while True:
+            free = db_exec("PRAGMA freelist_count", fetchone=True)[0]
+            if not free:
+                break
+            db_exec(f"PRAGMA incremental_vacuum({min(free, VACUUM_STEP_PAGES)})", fetchall=True)
+            time.sleep(MAINT_PAUSE)
+    db_exec("PRAGMA wal_checkpoint(TRUNCATE)", fetchone=True)
+    return full
+
+
+def run_maintenance() -> Dict:
+    with _MAINT_LOCK:
+        t0 = time.perf_counter()
+        before = _db_bytes()
+        rows = {}
+        for name, fn in MAINTENANCE_TASKS:
+            try:
+                rows[name] = fn()
+            except Exception as e:
+                print(f"maintenance {name} fail:", e)
+                rows[name] = -1
+        full_vacuum_ms = incremental_vacuum()
+        report = {
+            "at": datetime.utcnow().isoformat(timespec="seconds"),
+            "rows": rows,
+            "full_vacuum_ms": full_vacuum_ms,
+            "freed_bytes": max(0, before - _db_bytes()),
+            "db_bytes": _db_bytes(),
+            "took_ms": round((time.perf_counter() - t0) * 1000),
+        }
+        set_setting("maintenance_report", json.dumps(report))
+        return report
+
+
+def format_maintenance_report(report: Dict) -> str:
+    lines = [f"• {name}: {n if n >= 0 else 'ошибка'}" for name, n in report["rows"].items()]
+    full = report.get("full_vacuum_ms")
+    if full is not None:
+        lines.append("• полный VACUUM: " + ("отложен — бот не простаивает" if full < 0
+                                            else f"база была занята {full} мс"))
+    return (
+        f"🧹 <b>Обслуживание базы</b> ({report['at']} UTC)\n"
+        + "\n".join(lines)
+        + f"\n\nОсвобождено: <b>{report['freed_bytes'] // 1024} КБ</b>\n"
+        f"Размер базы: <b>{report['db_bytes'] // 1024} КБ</b>\n"
+        f"Заняло: {report['took_ms']} мс"
+    )
+
+
+@background_job(MAINT_INTERVAL)
+def scheduled_maintenance():
+    run_maintenance()
+
+
+@maintenance_task
+def expire_carts() -> int:
+    """Корзины, которые не трогали CART_TTL_DAYS. Версию поднимаем — WebApp подхватит пустую."""
+    cutoff = _days_ago(CART_TTL_DAYS)
+    total = 0
+    while True:
+        users = [r["user_id"] for r in db_exec(
+            """
+            SELECT ci.user_id FROM cart_items ci
+            LEFT JOIN carts c ON c.user_id=ci.user_id
+            GROUP BY ci.user_id
+            HAVING MAX(ci.created_at)<? AND COALESCE(MAX(c.updated_at),'')<?
+            LIMIT ?
+            """,
+            (cutoff, cutoff, MAINT_BATCH), fetchall=True
+        )]
+        if not users:
+            return total
+        q_marks = ",".join(["?"] * len(users))
+        with db_tx():
+            total += db_exec(f"DELETE FROM cart_items WHERE user_id IN ({q_marks})", tuple(users), rowcount=True)
+            for uid in users:
+                touch_cart(uid)
+        if len(users) < MAINT_BATCH:
+            return total
+        time.sleep(MAINT_PAUSE)
+
+
+@maintenance_task
+def expire_review_invites() -> int:
+    return delete_in_batches("review_invites", "invited_at<?", (_days_ago(REVIEW_INVITE_TTL_DAYS),))
+
+
+@maintenance_task
+def drop_dead_user_promos() -> int:
+    """Сохранённые промокоды, которых больше нет или у которых кончился лимит."""
+    return delete_in_batches(
+        "user_promos",
+        "code NOT IN (SELECT code FROM promo_codes) OR code IN "
+        "(SELECT code FROM promo_codes WHERE COALESCE(max_uses,0)>0 AND used>=max_uses)"
+    )
+
+
+@maintenance_task
+def drop_orphan_rows() -> int:
+    """Избранное и остатки удалённых товаров. order_items не трогаем — это история заказов."""
+    where = "product_id NOT IN (SELECT id FROM products)"
+    return delete_in_batches("favorites", where) + delete_in_batches("stock", where)
+
+
+# поднимать при каждом изменении init_db / ensure_columns — иначе быстрый старт их пропустит
+SCHEMA_VERSION = 7
+
+
+def migrate_db() -> bool:
+    """Схема создаётся/догоняется, только если записанная в базе версия отстала. True — обновляли."""
+    current = db_exec("PRAGMA user_version", fetchone=True)[0]
+    if current == SCHEMA_VERSION:
+        return False
+    init_db()
+    ensure_columns()
+    db_exec(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return True
+
+
+# ================== OUTBOX ==================
+# Уведомления другим людям (админу, покупателю, партнёру) не шлём из хендлера:
+# enqueue_message пишет строку в outbox в той же транзакции, что и само изменение,
+# а фоновый поток отправляет с повторами. Откатилась транзакция — нет и сообщения.
+OUTBOX_BATCH = 20
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_KEEP_DAYS = 7
+OUTBOX_XPROC_POLL = 0.2  # режим воркеров: как часто проверять коммиты других процессов
+_OUTBOX_WAKE = threading.Event()
+
+
+def enqueue_message(chat_id: int, text: str, kb=None, photo: Optional[str] = None):
+    if kb is not None and not isinstance(kb, str):
+        kb = kb.to_json()
+    db_exec(
+        "INSERT INTO outbox(chat_id,text,markup,photo,created_at) VALUES(?,?,?,?,?)",
+        (chat_id, text, kb, photo, datetime.utcnow().isoformat()),
+    )
+    # если мы внутри транзакции, поток всё равно дождётся коммита на DB_LOCK
+    _OUTBOX_WAKE.set()
+
+
+def _outbox_send(row: sqlite3.Row):
+    if row["photo"]:
+        bot.send_photo(row["chat_id"], row["photo"], caption=row["text"], reply_markup=row["markup"])
+    else:
+        bot.send_message(row["chat_id"], row["text"], reply_markup=row["markup"])
+
+
+def drain_outbox() -> float:
+    """Отправляет созревшие сообщения. Возвращает, сколько секунд можно спать.
+
+    Разные чаты шлются параллельно (fan_out), внутри чата — строго по порядку:
+    строка не берётся, пока более ранняя строка того же чата отложена на повтор."""
+    now = time.time()
+    rows = db_exec(
+        """
+        SELECT * FROM outbox
+        WHERE status='pending' AND next_at<=?
+          AND NOT EXISTS (SELECT 1 FROM outbox o2 WHERE o2.status='pending' AND o2.chat_id=outbox.chat_id
+                          AND o2.id<outbox.id AND o2.next_at>?)
+        ORDER BY id LIMIT ?
+        """,
+        (now, now, OUTBOX_BATCH), fetchall=True
+    )
+    by_chat: Dict[int, List[sqlite3.Row]] = {}
+    for row in rows:
+        by_chat.setdefault(row["chat_id"], []).append(row)
+
+    def send_chat(chat_rows: List[sqlite3.Row]) -> List[Tuple[sqlite3.Row, Optional[Exception]]]:
+        done = []
+        for row in chat_rows:
+            try:
+                _outbox_send(row)
+            except Exception as e:
+                # остаток чата ждёт: его не возьмут, пока эта строка отложена
+                done.append((row, e))
+                break
+            done.append((row, None))
+        return done
+
+    pause = 0
+    for chat_done in run_fan_out([lambda r=chat_rows: send_chat(r) for chat_rows in by_chat.values()]):
+        for row, error in chat_done:
+            pause = max(pause, _outbox_settle(row, error))
+    return pause or (0 if len(rows) == OUTBOX_BATCH else 5)
+
+
+def _outbox_settle(row: sqlite3.Row, error: Optional[Exception]) -> float:
+    """Записывает итог отправки строки. Возвращает паузу для всей очереди (только на 429)."""
+    if error is None:
+        db_exec("UPDATE outbox SET status='sent', attempts=attempts+1, sent_at=? WHERE id=?",
+                (datetime.utcnow().isoformat(), row["id"]))
+        return 0
+    if isinstance(error, apihelper.ApiTelegramException):
+        if error.error_code == 429:
+            # флуд-контроль общий на бота: откладываем всю очередь
+            retry_after = int((error.result_json.get("parameters") or {}).get("retry_after") or 5)
+            db_exec("UPDATE outbox SET next_at=?, error=? WHERE id=?",
+                    (time.time() + retry_after, "429", row["id"]))
+            return retry_after
+        if 400 <= error.error_code < 500:
+            # заблокировал бота, чат не найден, битая разметка — повтор не поможет
+            db_exec("UPDATE outbox SET status='dead', attempts=attempts+1, error=? WHERE id=?",
+                    (error.description[:300], row["id"]))
+            return 0
+    _outbox_retry(row, error)
+    return 0
+
+
+def _outbox_retry(row: sqlite3.Row, error: Exception):
+    attempts = row["attempts"] + 1
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        db_exec("UPDATE outbox SET status='dead', attempts=?, error=? WHERE id=?",
+                (attempts, str(error)[:300], row["id"]))
+        return
+    delay = min(2 ** attempts, 600)
+    db_exec("UPDATE outbox SET attempts=?, next_at=?, error=? WHERE id=?",
+            (attempts, time.time() + delay, str(error)[:300], row["id"]))
+
+
+def _db_data_version() -> int:
+    # меняется, только когда коммитит другое соединение — то есть другой процесс
+    return db_exec("PRAGMA data_version", fetchone=True, commit=False)[0]
+
+
+def _outbox_wait(pause: float, version: Optional[int]):
+    """
+    Спит до pause секунд. Event будит только из этого процесса; строки, которые
+    пишут воркеры (INKO_WORKERS), замечаем по смене PRAGMA data_version.
+    """
+    if version is None:
+        _OUTBOX_WAKE.wait(pause)
+        return
+    deadline = time.monotonic() + pause
+    while time.monotonic() < deadline:
+        step = min(OUTBOX_XPROC_POLL, deadline - time.monotonic())
+        if _OUTBOX_WAKE.wait(max(0, step)) or _db_data_version() != version:
+            return
+
+
+def _outbox_loop():
+    _SEND_CTX.prio = PRIO_NOTIFY
+    while True:
+        # сброс до выборки: set() во время drain не теряется, а будит следующий круг
+        _OUTBOX_WAKE.clear()
+        version = _db_data_version() if WORKERS else None
+        try:
+            pause = drain_outbox()
+        except Exception as e:
+            print("outbox fail:", e)
+            pause = 5
+        if pause:
+            _outbox_wait(pause, version)
+
+
+def start_outbox_sender():
+    threading.Thread(target=_outbox_loop, name="outbox", daemon=True).start()
+
+
+@maintenance_task
+def prune_outbox() -> int:
+    return delete_in_batches("outbox", "status IN ('sent','dead') AND created_at<?",
+                             (_days_ago(OUTBOX_KEEP_DAYS),))
 
 
 def init_db():
@@ -115,6 +754,18 @@ def init_db():
     )
     """)
 
+    db_exec("CREATE INDEX IF NOT EXISTS idx_cart_items_user ON cart_items(user_id, product_id, size)")
+
+    # версия корзины: растёт при любом изменении — из бота или из WebApp
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS carts (
+        user_id     INTEGER PRIMARY KEY,
+        version     INTEGER DEFAULT 0,
+        last_batch  TEXT,
+        updated_at  TEXT
+    )
+    """)
+
     db_exec("""
     CREATE TABLE IF NOT EXISTS favorites (
         id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -146,6 +797,19 @@ def init_db():
         price       INTEGER
     )
     """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, id)")
+
+    # остатки по размерам; нет строки — размер не учитывается и продаётся без ограничений
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS stock (
+        product_id  INTEGER,
+        size        TEXT,
+        qty         INTEGER DEFAULT 0,
+        updated_at  TEXT,
+        PRIMARY KEY(product_id, size)
+    )
+    """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)")
 
     db_exec("""
     CREATE TABLE IF NOT EXISTS settings (
@@ -165,6 +829,20 @@ def init_db():
     )
     """)
 
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS promo_reservations (
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        code        TEXT,
+        user_id     INTEGER,
+        order_id    INTEGER,
+        status      TEXT DEFAULT 'held',
+        created_at  TEXT,
+        updated_at  TEXT
+    )
+    """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_promo_res_order ON promo_reservations(order_id)")
+    db_exec("CREATE INDEX IF NOT EXISTS idx_promo_res_status ON promo_reservations(status, created_at)")
+
     db_exec("""
     CREATE TABLE IF NOT EXISTS user_promos (
         user_id INTEGER PRIMARY KEY,
@@ -192,6 +870,7 @@ def init_db():
         created_at TEXT
     )
     """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_reviews_queue ON reviews(is_approved, id)")
 
     db_exec("""
     CREATE TABLE IF NOT EXISTS partner_requests (
@@ -220,33 +899,224 @@ def init_db():
     )
     """)
 
+    # file_id телеграма → картинки для WebApp (пути относительно WEBAPP_DIR)
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS media_files (
+        file_id     TEXT PRIMARY KEY,
+        sha256      TEXT,
+        orig_path   TEXT,
+        grid_path   TEXT,
+        detail_path TEXT,
+        status      TEXT,
+        error       TEXT,
+        updated_at  TEXT
+    )
+    """)
+
+    # журнал комиссий партнёров: только INSERT, суммы со знаком
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS partner_ledger (
+        id           INTEGER PRIMARY KEY AUTOINCREMENT,
+        partner_id   INTEGER,
+        kind         TEXT,
+        amount       INTEGER,
+        sales_amount INTEGER DEFAULT 0,
+        order_id     INTEGER,
+        created_at   TEXT
+    )
+    """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_partner_ledger ON partner_ledger(partner_id, id)")
+    db_exec("CREATE INDEX IF NOT EXISTS idx_partner_ledger_order ON partner_ledger(order_id)")
+
+    # исходящие уведомления: пишутся в одной транзакции с изменением, шлёт фоновый поток
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id     INTEGER,
+        text        TEXT,
+        markup      TEXT,
+        photo       TEXT,
+        status      TEXT DEFAULT 'pending',
+        attempts    INTEGER DEFAULT 0,
+        next_at     REAL DEFAULT 0,
+        error       TEXT,
+        created_at  TEXT,
+        sent_at     TEXT
+    )
+    """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_at)")
+
+    # журнал входящих апдейтов: пишем до обработки, чтобы рестарт ничего не терял
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS update_journal (
+        update_id   INTEGER PRIMARY KEY,
+        payload     TEXT,
+        status      TEXT DEFAULT 'pending',
+        attempts    INTEGER DEFAULT 0,
+        error       TEXT,
+        received_at TEXT,
+        done_at     TEXT
+    )
+    """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_update_journal_status ON update_journal(status, update_id)")
+
+    # удалённые товары — чтобы /api/changes мог сказать клиенту, что убрать из кэша
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS catalog_tombstones (
+        product_id INTEGER PRIMARY KEY,
+        version    INTEGER
+    )
+    """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_catalog_tombstones ON catalog_tombstones(version)")
+
+    # снапшот журнала до last_entry_id включительно
+    db_exec("""
+    CREATE TABLE IF NOT EXISTS partner_balances (
+        partner_id     INTEGER PRIMARY KEY,
+        balance        INTEGER DEFAULT 0,
+        total_earned   INTEGER DEFAULT 0,
+        total_sales    INTEGER DEFAULT 0,
+        confirmed_uses INTEGER DEFAULT 0,
+        total_paid     INTEGER DEFAULT 0,
+        last_entry_id  INTEGER DEFAULT 0,
+        updated_at     TEXT
+    )
+    """)
+
+
+def _ensure_column(table: str, column: str, ddl: str) -> bool:
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет. True — колонку только что добавили."""
+    cols = {r["name"] for r in db_exec(f"PRAGMA table_info({table})", fetchall=True)}
+    if column in cols:
+        return False
+    try:
+        db_exec(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}", commit=True)
+        return True
+    except Exception as e:
+        print(f"ALTER {table} {column} fail:", e)
+        return False
+
 
 def ensure_columns():
-    cols = {r["name"] for r in db_exec("PRAGMA table_info(orders)", fetchall=True)}
-    if "partner_commission" not in cols:
-        try:
-            db_exec("ALTER TABLE orders ADD COLUMN partner_commission INTEGER DEFAULT 0", commit=True)
-        except Exception as e:
-            print("ALTER orders partner_commission fail:", e)
+    _ensure_column("orders", "partner_commission", "INTEGER DEFAULT 0")
+    # сколько штук позиции реально списано со склада при оформлении
+    _ensure_column("order_items", "stock_held", "INTEGER DEFAULT 0")
+    _ensure_column("orders", "partner_paid", "INTEGER DEFAULT 0")
+
+    # откуда импортирован товар — для дедупликации массового импорта
+    _ensure_column("products", "source_key", "TEXT")
+    _ensure_column("products", "content_hash", "TEXT")
+    db_exec("CREATE INDEX IF NOT EXISTS idx_products_source ON products(source_key)")
+    db_exec("CREATE INDEX IF NOT EXISTS idx_products_hash ON products(content_hash)")
+
+    # версия каталога, в которой товар менялся последний раз
+    _ensure_column("products", "version", "INTEGER DEFAULT 0")
+    db_exec("CREATE INDEX IF NOT EXISTS idx_products_version ON products(version)")
+
+    # денормализованные счётчики рефералов (заполняем один раз при миграции)
+    if _ensure_column("users", "first_order_at", "TEXT"):
+        db_exec("UPDATE users SET first_order_at=(SELECT MIN(o.created_at) FROM orders o WHERE o.user_id=users.user_id)")
+    if _ensure_column("users", "ref_count", "INTEGER DEFAULT 0"):
+        db_exec("UPDATE users SET ref_count=(SELECT COUNT(*) FROM users u WHERE u.referrer_id=users.user_id)")
+    if _ensure_column("users", "ref_converted", "INTEGER DEFAULT 0"):
+        db_exec("""
+            UPDATE users SET ref_converted=(
+                SELECT COUNT(*) FROM users u
+                WHERE u.referrer_id=users.user_id AND u.first_order_at IS NOT NULL
+            )
+        """)
+    db_exec("CREATE INDEX IF NOT EXISTS idx_users_ref_count ON users(ref_count)")
 
-    if "partner_paid" not in cols:
-        try:
-            db_exec("ALTER TABLE orders ADD COLUMN partner_paid INTEGER DEFAULT 0", commit=True)
-        except Exception as e:
-            print("ALTER orders partner_paid fail:", e)
+    # балансы, накопленные в partners до появления журнала, становятся стартовым снапшотом
+    db_exec("""
+        INSERT OR IGNORE INTO partner_balances(partner_id,balance,total_earned,total_sales,confirmed_uses,last_entry_id,updated_at)
+        SELECT user_id, balance, total_earned, total_sales, confirmed_uses, 0, ?
+        FROM partners
+    """, (datetime.utcnow().isoformat(),))
+
+    # очередь для воркеров: шард по пользователю и аренда взятой строки
+    _ensure_column("update_journal", "user_id", "INTEGER DEFAULT 0")
+    _ensure_column("update_journal", "worker", "TEXT")
+    _ensure_column("update_journal", "lease_until", "REAL")
+    _ensure_column("update_journal", "prio", "INTEGER DEFAULT 3")
+    _ensure_column("update_journal", "coalesce_key", "TEXT")
+    db_exec("CREATE INDEX IF NOT EXISTS idx_update_journal_user ON update_journal(user_id, update_id)")
+
+    # архив старых заказов — после всех ALTER горячих таблиц, чтобы колонки совпали
+    _ensure_archive_tables()
+    db_exec("CREATE INDEX IF NOT EXISTS idx_orders_archive_user ON orders_archive(user_id, id)")
+    db_exec("CREATE INDEX IF NOT EXISTS idx_order_items_archive_order ON order_items_archive(order_id)")
+
+
+ARCHIVE_TABLES = (("orders", "orders_archive"), ("order_items", "order_items_archive"))
+
+
+def _table_columns(table: str) -> List[str]:
+    return [r["name"] for r in db_exec(f"PRAGMA table_info({table})", fetchall=True)]
+
+
+def _ensure_archive_tables():
+    """Архив — копия DDL горячей таблицы; колонки, добавленные позже, догоняем ALTER'ом."""
+    for hot, cold in ARCHIVE_TABLES:
+        ddl = db_exec("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (hot,), fetchone=True)["sql"]
+        db_exec(re.sub(rf"^CREATE TABLE\s+(IF NOT EXISTS\s+)?\"?{hot}\"?",
+                       f"CREATE TABLE IF NOT EXISTS {cold}", ddl.strip(), count=1))
+        have = set(_table_columns(cold))
+        for r in db_exec(f"PRAGMA table_info({hot})", fetchall=True):
+            if r["name"] not in have:
+                default = f" DEFAULT {r['dflt_value']}" if r["dflt_value"] is not None else ""
+                _ensure_column(cold, r["name"], f"{r['type']}{default}")
+
+
+# settings читаются на каждом экране (баннеры, лого, версия каталога) — держим в памяти.
+# Запись только выкидывает ключ; заполняем кэш чтением вне транзакции, чтобы откат
+# не оставил в памяти незакоммиченное значение.
+_SETTINGS_CACHE: Dict[str, Optional[str]] = {}
 
 
 def get_setting(key: str) -> Optional[str]:
-    row = db_exec("SELECT value FROM settings WHERE key=?", (key,), fetchone=True)
-    return row["value"] if row else None
+    in_tx = getattr(_DB_TX, "depth", 0)
+    if not in_tx and key in _SETTINGS_CACHE:
+        return _SETTINGS_CACHE[key]
+    with DB_LOCK:
+        row = db_exec("SELECT value FROM settings WHERE key=?", (key,), fetchone=True)
+        value = row["value"] if row else None
+        if not in_tx:
+            _SETTINGS_CACHE[key] = value
+    return value
 
 
 def set_setting(key: str, value: str):
-    db_exec(
-        "INSERT INTO settings(key,value) VALUES(?,?) "
-        "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-        (key, value),
-    )
+    with db_tx():
+        db_exec(
+            "INSERT INTO settings(key,value) VALUES(?,?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (key, value),
+        )
+        # счётчик для других процессов: по нему они сбрасывают свои кэши (sync_shared_caches)
+        db_exec(
+            "INSERT INTO settings(key,value) VALUES('settings_version','1') "
+            "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1"
+        )
+        _SETTINGS_CACHE.pop(key, None)
+        invalidate_render_cache()
+
+
+def get_catalog_version() -> int:
+    v = get_setting("catalog_version")
+    return int(v) if v else 0
+
+
+def bump_catalog_version() -> int:
+    """Новая версия каталога. Вызывать в той же транзакции, что и само изменение."""
+    with db_tx():
+        db_exec(
+            "INSERT INTO settings(key,value) VALUES('catalog_version','1') "
+            "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1"
+        )
+        _SETTINGS_CACHE.pop("catalog_version", None)
+        invalidate_render_cache()
+        return get_catalog_version()
 
 
 def promo_limit_str(max_uses: Optional[int]) -> str:
@@ -257,51 +1127,1146 @@ def promo_limit_str(max_uses: Optional[int]) -> str:
     return "∞" if mu <= 0 else str(mu)
 
 
+# ================== ХРАНИЛИЩЕ ==================
+ORDER_LIST_COLS = "id, user_id, status, total, final_total, discount_percent, promo_code, created_at"
+
+
+# Весь SQL по пользователям, каталогу, корзинам, заказам, промокодам, партнёрам и
+# отзывам живёт в репозиториях ниже; хендлеры и хелперы ходят через REPO.
+# Бэкендов два: SQLite (прод) и память (бенчмарки, проверка логики без файла базы).
+# Проверка, что оба ведут себя одинаково, — `python bench.py --repo`.
+# На SQLite остаются только инфраструктурные таблицы, которым нужны атомарные
+# условные UPDATE и фоновые задачи: резервы промокодов, журнал партнёров, архив
+# заказов, outbox, журнал апдейтов, settings и медиа. Бэкенд в памяти транзакции
+# не откатывает: db_tx() вокруг его вызовов только сериализует.
+class SqliteUsers:
+    def get(self, user_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM users WHERE user_id=?", (user_id,), fetchone=True)
+
+    def add(self, user_id: int, username: Optional[str], referrer_id: Optional[int] = None) -> bool:
+        """Новый пользователь (+ реферал в пределах REFERRAL_CAP). False — уже был."""
+        with db_tx():
+            inserted = db_exec(
+                "INSERT OR IGNORE INTO users(user_id, username, created_at, referrer_id) VALUES (?,?,?,NULL)",
+                (user_id, username, datetime.utcnow().isoformat()),
+                rowcount=True,
+            )
+            if not inserted:
+                return False
+            if not referrer_id or referrer_id == user_id:
+                return True
+
+            # лимит REFERRAL_CAP проверяется и списывается одним условным UPDATE
+            credited = db_exec(
+                "UPDATE users SET ref_count=ref_count+1 WHERE user_id=? AND ref_count<?",
+                (referrer_id, REFERRAL_CAP), rowcount=True
+            )
+            if credited:
+                db_exec("UPDATE users SET referrer_id=? WHERE user_id=?", (referrer_id, user_id))
+        return True
+
+    def mark_first_order(self, user_id: int):
+        first = db_exec(
+            "UPDATE users SET first_order_at=? WHERE user_id=? AND first_order_at IS NULL",
+            (datetime.utcnow().isoformat(), user_id), rowcount=True
+        )
+        if first:
+            db_exec(
+                "UPDATE users SET ref_converted=ref_converted+1 "
+                "WHERE user_id=(SELECT referrer_id FROM users WHERE user_id=?)",
+                (user_id,),
+            )
+
+    def set_username(self, user_id: int, username: Optional[str]):
+        db_exec("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+
+    def ids(self) -> List[int]:
+        return [r["user_id"] for r in db_exec("SELECT user_id FROM users ORDER BY user_id", fetchall=True)]
+
+    def count(self) -> int:
+        return db_exec("SELECT COUNT(*) AS c FROM users", fetchone=True)["c"]
+
+    def leaderboard(self, limit: int) -> List[sqlite3.Row]:
+        return db_exec(
+            """
+            SELECT user_id, username, ref_count, ref_converted
+            FROM users
+            WHERE ref_count>0
+            ORDER BY ref_count DESC, ref_converted DESC
+            LIMIT ?
+            """,
+            (limit,), fetchall=True
+        )
+
+
+class SqliteCatalog:
+    def category_id(self, name: str) -> int:
+        """id категории по имени (slug — имя в нижнем регистре), создаёт при необходимости."""
+        slug = name.lower()
+        row = db_exec("SELECT id FROM categories WHERE slug=?", (slug,), fetchone=True)
+        if row:
+            return row["id"]
+        db_exec("INSERT INTO categories(name, slug) VALUES(?,?)", (name, slug))
+        return db_exec("SELECT id FROM categories WHERE slug=?", (slug,), fetchone=True)["id"]
+
+    def category(self, cat_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM categories WHERE id=?", (cat_id,), fetchone=True)
+
+    def categories(self) -> List[sqlite3.Row]:
+        return db_exec("SELECT * FROM categories ORDER BY name", fetchall=True)
+
+    def add_product(self, cat_id: int, title: str, description: str, price: int, photo_ids: List[str],
+                    is_preorder: bool, source_key: Optional[str], content_hash: Optional[str], version: int) -> int:
+        with db_tx():
+            db_exec(
+                """
+                INSERT INTO products(category_id,title,description,price,is_preorder,photos_json,created_at,
+                                     source_key,content_hash,version)
+                VALUES (?,?,?,?,?,?,?,?,?,?)
+                """,
+                (
+                    cat_id, title, description, price, int(is_preorder),
+                    json.dumps(photo_ids), datetime.utcnow().isoformat(),
+                    source_key, content_hash, version
+                ),
+            )
+            return db_exec("SELECT last_insert_rowid() AS id", fetchone=True)["id"]
+
+    def product(self, product_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM products WHERE id=?", (product_id,), fetchone=True)
+
+    def products_in(self, cat_id: int) -> List[sqlite3.Row]:
+        return db_exec("SELECT * FROM products WHERE category_id=? ORDER BY id DESC", (cat_id,), fetchall=True)
+
+    def search(self, text: str) -> List[sqlite3.Row]:
+        return db_exec("SELECT * FROM products WHERE title LIKE ? ORDER BY id DESC", (f"%{text}%",), fetchall=True)
+
+    def count_products(self) -> int:
+        return db_exec("SELECT COUNT(*) AS c FROM products", fetchone=True)["c"]
+
+    def touch_products(self, product_ids: List[int], version: int):
+        q_marks = ",".join(["?"] * len(product_ids))
+        db_exec(f"UPDATE products SET version=? WHERE id IN ({q_marks})", (version, *product_ids))
+
+    def delete_category(self, cat_id: int, version: int) -> List[int]:
+        """Удаляет категорию с товарами, их остатками и избранным. Возвращает id удалённых товаров."""
+        prod_ids = [p["id"] for p in db_exec("SELECT id FROM products WHERE category_id=?", (cat_id,), fetchall=True)]
+        with db_tx():
+            if prod_ids:
+                q_marks = ",".join(["?"] * len(prod_ids))
+                db_exec(f"DELETE FROM favorites WHERE product_id IN ({q_marks})", tuple(prod_ids))
+                db_exec(f"DELETE FROM stock WHERE product_id IN ({q_marks})", tuple(prod_ids))
+                db_exec(f"DELETE FROM products WHERE id IN ({q_marks})", tuple(prod_ids))
+                for pid in prod_ids:
+                    db_exec("INSERT OR REPLACE INTO catalog_tombstones(product_id,version) VALUES(?,?)", (pid, version))
+            db_exec("DELETE FROM categories WHERE id=?", (cat_id,))
+        return prod_ids
+
+    def stock_map(self, product_ids: List[int]) -> Dict[Tuple[int, str], int]:
+        out = {}
+        ids = list(product_ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            q_marks = ",".join(["?"] * len(chunk))
+            for r in db_exec(f"SELECT product_id, size, qty FROM stock WHERE product_id IN ({q_marks})",
+                             tuple(chunk), fetchall=True):
+                out[(r["product_id"], r["size"])] = r["qty"]
+        return out
+
+    def stock_qty(self, product_id: int, size: str) -> Optional[int]:
+        """Остаток размера; None — размер на складе не учитывается."""
+        row = db_exec("SELECT qty FROM stock WHERE product_id=? AND size=?", (product_id, size), fetchone=True)
+        return row["qty"] if row else None
+
+    def take_stock(self, product_id: int, size: str, qty: int) -> bool:
+        # условный UPDATE: два параллельных заказа не уведут остаток в минус
+        return db_exec(
+            "UPDATE stock SET qty=qty-?, updated_at=? WHERE product_id=? AND size=? AND qty>=?",
+            (qty, datetime.utcnow().isoformat(), product_id, size, qty), rowcount=True
+        ) > 0
+
+    def return_stock(self, product_id: int, size: str, qty: int):
+        db_exec("UPDATE stock SET qty=qty+?, updated_at=? WHERE product_id=? AND size=?",
+                (qty, datetime.utcnow().isoformat(), product_id, size))
+
+    def set_stock(self, product_id: int, size: str, qty: Optional[int]):
+        """qty=None — снять размер с учёта."""
+        if qty is None:
+            db_exec("DELETE FROM stock WHERE product_id=? AND size=?", (product_id, size))
+            return
+        db_exec(
+            "INSERT INTO stock(product_id,size,qty,updated_at) VALUES(?,?,?,?) "
+            "ON CONFLICT(product_id,size) DO UPDATE SET qty=excluded.qty, updated_at=excluded.updated_at",
+            (product_id, size, qty, datetime.utcnow().isoformat()),
+        )
+
+    def toggle_favorite(self, user_id: int, product_id: int) -> bool:
+        row = db_exec("SELECT id FROM favorites WHERE user_id=? AND product_id=?", (user_id, product_id), fetchone=True)
+        if row:
+            db_exec("DELETE FROM favorites WHERE id=?", (row["id"],))
+            return False
+        db_exec("INSERT INTO favorites(user_id,product_id) VALUES(?,?)", (user_id, product_id))
+        return True
+
+    def favorites(self, user_id: int) -> List[sqlite3.Row]:
+        return db_exec(
+            """
+            SELECT f.*, p.title, p.price
+            FROM favorites f JOIN products p ON p.id=f.product_id
+            WHERE f.user_id=?
+            ORDER BY f.id DESC
+            """,
+            (user_id,), fetchall=True
+        )
+
+
+class SqliteCarts:
+    def version(self, user_id: int) -> int:
+        row = db_exec("SELECT version FROM carts WHERE user_id=?", (user_id,), fetchone=True)
+        return row["version"] if row else 0
+
+    def touch(self, user_id: int) -> int:
+        with db_tx():
+            db_exec(
+                "INSERT INTO carts(user_id,version,updated_at) VALUES(?,1,?) "
+                "ON CONFLICT(user_id) DO UPDATE SET version=version+1, updated_at=excluded.updated_at",
+                (user_id, datetime.utcnow().isoformat()),
+            )
+            return self.version(user_id)
+
+    def items(self, user_id: int) -> List[sqlite3.Row]:
+        return db_exec(
+            """
+            SELECT c.*, p.title, p.price
+            FROM cart_items c
+            JOIN products p ON p.id=c.product_id
+            WHERE c.user_id=?
+            ORDER BY c.id
+            """,
+            (user_id,), fetchall=True
+        )
+
+    def add(self, user_id: int, product_id: int, size: str, qty: int):
+        """Одна строка на товар+размер: повторное добавление увеличивает количество."""
+        with db_tx():
+            if not db_exec(
+                "UPDATE cart_items SET qty=qty+? WHERE user_id=? AND product_id=? AND size=?",
+                (qty, user_id, product_id, size), rowcount=True
+            ):
+                db_exec(
+                    "INSERT INTO cart_items(user_id,product_id,size,qty,created_at) VALUES (?,?,?,?,?)",
+                    (user_id, product_id, size, qty, datetime.utcnow().isoformat()),
+                )
+
+    def change_qty(self, user_id: int, item_id: int, delta: int) -> bool:
+        """Количество позиции ± delta, до нуля — удалить. False — позиции нет."""
+        with db_tx():
+            row = db_exec("SELECT qty FROM cart_items WHERE id=? AND user_id=?", (item_id, user_id), fetchone=True)
+            if not row:
+                return False
+            qty = int(row["qty"] or 1) + delta
+            if qty <= 0:
+                db_exec("DELETE FROM cart_items WHERE id=?", (item_id,))
+            else:
+                db_exec("UPDATE cart_items SET qty=? WHERE id=?", (qty, item_id))
+        return True
+
+    def remove(self, user_id: int, item_id: int) -> bool:
+        return db_exec("DELETE FROM cart_items WHERE id=? AND user_id=?", (item_id, user_id), rowcount=True) > 0
+
+    def clear(self, user_id: int) -> int:
+        return db_exec("DELETE FROM cart_items WHERE user_id=?", (user_id,), rowcount=True)
+
+    def qty(self, user_id: int, product_id: int, size: str) -> int:
+        row = db_exec("SELECT qty FROM cart_items WHERE user_id=? AND product_id=? AND size=?",
+                      (user_id, product_id, size), fetchone=True)
+        return row["qty"] if row else 0
+
+    def set_qty(self, user_id: int, product_id: int, size: str, qty: int):
+        if qty <= 0:
+            db_exec("DELETE FROM cart_items WHERE user_id=? AND product_id=? AND size=?", (user_id, product_id, size))
+            return
+        if not db_exec(
+            "UPDATE cart_items SET qty=? WHERE user_id=? AND product_id=? AND size=?",
+            (qty, user_id, product_id, size), rowcount=True
+        ):
+            db_exec(
+                "INSERT INTO cart_items(user_id,product_id,size,qty,created_at) VALUES (?,?,?,?,?)",
+                (user_id, product_id, size, qty, datetime.utcnow().isoformat()),
+            )
+
+    def last_batch(self, user_id: int) -> Optional[str]:
+        row = db_exec("SELECT last_batch FROM carts WHERE user_id=?", (user_id,), fetchone=True)
+        return row["last_batch"] if row else None
+
+    def set_last_batch(self, user_id: int, batch_id: str):
+        db_exec(
+            "INSERT INTO carts(user_id,version,last_batch,updated_at) VALUES(?,0,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET last_batch=excluded.last_batch",
+            (user_id, batch_id, datetime.utcnow().isoformat()),
+        )
+
+    def drop_products(self, product_ids: List[int]) -> List[int]:
+        """Убирает товары из всех корзин. Возвращает затронутых пользователей."""
+        if not product_ids:
+            return []
+        q_marks = ",".join(["?"] * len(product_ids))
+        with db_tx():
+            users = [r["user_id"] for r in db_exec(
+                f"SELECT DISTINCT user_id FROM cart_items WHERE product_id IN ({q_marks})",
+                tuple(product_ids), fetchall=True)]
+            db_exec(f"DELETE FROM cart_items WHERE product_id IN ({q_marks})", tuple(product_ids))
+        return users
+
+
+class SqliteOrders:
+    def create(self, user_id: int, total: int) -> int:
+        db_exec(
+            """
+            INSERT INTO orders(user_id,status,total,discount_percent,final_total,promo_code,created_at,partner_commission,partner_paid)
+            VALUES (?,?,?,?,?,?,?,?,?)
+            """,
+            (user_id, "новый", total, 0, total, None, datetime.utcnow().isoformat(), 0, 0),
+        )
+        return db_exec("SELECT last_insert_rowid() AS id", fetchone=True)["id"]
+
+    def add_item(self, order_id: int, product_id: int, size: str, qty: int, price: int, stock_held: int):
+        db_exec(
+            "INSERT INTO order_items(order_id,product_id,size,qty,price,stock_held) VALUES (?,?,?,?,?,?)",
+            (order_id, product_id, size, qty, price, stock_held),
+        )
+
+    def set_discount(self, order_id: int, percent: int, final_total: int, promo_code: str):
+        db_exec("UPDATE orders SET discount_percent=?, final_total=?, promo_code=? WHERE id=?",
+                (percent, final_total, promo_code, order_id))
+
+    def get(self, order_id: int) -> Optional[sqlite3.Row]:
+        return (db_exec("SELECT * FROM orders WHERE id=?", (order_id,), fetchone=True)
+                or db_exec("SELECT * FROM orders_archive WHERE id=?", (order_id,), fetchone=True))
+
+    def set_status(self, order_id: int, status: str) -> bool:
+        with db_tx():
+            if db_exec("UPDATE orders SET status=? WHERE id=?", (status, order_id), rowcount=True):
+                return True
+            # статус меняют по старой кнопке у архивного заказа — возвращаем его в горячую таблицу
+            if _move_orders([order_id], to_archive=False):
+                db_exec("UPDATE orders SET status=? WHERE id=?", (status, order_id))
+                return True
+        return False
+
+    def _union(self, where: str, params: tuple, limit: int) -> List[sqlite3.Row]:
+        """Последние заказы из горячей таблицы и архива. Заказ живёт ровно в одной из них:
+        перенос идёт одной транзакцией, так что UNION ALL без дублей."""
+        return db_exec(
+            f"""
+            SELECT * FROM (SELECT {ORDER_LIST_COLS} FROM orders WHERE {where} ORDER BY id DESC LIMIT ?)
+            UNION ALL
+            SELECT * FROM (SELECT {ORDER_LIST_COLS} FROM orders_archive WHERE {where} ORDER BY id DESC LIMIT ?)
+            ORDER BY id DESC LIMIT ?
+            """,
+            (*params, limit, *params, limit, limit), fetchall=True
+        )
+
+    def recent(self, limit: int) -> List[sqlite3.Row]:
+        return self._union("1", (), limit)
+
+    def user_page(self, user_id: int, before_id: Optional[int], limit: int) -> Tuple[List[Dict], Optional[int]]:
+        heads = self._union("user_id=? AND id<?", (user_id, before_id or 2 ** 62), limit + 1)
+        orders = _order_heads(heads)
+        if orders:
+            q_marks = ",".join(["?"] * len(orders))
+            ids = tuple(orders)
+            items = db_exec(
+                f"""
+                SELECT oi.order_id, oi.id, oi.size, oi.qty, oi.price, p.title FROM (
+                    SELECT order_id, id, product_id, size, qty, price FROM order_items WHERE order_id IN ({q_marks})
+                    UNION ALL
+                    SELECT order_id, id, product_id, size, qty, price FROM order_items_archive WHERE order_id IN ({q_marks})
+                ) oi
+                LEFT JOIN products p ON p.id=oi.product_id
+                ORDER BY oi.order_id DESC, oi.id
+                """,
+                ids + ids, fetchall=True
+            )
+            for r in items:
+                orders[r["order_id"]]["items"].append(
+                    {"title": r["title"], "size": r["size"], "qty": r["qty"], "price": r["price"]})
+        return _order_page(orders, limit)
+
+    def items(self, order_id: int) -> List[sqlite3.Row]:
+        return db_exec("SELECT id, product_id, size, qty, stock_held FROM order_items WHERE order_id=? ORDER BY id",
+                       (order_id,), fetchall=True)
+
+    def held_items(self, order_id: int) -> List[sqlite3.Row]:
+        return db_exec("SELECT id, product_id, size, stock_held FROM order_items WHERE order_id=? AND stock_held>0",
+                       (order_id,), fetchall=True)
+
+    def set_held(self, item_id: int, qty: int):
+        db_exec("UPDATE order_items SET stock_held=? WHERE id=?", (qty, item_id))
+
+    def count(self) -> int:
+        return db_exec("SELECT (SELECT COUNT(*) FROM orders) + (SELECT COUNT(*) FROM orders_archive) AS c",
+                       fetchone=True)["c"]
+
+    def revenue(self, status: str) -> int:
+        return db_exec(
+            "SELECT COALESCE((SELECT SUM(final_total) FROM orders WHERE status=?), 0)"
+            " + COALESCE((SELECT SUM(final_total) FROM orders_archive WHERE status=?), 0) AS s",
+            (status, status), fetchone=True
+        )["s"] or 0
+
+
+def _order_heads(heads: List) -> Dict[int, Dict]:
+    orders: Dict[int, Dict] = {}
+    for r in heads:
+        orders[r["id"]] = {k: r[k] for k in (
+            "id", "status", "total", "final_total", "discount_percent", "promo_code", "created_at"
+        )}
+        orders[r["id"]]["items"] = []
+    return orders
+
+
+def _order_page(orders: Dict[int, Dict], limit: int) -> Tuple[List[Dict], Optional[int]]:
+    page = list(orders.values())
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1]["id"]
+    return page, next_cursor
+
+
+class SqlitePromos:
+    def get(self, code: str) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM promo_codes WHERE code=?", (code,), fetchone=True)
+
+    def add(self, code: str, percent: int, max_uses: int, update: bool = False) -> bool:
+        """Новый промокод. update=True — существующему обновить скидку и лимит. False — код уже был."""
+        on_conflict = ("DO UPDATE SET discount_percent=excluded.discount_percent, max_uses=excluded.max_uses"
+                       if update else "DO NOTHING")
+        return db_exec(
+            "INSERT INTO promo_codes(code,discount_percent,max_uses,used,confirmed_uses,created_at) "
+            f"VALUES(?,?,?,0,0,?) ON CONFLICT(code) {on_conflict}",
+            (code, percent, max_uses, datetime.utcnow().isoformat()), rowcount=True
+        ) > 0
+
+    def all(self) -> List[sqlite3.Row]:
+        return db_exec("SELECT * FROM promo_codes ORDER BY created_at DESC, code", fetchall=True)
+
+    def totals(self) -> Tuple[int, int]:
+        """(использовано при оформлении, подтверждено) по всем кодам."""
+        row = db_exec("SELECT SUM(used) AS u, SUM(confirmed_uses) AS c FROM promo_codes", fetchone=True)
+        return row["u"] or 0, row["c"] or 0
+
+    def user_promo(self, user_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM user_promos WHERE user_id=?", (user_id,), fetchone=True)
+
+    def set_user_promo(self, user_id: int, code: str, percent: int):
+        db_exec("""
+            INSERT INTO user_promos(user_id, code, discount_percent, set_at)
+            VALUES(?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                code=excluded.code,
+                discount_percent=excluded.discount_percent,
+                set_at=excluded.set_at
+        """, (user_id, code, percent, datetime.utcnow().isoformat()))
+
+    def clear_user_promo(self, user_id: int):
+        db_exec("DELETE FROM user_promos WHERE user_id=?", (user_id,))
+
+
+class SqlitePartners:
+    def get(self, user_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM partners WHERE user_id=?", (user_id,), fetchone=True)
+
+    def by_code(self, code: str) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM partners WHERE code=? AND is_active=1", (code,), fetchone=True)
+
+    def upsert(self, user_id: int, username: Optional[str], code: str, discount_percent: int, commission_percent: int):
+        db_exec("""
+            INSERT INTO partners(user_id,username,code,discount_percent,commission_percent,created_at)
+            VALUES(?,?,?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=excluded.username,
+                code=excluded.code,
+                discount_percent=excluded.discount_percent,
+                commission_percent=excluded.commission_percent,
+                is_active=1
+        """, (user_id, username, code, discount_percent, commission_percent, datetime.utcnow().isoformat()))
+
+    def request(self, user_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM partner_requests WHERE user_id=?", (user_id,), fetchone=True)
+
+    def submit_request(self, user_id: int, username: Optional[str]) -> bool:
+        """Новая заявка. False — заявка уже ждёт решения."""
+        return db_exec("""
+            INSERT INTO partner_requests(user_id,username,status,requested_at)
+            VALUES(?,?,'pending',?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=excluded.username,
+                status='pending',
+                requested_at=excluded.requested_at,
+                decided_at=NULL
+            WHERE partner_requests.status!='pending'
+        """, (user_id, username, datetime.utcnow().isoformat()), rowcount=True) > 0
+
+    def decide_request(self, user_id: int, username: Optional[str], status: str):
+        now = datetime.utcnow().isoformat()
+        db_exec("""
+            INSERT INTO partner_requests(user_id,username,status,requested_at,decided_at)
+            VALUES(?,?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                status=excluded.status,
+                decided_at=excluded.decided_at
+        """, (user_id, username, status, now, now))
+
+
+class SqliteReviews:
+    def add(self, user_id: int, text: str, photos: List[str]) -> int:
+        with db_tx():
+            db_exec(
+                "INSERT INTO reviews(user_id,text,photos_json,is_approved,created_at) VALUES(?,?,?,?,?)",
+                (user_id, text, json.dumps(photos), 0, datetime.utcnow().isoformat())
+            )
+            return db_exec("SELECT last_insert_rowid() AS id", fetchone=True)["id"]
+
+    def get(self, review_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM reviews WHERE id=?", (review_id,), fetchone=True)
+
+    def next_pending(self, after_id: int) -> Optional[sqlite3.Row]:
+        return db_exec("SELECT * FROM reviews WHERE is_approved=0 AND id>? ORDER BY id ASC LIMIT 1",
+                       (after_id,), fetchone=True)
+
+    def count_pending(self) -> int:
+        return db_exec("SELECT COUNT(*) AS c FROM reviews WHERE is_approved=0", fetchone=True)["c"]
+
+    def approved(self) -> List[sqlite3.Row]:
+        return db_exec("SELECT * FROM reviews WHERE is_approved=1 ORDER BY id DESC", fetchall=True)
+
+    def approve(self, review_id: int):
+        db_exec("UPDATE reviews SET is_approved=1 WHERE id=?", (review_id,))
+
+    def delete(self, review_id: int):
+        db_exec("DELETE FROM reviews WHERE id=?", (review_id,))
+
+    def invite(self, user_id: int):
+        db_exec(
+            "INSERT INTO review_invites(user_id,invited_at,used) VALUES(?,?,0) "
+            "ON CONFLICT(user_id) DO UPDATE SET invited_at=excluded.invited_at, used=0",
+            (user_id, datetime.utcnow().isoformat()),
+        )
+
+    def open_invite(self, user_id: int) -> bool:
+        row = db_exec("SELECT used FROM review_invites WHERE user_id=?", (user_id,), fetchone=True)
+        return bool(row) and row["used"] == 0
+
+    def use_invite(self, user_id: int):
+        db_exec("UPDATE review_invites SET used=1 WHERE user_id=?", (user_id,))
+
+
+class Storage:
+    """Набор репозиториев одного бэкенда."""
+
+    def __init__(self, users, catalog, carts, orders, promos, partners, reviews):
+        self.users, self.catalog, self.carts, self.orders = users, catalog, carts, orders
+        self.promos, self.partners, self.reviews = promos, partners, reviews
+
+
+def sqlite_storage() -> Storage:
+    return Storage(SqliteUsers(), SqliteCatalog(), SqliteCarts(), SqliteOrders(),
+                   SqlitePromos(), SqlitePartners(), SqliteReviews())
+
+
+# ---------- бэкенд в памяти ----------
+# Те же методы на словарях. Строки — dict с теми же колонками, что в таблицах,
+# так что хендлеры читают их как sqlite3.Row по имени поля.
+def _locked(fn):
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with self.mem.lock:
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+
+def _like_lower(s: str) -> str:
+    # LIKE в SQLite без учёта регистра только для ASCII — повторяем это поведение
+    return "".join(ch.lower() if ch < "\x80" else ch for ch in s)
+
+
+class MemoryState:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.seq: Dict[str, int] = {}
+        self.users: Dict[int, Dict] = {}
+        self.categories: Dict[int, Dict] = {}
+        self.products: Dict[int, Dict] = {}
+        self.stock: Dict[Tuple[int, str], Dict] = {}
+        self.favorites: Dict[int, Dict] = {}
+        self.tombstones: Dict[int, int] = {}
+        self.cart_items: Dict[int, Dict] = {}
+        self.carts: Dict[int, Dict] = {}
+        self.orders: Dict[int, Dict] = {}
+        self.order_items: Dict[int, Dict] = {}
+        self.promo_codes: Dict[str, Dict] = {}
+        self.user_promos: Dict[int, Dict] = {}
+        self.partners: Dict[int, Dict] = {}
+        self.partner_requests: Dict[int, Dict] = {}
+        self.reviews: Dict[int, Dict] = {}
+        self.review_invites: Dict[int, Dict] = {}
+
+    def next_id(self, table: str) -> int:
+        self.seq[table] = self.seq.get(table, 0) + 1
+        return self.seq[table]
+
+
+class _MemoryRepo:
+    def __init__(self, mem: MemoryState):
+        self.mem = mem
+
+
+class MemoryUsers(_MemoryRepo):
+    @_locked
+    def get(self, user_id: int) -> Optional[Dict]:
+        row = self.mem.users.get(user_id)
+        return dict(row) if row else None
+
+    @_locked
+    def add(self, user_id: int, username: Optional[str], referrer_id: Optional[int] = None) -> bool:
+        if user_id in self.mem.users:
+            return False
+        self.mem.users[user_id] = {
+            "user_id": user_id, "username": username, "created_at": datetime.utcnow().isoformat(),
+            "referrer_id": None, "first_order_at": None, "ref_count": 0, "ref_converted": 0,
+        }
+        ref = self.mem.users.get(referrer_id) if referrer_id and referrer_id != user_id else None
+        if ref and ref["ref_count"] < REFERRAL_CAP:
+            ref["ref_count"] += 1
+            self.mem.users[user_id]["referrer_id"] = referrer_id
+        return True
+
+    @_locked
+    def mark_first_order(self, user_id: int):
+        u = self.mem.users.get(user_id)
+        if not u or u["first_order_at"] is not None:
+            return
+        u["first_order_at"] = datetime.utcnow().isoformat()
+        ref = self.mem.users.get(u["referrer_id"])
+        if ref:
+            ref["ref_converted"] += 1
+
+    @_locked
+    def set_username(self, user_id: int, username: Optional[str]):
+        if user_id in self.mem.users:
+            self.mem.users[user_id]["username"] = username
+
+    @_locked
+    def ids(self) -> List[int]:
+        return sorted(self.mem.users)
+
+    @_locked
+    def count(self) -> int:
+        return len(self.mem.users)
+
+    @_locked
+    def leaderboard(self, limit: int) -> List[Dict]:
+        rows = [u for u in self.mem.users.values() if u["ref_count"] > 0]
+        rows.sort(key=lambda u: (-u["ref_count"], -u["ref_converted"]))
+        return [{k: u[k] for k in ("user_id", "username", "ref_count", "ref_converted")} for u in rows[:limit]]
+
+
+class MemoryCatalog(_MemoryRepo):
+    @_locked
+    def category_id(self, name: str) -> int:
+        slug = name.lower()
+        for c in self.mem.categories.values():
+            if c["slug"] == slug:
+                return c["id"]
+        cat_id = self.mem.next_id("categories")
+        self.mem.categories[cat_id] = {"id": cat_id, "name": name, "slug": slug}
+        return cat_id
+
+    @_locked
+    def category(self, cat_id: int) -> Optional[Dict]:
+        row = self.mem.categories.get(cat_id)
+        return dict(row) if row else None
+
+    @_locked
+    def categories(self) -> List[Dict]:
+        return [dict(c) for c in sorted(self.mem.categories.values(), key=lambda c: c["name"])]
+
+    @_locked
+    def add_product(self, cat_id: int, title: str, description: str, price: int, photo_ids: List[str],
+                    is_preorder: bool, source_key: Optional[str], content_hash: Optional[str], version: int) -> int:
+        pid = self.mem.next_id("products")
+        self.mem.products[pid] = {
+            "id": pid, "category_id": cat_id, "title": title, "description": description, "price": price,
+            "is_preorder": int(is_preorder), "photos_json": json.dumps(photo_ids),
+            "created_at": datetime.utcnow().isoformat(), "source_key": source_key,
+            "content_hash": content_hash, "version": version,
+        }
+        return pid
+
+    @_locked
+    def product(self, product_id: int) -> Optional[Dict]:
+        row = self.mem.products.get(product_id)
+        return dict(row) if row else None
+
+    @_locked
+    def products_in(self, cat_id: int) -> List[Dict]:
+        return [dict(p) for p in sorted(self.mem.products.values(), key=lambda p: -p["id"])
+                if p["category_id"] == cat_id]
+
+    @_locked
+    def search(self, text: str) -> List[Dict]:
+        needle = _like_lower(text)
+        return [dict(p) for p in sorted(self.mem.products.values(), key=lambda p: -p["id"])
+                if needle in _like_lower(p["title"] or "")]
+
+    @_locked
+    def count_products(self) -> int:
+        return len(self.mem.products)
+
+    @_locked
+    def touch_products(self, product_ids: List[int], version: int):
+        for pid in product_ids:
+            if pid in self.mem.products:
+                self.mem.products[pid]["version"] = version
+
+    @_locked
+    def delete_category(self, cat_id: int, version: int) -> List[int]:
+        prod_ids = [p["id"] for p in self.mem.products.values() if p["category_id"] == cat_id]
+        gone = set(prod_ids)
+        for fid in [f["id"] for f in self.mem.favorites.values() if f["product_id"] in gone]:
+            del self.mem.favorites[fid]
+        for key in [k for k in self.mem.stock if k[0] in gone]:
+            del self.mem.stock[key]
+        for pid in prod_ids:
+            del self.mem.products[pid]
+            self.mem.tombstones[pid] = version
+        self.mem.categories.pop(cat_id, None)
+        return prod_ids
+
+    @_locked
+    def stock_map(self, product_ids: List[int]) -> Dict[Tuple[int, str], int]:
+        ids = set(product_ids)
+        return {k: s["qty"] for k, s in self.mem.stock.items() if k[0] in ids}
+
+    @_locked
+    def stock_qty(self, product_id: int, size: str) -> Optional[int]:
+        row = self.mem.stock.get((product_id, size))
+        return row["qty"] if row else None
+
+    @_locked
+    def take_stock(self, product_id: int, size: str, qty: int) -> bool:
+        row = self.mem.stock.get((product_id, size))
+        if not row or row["qty"] < qty:
+            return False
+        row["qty"] -= qty
+        row["updated_at"] = datetime.utcnow().isoformat()
+        return True
+
+    @_locked
+    def return_stock(self, product_id: int, size: str, qty: int):
+        row = self.mem.stock.get((product_id, size))
+        if row:
+            row["qty"] += qty
+            row["updated_at"] = datetime.utcnow().isoformat()
+
+    @_locked
+    def set_stock(self, product_id: int, size: str, qty: Optional[int]):
+        if qty is None:
+            self.mem.stock.pop((product_id, size), None)
+            return
+        self.mem.stock[(product_id, size)] = {"product_id": product_id, "size": size, "qty": qty,
+                                              "updated_at": datetime.utcnow().isoformat()}
+
+    @_locked
+    def toggle_favorite(self, user_id: int, product_id: int) -> bool:
+        for f in self.mem.favorites.values():
+            if f["user_id"] == user_id and f["product_id"] == product_id:
+                del self.mem.favorites[f["id"]]
+                return False
+        fid = self.mem.next_id("favorites")
+        self.mem.favorites[fid] = {"id": fid, "user_id": user_id, "product_id": product_id}
+        return True
+
+    @_locked
+    def favorites(self, user_id: int) -> List[Dict]:
+        out = []
+        for f in sorted(self.mem.favorites.values(), key=lambda f: -f["id"]):
+            p = self.mem.products.get(f["product_id"])
+            if f["user_id"] == user_id and p:
+                out.append(dict(f, title=p["title"], price=p["price"]))
+        return out
+
+
+class MemoryCarts(_MemoryRepo):
+    @_locked
+    def version(self, user_id: int) -> int:
+        row = self.mem.carts.get(user_id)
+        return row["version"] if row else 0
+
+    @_locked
+    def touch(self, user_id: int) -> int:
+        row = self.mem.carts.setdefault(user_id, {"user_id": user_id, "version": 0, "last_batch": None,
+                                                  "updated_at": None})
+        row["version"] += 1
+        row["updated_at"] = datetime.utcnow().isoformat()
+        return row["version"]
+
+    def _find(self, user_id: int, product_id: int, size: str) -> Optional[Dict]:
+        for it in self.mem.cart_items.values():
+            if it["user_id"] == user_id and it["product_id"] == product_id and it["size"] == size:
+                return it
+        return None
+
+    @_locked
+    def items(self, user_id: int) -> List[Dict]:
+        out = []
+        for it in sorted(self.mem.cart_items.values(), key=lambda it: it["id"]):
+            p = self.mem.products.get(it["product_id"])
+            if it["user_id"] == user_id and p:
+                out.append(dict(it, title=p["title"], price=p["price"]))
+        return out
+
+    @_locked
+    def add(self, user_id: int, product_id: int, size: str, qty: int):
+        it = self._find(user_id, product_id, size)
+        if it:
+            it["qty"] += qty
+        else:
+            self.set_qty(user_id, product_id, size, qty)
+
+    @_locked
+    def change_qty(self, user_id: int, item_id: int, delta: int) -> bool:
+        it = self.mem.cart_items.get(item_id)
+        if not it or it["user_id"] != user_id:
+            return False
+        qty = int(it["qty"] or 1) + delta
+        if qty <= 0:
+            del self.mem.cart_items[item_id]
+        else:
+            it["qty"] = qty
+        return True
+
+    @_locked
+    def remove(self, user_id: int, item_id: int) -> bool:
+        it = self.mem.cart_items.get(item_id)
+        if not it or it["user_id"] != user_id:
+            return False
+        del self.mem.cart_items[item_id]
+        return True
+
+    @_locked
+    def clear(self, user_id: int) -> int:
+        ids = [i for i, it in self.mem.cart_items.items() if it["user_id"] == user_id]
+        for i in ids:
+            del self.mem.cart_items[i]
+        return len(ids)
+
+    @_locked
+    def qty(self, user_id: int, product_id: int, size: str) -> int:
+        it = self._find(user_id, product_id, size)
+        return it["qty"] if it else 0
+
+    @_locked
+    def set_qty(self, user_id: int, product_id: int, size: str, qty: int):
+        it = self._find(user_id, product_id, size)
+        if qty <= 0:
+            if it:
+                del self.mem.cart_items[it["id"]]
+            return
+        if it:
+            it["qty"] = qty
+            return
+        item_id = self.mem.next_id("cart_items")
+        self.mem.cart_items[item_id] = {"id": item_id, "user_id": user_id, "product_id": product_id, "size": size,
+                                        "qty": qty, "created_at": datetime.utcnow().isoformat()}
+
+    @_locked
+    def last_batch(self, user_id: int) -> Optional[str]:
+        row = self.mem.carts.get(user_id)
+        return row["last_batch"] if row else None
+
+    @_locked
+    def set_last_batch(self, user_id: int, batch_id: str):
+        row = self.mem.carts.setdefault(user_id, {"user_id": user_id, "version": 0, "last_batch": None,
+                                                  "updated_at": datetime.utcnow().isoformat()})
+        row["last_batch"] = batch_id
+
+    @_locked
+    def drop_products(self, product_ids: List[int]) -> List[int]:
+        gone = set(product_ids)
+        hit = [it for it in self.mem.cart_items.values() if it["product_id"] in gone]
+        for it in hit:
+            del self.mem.cart_items[it["id"]]
+        return sorted({it["user_id"] for it in hit})
+
+
+class MemoryOrders(_MemoryRepo):
+    @_locked
+    def create(self, user_id: int, total: int) -> int:
+        order_id = self.mem.next_id("orders")
+        self.mem.orders[order_id] = {
+            "id": order_id, "user_id": user_id, "status": "новый", "total": total, "discount_percent": 0,
+            "final_total": total, "promo_code": None, "created_at": datetime.utcnow().isoformat(),
+            "partner_commission": 0, "partner_paid": 0,
+        }
+        return order_id
+
+    @_locked
+    def add_item(self, order_id: int, product_id: int, size: str, qty: int, price: int, stock_held: int):
+        item_id = self.mem.next_id("order_items")
+        self.mem.order_items[item_id] = {"id": item_id, "order_id": order_id, "product_id": product_id, "size": size,
+                                         "qty": qty, "price": price, "stock_held": stock_held}
+
+    @_locked
+    def set_discount(self, order_id: int, percent: int, final_total: int, promo_code: str):
+        self.mem.orders[order_id].update(discount_percent=percent, final_total=final_total, promo_code=promo_code)
+
+    @_locked
+    def get(self, order_id: int) -> Optional[Dict]:
+        row = self.mem.orders.get(order_id)
+        return dict(row) if row else None
+
+    @_locked
+    def set_status(self, order_id: int, status: str) -> bool:
+        if order_id not in self.mem.orders:
+            return False
+        self.mem.orders[order_id]["status"] = status
+        return True
+
+    def _heads(self, match: Callable, limit: int) -> List[Dict]:
+        rows = sorted((o for o in self.mem.orders.values() if match(o)), key=lambda o: -o["id"])[:limit]
+        return [{k: o[k] for k in ORDER_LIST_COLS.split(", ")} for o in rows]
+
+    @_locked
+    def recent(self, limit: int) -> List[Dict]:
+        return self._heads(lambda o: True, limit)
+
+    @_locked
+    def user_page(self, user_id: int, before_id: Optional[int], limit: int) -> Tuple[List[Dict], Optional[int]]:
+        before = before_id or 2 ** 62
+        orders = _order_heads(self._heads(lambda o: o["user_id"] == user_id and o["id"] < before, limit + 1))
+        for it in sorted(self.mem.order_items.values(), key=lambda it: it["id"]):
+            if it["order_id"] in orders:
+                p = self.mem.products.get(it["product_id"])
+                orders[it["order_id"]]["items"].append(
+                    {"title": p["title"] if p else None, "size": it["size"], "qty": it["qty"], "price": it["price"]})
+        return _order_page(orders, limit)
+
+    @_locked
+    def items(self, order_id: int) -> List[Dict]:
+        return [{k: it[k] for k in ("id", "product_id", "size", "qty", "stock_held")}
+                for it in sorted(self.mem.order_items.values(), key=lambda it: it["id"])
+                if it["order_id"] == order_id]
+
+    @_locked
+    def held_items(self, order_id: int) -> List[Dict]:
+        return [{k: it[k] for k in ("id", "product_id", "size", "stock_held")}
+                for it in sorted(self.mem.order_items.values(), key=lambda it: it["id"])
+                if it["order_id"] == order_id and it["stock_held"] > 0]
+
+    @_locked
+    def set_held(self, item_id: int, qty: int):
+        self.mem.order_items[item_id]["stock_held"] = qty
+
+    @_locked
+    def count(self) -> int:
+        return len(self.mem.orders)
+
+    @_locked
+    def revenue(self, status: str) -> int:
+        return sum(o["final_total"] or 0 for o in self.mem.orders.values() if o["status"] == status)
+
+
+class MemoryPromos(_MemoryRepo):
+    @_locked
+    def get(self, code: str) -> Optional[Dict]:
+        row = self.mem.promo_codes.get(code)
+        return dict(row) if row else None
+
+    @_locked
+    def add(self, code: str, percent: int, max_uses: int, update: bool = False) -> bool:
+        row = self.mem.promo_codes.get(code)
+        if row:
+            if update:
+                row.update(discount_percent=percent, max_uses=max_uses)
+            return update
+        self.mem.promo_codes[code] = {"code": code, "discount_percent": percent, "max_uses": max_uses, "used": 0,
+                                      "confirmed_uses": 0, "created_at": datetime.utcnow().isoformat()}
+        return True
+
+    @_locked
+    def all(self) -> List[Dict]:
+        rows = sorted(self.mem.promo_codes.values(), key=lambda r: r["code"])
+        return [dict(r) for r in sorted(rows, key=lambda r: r["created_at"], reverse=True)]
+
+    @_locked
+    def totals(self) -> Tuple[int, int]:
+        rows = self.mem.promo_codes.values()
+        return sum(r["used"] for r in rows), sum(r["confirmed_uses"] for r in rows)
+
+    @_locked
+    def user_promo(self, user_id: int) -> Optional[Dict]:
+        row = self.mem.user_promos.get(user_id)
+        return dict(row) if row else None
+
+    @_locked
+    def set_user_promo(self, user_id: int, code: str, percent: int):
+        self.mem.user_promos[user_id] = {"user_id": user_id, "code": code, "discount_percent": percent,
+                                         "set_at": datetime.utcnow().isoformat()}
+
+    @_locked
+    def clear_user_promo(self, user_id: int):
+        self.mem.user_promos.pop(user_id, None)
+
+
+class MemoryPartners(_MemoryRepo):
+    @_locked
+    def get(self, user_id: int) -> Optional[Dict]:
+        row = self.mem.partners.get(user_id)
+        return dict(row) if row else None
+
+    @_locked
+    def by_code(self, code: str) -> Optional[Dict]:
+        for p in self.mem.partners.values():
+            if p["code"] == code and p["is_active"] == 1:
+                return dict(p)
+        return None
+
+    @_locked
+    def upsert(self, user_id: int, username: Optional[str], code: str, discount_percent: int, commission_percent: int):
+        row = self.mem.partners.setdefault(user_id, {
+            "user_id": user_id, "balance": 0, "total_earned": 0, "total_sales": 0, "confirmed_uses": 0,
+            "created_at": datetime.utcnow().isoformat(),
+        })
+        row.update(username=username, code=code, discount_percent=discount_percent,
+                   commission_percent=commission_percent, is_active=1)
+
+    @_locked
+    def request(self, user_id: int) -> Optional[Dict]:
+        row = self.mem.partner_requests.get(user_id)
+        return dict(row) if row else None
+
+    @_locked
+    def submit_request(self, user_id: int, username: Optional[str]) -> bool:
+        row = self.mem.partner_requests.get(user_id)
+        if row and row["status"] == "pending":
+            return False
+        if not row:
+            row = self.mem.partner_requests[user_id] = {"id": self.mem.next_id("partner_requests"),
+                                                        "user_id": user_id}
+        row.update(username=username, status="pending", requested_at=datetime.utcnow().isoformat(), decided_at=None)
+        return True
+
+    @_locked
+    def decide_request(self, user_id: int, username: Optional[str], status: str):
+        now = datetime.utcnow().isoformat()
+        row = self.mem.partner_requests.get(user_id)
+        if not row:
+            row = self.mem.partner_requests[user_id] = {"id": self.mem.next_id("partner_requests"),
+                                                        "user_id": user_id, "username": username,
+                                                        "requested_at": now}
+        row.update(status=status, decided_at=now)
+
+
+class MemoryReviews(_MemoryRepo):
+    @_locked
+    def add(self, user_id: int, text: str, photos: List[str]) -> int:
+        review_id = self.mem.next_id("reviews")
+        self.mem.reviews[review_id] = {"id": review_id, "user_id": user_id, "text": text,
+                                       "photos_json": json.dumps(photos), "is_approved": 0,
+                                       "created_at": datetime.utcnow().isoformat()}
+        return review_id
+
+    @_locked
+    def get(self, review_id: int) -> Optional[Dict]:
+        row = self.mem.reviews.get(review_id)
+        return dict(row) if row else None
+
+    @_locked
+    def next_pending(self, after_id: int) -> Optional[Dict]:
+        ids = [r["id"] for r in self.mem.reviews.values() if r["is_approved"] == 0 and r["id"] > after_id]
+        return dict(self.mem.reviews[min(ids)]) if ids else None
+
+    @_locked
+    def count_pending(self) -> int:
+        return sum(1 for r in self.mem.reviews.values() if r["is_approved"] == 0)
+
+    @_locked
+    def approved(self) -> List[Dict]:
+        return [dict(r) for r in sorted(self.mem.reviews.values(), key=lambda r: -r["id"]) if r["is_approved"] == 1]
+
+    @_locked
+    def approve(self, review_id: int):
+        if review_id in self.mem.reviews:
+            self.mem.reviews[review_id]["is_approved"] = 1
+
+    @_locked
+    def delete(self, review_id: int):
+        self.mem.reviews.pop(review_id, None)
+
+    @_locked
+    def invite(self, user_id: int):
+        self.mem.review_invites[user_id] = {"user_id": user_id, "invited_at": datetime.utcnow().isoformat(),
+                                            "used": 0}
+
+    @_locked
+    def open_invite(self, user_id: int) -> bool:
+        row = self.mem.review_invites.get(user_id)
+        return bool(row) and row["used"] == 0
+
+    @_locked
+    def use_invite(self, user_id: int):
+        if user_id in self.mem.review_invites:
+            self.mem.review_invites[user_id]["used"] = 1
+
+
+def memory_storage() -> Storage:
+    mem = MemoryState()
+    return Storage(MemoryUsers(mem), MemoryCatalog(mem), MemoryCarts(mem), MemoryOrders(mem),
+                   MemoryPromos(mem), MemoryPartners(mem), MemoryReviews(mem))
+
+
+REPO = sqlite_storage()
+
+
+def use_storage(storage: Storage) -> Storage:
+    """Подменяет бэкенд (бенчмарки). Возвращает прежний, чтобы вернуть его обратно."""
+    global REPO
+    prev, REPO = REPO, storage
+    invalidate_render_cache()
+    return prev
+
+
 # ================== ПОЛЬЗОВАТЕЛИ ==================
 def add_user(user_id: int, username: Optional[str], referrer_id: Optional[int] = None):
-    exists = db_exec("SELECT user_id FROM users WHERE user_id=?", (user_id,), fetchone=True)
-    if exists:
+    if REPO.users.get(user_id):
         return
+    REPO.users.add(user_id, username, referrer_id)
 
-    valid_ref = None
-    if referrer_id and referrer_id != user_id:
-        count = db_exec(
-            "SELECT COUNT(*) AS c FROM users WHERE referrer_id=?",
-            (referrer_id,),
-            fetchone=True,
-        )["c"]
-        if count < REFERRAL_CAP:
-            valid_ref = referrer_id
 
-    db_exec(
-        "INSERT INTO users(user_id, username, created_at, referrer_id) VALUES (?,?,?,?)",
-        (user_id, username, datetime.utcnow().isoformat(), valid_ref),
-    )
+def mark_first_order(user_id: int):
+    """Первый заказ реферала — +1 к конверсии пригласившего."""
+    REPO.users.mark_first_order(user_id)
 
 
 def update_username(user_id: int, username: Optional[str]):
-    db_exec("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+    REPO.users.set_username(user_id, username)
 
 
 def get_ref_stats(user_id: int) -> Tuple[int, int]:
-    c = db_exec(
-        "SELECT COUNT(*) AS c FROM users WHERE referrer_id=?",
-        (user_id,),
-        fetchone=True,
-    )["c"]
-    return c, REFERRAL_CAP
+    row = REPO.users.get(user_id)
+    return (int(row["ref_count"] or 0) if row else 0), REFERRAL_CAP
+
+
+def get_referral_leaderboard(limit: int = 10) -> List[sqlite3.Row]:
+    return REPO.users.leaderboard(limit)
 
 
 # ================== КАТЕГОРИИ / ТОВАРЫ ==================
 def get_or_create_category(name: str) -> int:
-    name = name.strip()
-    slug = name.lower()
-    row = db_exec("SELECT id FROM categories WHERE slug=?", (slug,), fetchone=True)
-    if row:
-        return row["id"]
-    db_exec("INSERT INTO categories(name, slug) VALUES(?,?)", (name, slug))
-    row = db_exec("SELECT id FROM categories WHERE slug=?", (slug,), fetchone=True)
-    return row["id"]
+    return REPO.catalog.category_id(name.strip())
 
 
 def create_product(
@@ -311,128 +2276,333 @@ def create_product(
     price: int,
     photo_ids: List[str],
     is_preorder: bool = False,
+    source_key: Optional[str] = None,
+    content_hash: Optional[str] = None,
 ) -> int:
-    cat_id = get_or_create_category(category_name)
-    db_exec(
-        """
-        INSERT INTO products(category_id,title,description,price,is_preorder,photos_json,created_at)
-        VALUES (?,?,?,?,?,?,?)
-        """,
-        (
-            cat_id, title, description, price, int(is_preorder),
-            json.dumps(photo_ids), datetime.utcnow().isoformat()
-        ),
-    )
-    row = db_exec("SELECT id FROM products ORDER BY id DESC LIMIT 1", fetchone=True)
-    return row["id"]
+    with db_tx():
+        cat_id = get_or_create_category(category_name)
+        return REPO.catalog.add_product(cat_id, title, description, price, photo_ids, is_preorder,
+                                        source_key, content_hash, bump_catalog_version())
 
 
 def get_categories() -> List[sqlite3.Row]:
-    return db_exec("SELECT * FROM categories ORDER BY name", fetchall=True)
+    return REPO.catalog.categories()
 
 
 def get_products_by_category(cat_id: int) -> List[sqlite3.Row]:
-    return db_exec(
-        "SELECT * FROM products WHERE category_id=? ORDER BY id DESC",
-        (cat_id,), fetchall=True
-    )
+    return REPO.catalog.products_in(cat_id)
 
 
 def get_product(product_id: int) -> Optional[sqlite3.Row]:
-    return db_exec("SELECT * FROM products WHERE id=?", (product_id,), fetchone=True)
+    return REPO.catalog.product(product_id)
 
 
 def delete_category_full(cat_id: int):
-    """Полное удаление категории: товары + корзины/избранное + сама категория."""
-    prod_ids = db_exec("SELECT id FROM products WHERE category_id=?", (cat_id,), fetchall=True)
-    prod_ids = [p["id"] for p in prod_ids] if prod_ids else []
+    """Полное удаление категории: товары + корзины/избранное/остатки + сама категория."""
+    with db_tx():
+        prod_ids = REPO.catalog.delete_category(cat_id, bump_catalog_version())
+        for uid in REPO.carts.drop_products(prod_ids):
+            touch_cart(uid)
 
-    if prod_ids:
-        q_marks = ",".join(["?"] * len(prod_ids))
-        db_exec(f"DELETE FROM cart_items WHERE product_id IN ({q_marks})", tuple(prod_ids))
-        db_exec(f"DELETE FROM favorites WHERE product_id IN ({q_marks})", tuple(prod_ids))
-        db_exec(f"DELETE FROM products WHERE id IN ({q_marks})", tuple(prod_ids))
 
-    db_exec("DELETE FROM categories WHERE id=?", (cat_id,))
+# ================== СКЛАД ==================
+class OutOfStock(Exception):
+    def __init__(self, items: List[Dict]):
+        super().__init__("out of stock")
+        self.items = items
 
 
-# ================== КОРЗИНА / ЗАКАЗЫ ==================
-def add_to_cart(user_id: int, product_id: int, size: str, qty: int = 1):
-    db_exec(
-        """
-        INSERT INTO cart_items(user_id,product_id,size,qty,created_at)
-        VALUES (?,?,?,?,?)
-        """,
-        (user_id, product_id, size, qty, datetime.utcnow().isoformat()),
-    )
+def _touch_products(product_ids: List[int]):
+    """Набор доступных размеров поменялся — товар уходит в /api/changes."""
+    ids = sorted(set(product_ids))
+    if not ids:
+        return
+    with db_tx():
+        REPO.catalog.touch_products(ids, bump_catalog_version())
 
 
-def get_cart(user_id: int) -> List[sqlite3.Row]:
-    return db_exec(
-        """
-        SELECT c.*, p.title, p.price
-        FROM cart_items c
-        JOIN products p ON p.id=c.product_id
-        WHERE c.user_id=?
-        ORDER BY c.id
-        """,
-        (user_id,), fetchall=True
-    )
+def get_stock_map(product_ids: List[int]) -> Dict[Tuple[int, str], int]:
+    return REPO.catalog.stock_map(product_ids)
 
 
-def update_cart_item_qty(item_id: int, delta: int):
-    row = db_exec("SELECT qty FROM cart_items WHERE id=?", (item_id,), fetchone=True)
-    if not row:
-        return
-    qty = int(row["qty"] or 1) + delta
-    if qty <= 0:
-        db_exec("DELETE FROM cart_items WHERE id=?", (item_id,))
-    else:
-        db_exec("UPDATE cart_items SET qty=? WHERE id=?", (qty, item_id))
+def in_stock_sizes(product_id: int, sizes: List[str], stock: Dict[Tuple[int, str], int] = None) -> List[str]:
+    if stock is None:
+        stock = get_stock_map([product_id])
+    return [s for s in sizes if stock.get((product_id, s), 1) > 0]
+
+
+def size_available(product_id: int, size: str, qty: int = 1) -> bool:
+    left = REPO.catalog.stock_qty(product_id, size)
+    return left is None or left >= qty
+
+
+def take_stock(product_id: int, size: str, qty: int) -> Optional[int]:
+    """
+    Условное списание: UPDATE пройдёт, только если остатка хватает, поэтому два
+    параллельных заказа не уведут в минус. None — размер не учитывается, иначе
+    сколько списали (0 — не хватило).
+    """
+    with db_tx():
+        if REPO.catalog.take_stock(product_id, size, qty):
+            if REPO.catalog.stock_qty(product_id, size) <= 0:
+                _touch_products([product_id])
+            return qty
+        if REPO.catalog.stock_qty(product_id, size) is not None:
+            return 0
+    return None
+
+
+def release_order_stock(order_id: int) -> int:
+    """Возвращает на склад всё, что заказ списал. Повторный вызов ничего не делает."""
+    returned, touched = 0, []
+    with db_tx():
+        for it in REPO.orders.held_items(order_id):
+            left = REPO.catalog.stock_qty(it["product_id"], it["size"])
+            if left is not None:
+                REPO.catalog.return_stock(it["product_id"], it["size"], it["stock_held"])
+                if left <= 0:
+                    touched.append(it["product_id"])
+            REPO.orders.set_held(it["id"], 0)
+            returned += it["stock_held"]
+        _touch_products(touched)
+    return returned
+
+
+def retake_order_stock(order_id: int):
+    """Заказ вернули из отмены — списываем его остатки заново. Не хватило — OutOfStock
+    до любых списаний, и статус не меняется: иначе те же штуки продадут дважды."""
+    with db_tx():
+        items = [it for it in REPO.orders.items(order_id) if not it["stock_held"]]
+        short = []
+        for it in items:
+            if not size_available(it["product_id"], it["size"], it["qty"]):
+                p = get_product(it["product_id"])
+                left = REPO.catalog.stock_qty(it["product_id"], it["size"])
+                short.append({"title": p["title"] if p else f"#{it['product_id']}", "size": it["size"],
+                              "left": max(0, left or 0)})
+        if short:
+            raise OutOfStock(short)
+        for it in items:
+            held = take_stock(it["product_id"], it["size"], it["qty"])
+            if held == 0:
+                raise OutOfStock([{"title": f"#{it['product_id']}", "size": it["size"], "left": 0}])
+            if held:
+                REPO.orders.set_held(it["id"], held)
+
+
+def parse_stock_table(text: str) -> Tuple[List[Tuple[int, str, Optional[int]]], List[str]]:
+    """
+    Строки вида «12 M 3» (можно табами из таблицы) или «12 S=3 M=0 L=5».
+    Количество «-» — снять размер с учёта.
+    """
+    rows, errors = [], []
+    for line in (text or "").splitlines():
+        parts = [p for p in re.split(r"[\s;,]+", line.strip()) if p]
+        if not parts:
+            continue
+        try:
+            pid = int(parts[0])
+            if len(parts) == 3 and "=" not in parts[1]:
+                pairs = [(parts[1], parts[2])]
+            else:
+                pairs = [p.split("=", 1) for p in parts[1:]]
+                if not pairs or any(len(p) != 2 for p in pairs):
+                    raise ValueError
+            for size, qty in pairs:
+                rows.append((pid, size.upper(), None if qty == "-" else max(0, int(qty))))
+        except ValueError:
+            errors.append(line.strip())
+    return rows, errors
+
+
+def set_stock_bulk(rows: List[Tuple[int, str, Optional[int]]]) -> Dict[str, int]:
+    report = {"set": 0, "removed": 0, "unknown": 0}
+    touched = []
+    with db_tx():
+        for pid, size, qty in rows:
+            if not get_product(pid):
+                report["unknown"] += 1
+                continue
+            REPO.catalog.set_stock(pid, size, qty)
+            report["removed" if qty is None else "set"] += 1
+            touched.append(pid)
+        _touch_products(touched)
+    return report
+
+
+# ================== КОРЗИНА / ЗАКАЗЫ ==================
+def touch_cart(user_id: int) -> int:
+    """+1 к версии корзины. Вызывать в той же транзакции, что и изменение."""
+    return REPO.carts.touch(user_id)
+
+
+def get_cart_version(user_id: int) -> int:
+    return REPO.carts.version(user_id)
+
+
+def add_to_cart(user_id: int, product_id: int, size: str, qty: int = 1):
+    with db_tx():
+        REPO.carts.add(user_id, product_id, size, qty)
+        touch_cart(user_id)
+
+
+def get_cart(user_id: int) -> List[sqlite3.Row]:
+    return REPO.carts.items(user_id)
+
+
+def update_cart_item_qty(user_id: int, item_id: int, delta: int):
+    with db_tx():
+        if REPO.carts.change_qty(user_id, item_id, delta):
+            touch_cart(user_id)
+
+
+def remove_cart_item(user_id: int, item_id: int):
+    with db_tx():
+        if REPO.carts.remove(user_id, item_id):
+            touch_cart(user_id)
 
 
 def clear_cart(user_id: int):
-    db_exec("DELETE FROM cart_items WHERE user_id=?", (user_id,))
+    with db_tx():
+        if REPO.carts.clear(user_id):
+            touch_cart(user_id)
+
+
+def apply_cart_ops(user_id: int, ops: List[Dict], batch_id: Optional[str] = None) -> Dict:
+    """
+    Пачка изменений корзины из WebApp — одной транзакцией.
+    op: add (+qty), set (qty, 0 — удалить), remove, clear. Товар+размер — ключ позиции.
+    Повтор той же batch_id (клиент не дождался ответа) второй раз не применяется.
+    """
+    rejected = []
+    with db_tx():
+        if batch_id and REPO.carts.last_batch(user_id) == batch_id:
+            return {"applied": 0, "rejected": rejected}
+
+        applied = 0
+        for i, op in enumerate(ops):
+            if not isinstance(op, dict):
+                rejected.append(i)
+                continue
+            kind = op.get("op")
+            if kind == "clear":
+                REPO.carts.clear(user_id)
+                applied += 1
+                continue
+            try:
+                pid = int(op.get("product_id"))
+                size = str(op.get("size") or "")[:16]
+                qty = int(op.get("qty") or 0)
+            except (TypeError, ValueError):
+                rejected.append(i)
+                continue
+            if kind == "remove":
+                REPO.carts.set_qty(user_id, pid, size, 0)
+            elif kind in ("add", "set") and get_product(pid) and 0 <= qty <= 99:
+                if kind == "add":
+                    qty = min(99, REPO.carts.qty(user_id, pid, size) + qty)
+                if qty and not size_available(pid, size, qty):
+                    rejected.append(i)
+                    continue
+                REPO.carts.set_qty(user_id, pid, size, qty)
+            else:
+                rejected.append(i)
+                continue
+            applied += 1
 
+        if applied:
+            touch_cart(user_id)
+        if batch_id:
+            REPO.carts.set_last_batch(user_id, batch_id)
+    return {"applied": applied, "rejected": rejected}
 
-def get_user_orders(user_id: int) -> List[sqlite3.Row]:
-    return db_exec(
-        "SELECT * FROM orders WHERE user_id=? ORDER BY id DESC",
-        (user_id,), fetchall=True
-    )
+
+ORDERS_PAGE_SIZE = 5
+
+
+def recent_orders(limit: int = 20) -> List[sqlite3.Row]:
+    return REPO.orders.recent(limit)
+
+
+def get_user_orders_page(user_id: int, before_id: Optional[int] = None,
+                         limit: int = ORDERS_PAGE_SIZE) -> Tuple[List[Dict], Optional[int]]:
+    """Страница заказов (keyset по id) с позициями. Возвращает (заказы, курсор дальше)."""
+    return REPO.orders.user_page(user_id, before_id, limit)
 
 
 def get_order(order_id: int) -> Optional[sqlite3.Row]:
-    return db_exec("SELECT * FROM orders WHERE id=?", (order_id,), fetchone=True)
+    return REPO.orders.get(order_id)
 
 
 def set_order_status(order_id: int, status: str):
-    db_exec("UPDATE orders SET status=? WHERE id=?", (status, order_id))
+    REPO.orders.set_status(order_id, status)
+
+
+def _move_orders(order_ids: List[int], to_archive: bool = True) -> int:
+    """Переносит заказы с позициями между orders* и *_archive. Вызывать внутри db_tx()."""
+    (hot_o, cold_o), (hot_i, cold_i) = ARCHIVE_TABLES
+    src_o, dst_o, src_i, dst_i = (hot_o, cold_o, hot_i, cold_i) if to_archive else (cold_o, hot_o, cold_i, hot_i)
+    q_marks = ",".join(["?"] * len(order_ids))
+    ids = tuple(order_ids)
+    # колонки берём у горячих таблиц: архив их надмножество
+    cols_o = ",".join(_table_columns(hot_o))
+    cols_i = ",".join(_table_columns(hot_i))
+    with db_tx():
+        moved = db_exec(f"INSERT OR REPLACE INTO {dst_o}({cols_o}) SELECT {cols_o} FROM {src_o} WHERE id IN ({q_marks})",
+                        ids, rowcount=True)
+        db_exec(f"INSERT OR REPLACE INTO {dst_i}({cols_i}) SELECT {cols_i} FROM {src_i} WHERE order_id IN ({q_marks})", ids)
+        db_exec(f"DELETE FROM {src_i} WHERE order_id IN ({q_marks})", ids)
+        db_exec(f"DELETE FROM {src_o} WHERE id IN ({q_marks})", ids)
+    return moved
+
+
+def _settle_held_promos(ids: List[int]):
+    """Резервы, оставшиеся 'held' у закрытых заказов: доставленный — подтверждаем, отменённый — снимаем."""
+    q_marks = ",".join(["?"] * len(ids))
+    for o in db_exec(
+        f"SELECT o.* FROM orders o JOIN promo_reservations r ON r.order_id=o.id "
+        f"WHERE r.status='held' AND o.id IN ({q_marks})",
+        ids, fetchall=True
+    ):
+        if o["status"] in ORDER_CANCEL_STATUSES:
+            release_promo_reservation(o["id"], status="expired")
+        else:
+            confirm_order_promo(o)
+
+
+@maintenance_task
+def archive_old_orders() -> int:
+    """Закрытые заказы старше ORDER_ARCHIVE_DAYS — в архив, только по статусу заказа.
+    Висящий резерв промокода перед переносом закрываем: иначе expire_promo_reservations
+    принял бы заказ за удалённый."""
+    cutoff = _days_ago(ORDER_ARCHIVE_DAYS)
+    q_marks = ",".join(["?"] * len(ORDER_CLOSED_STATUSES))
+    total = 0
+    while True:
+        with db_tx():
+            ids = [r["id"] for r in db_exec(
+                f"""
+                SELECT id FROM orders
+                WHERE status IN ({q_marks}) AND created_at<?
+                ORDER BY id LIMIT ?
+                """,
+                (*ORDER_CLOSED_STATUSES, cutoff, MAINT_BATCH), fetchall=True
+            )]
+            if ids:
+                _settle_held_promos(ids)
+                total += _move_orders(ids)
+        if len(ids) < MAINT_BATCH:
+            return total
+        time.sleep(MAINT_PAUSE)
 
 
 # ================== ИЗБРАННОЕ ==================
 def toggle_favorite(user_id: int, product_id: int) -> bool:
-    row = db_exec(
-        "SELECT id FROM favorites WHERE user_id=? AND product_id=?",
-        (user_id, product_id), fetchone=True
-    )
-    if row:
-        db_exec("DELETE FROM favorites WHERE id=?", (row["id"],))
-        return False
-    db_exec("INSERT INTO favorites(user_id,product_id) VALUES(?,?)", (user_id, product_id))
-    return True
+    return REPO.catalog.toggle_favorite(user_id, product_id)
 
 
 def get_favorites(user_id: int) -> List[sqlite3.Row]:
-    return db_exec(
-        """
-        SELECT f.*, p.title, p.price
-        FROM favorites f JOIN products p ON p.id=f.product_id
-        WHERE f.user_id=?
-        ORDER BY f.id DESC
-        """,
-        (user_id,), fetchall=True
-    )
+    return REPO.catalog.favorites(user_id)
 
 
 # ================== ПРОМОКОДЫ ==================
@@ -440,7 +2610,7 @@ def get_promo(code: str) -> Optional[sqlite3.Row]:
     code = code.strip().upper()
     if not code:
         return None
-    return db_exec("SELECT * FROM promo_codes WHERE code=?", (code,), fetchone=True)
+    return REPO.promos.get(code)
 
 
 def validate_promo(code: str) -> Tuple[int, str]:
@@ -459,37 +2629,133 @@ def validate_promo(code: str) -> Tuple[int, str]:
     return percent, code
 
 
-def apply_promo_use(code: str) -> Tuple[int, str]:
-    percent, code2 = validate_promo(code)
-    if not code2 or percent <= 0:
+def _take_promo_slot(code: str) -> bool:
+    """Одно условное UPDATE: лимит проверяется и списывается атомарно."""
+    return db_exec(
+        "UPDATE promo_codes SET used=used+1 "
+        "WHERE code=? AND (COALESCE(max_uses,0)<=0 OR used<max_uses)",
+        (code,), rowcount=True
+    ) > 0
+
+
+def reserve_promo(code: str, user_id: int, order_id: int) -> Tuple[int, str]:
+    """Резервирует одно использование промокода под заказ. Вызывать внутри db_tx() чекаута."""
+    row = get_promo(code)
+    if not row:
         return 0, ""
-    db_exec("UPDATE promo_codes SET used=used+1 WHERE code=?", (code2,))
-    return percent, code2
+    percent = min(int(row["discount_percent"] or 0), PROMO_MAX_PERCENT)
+    if percent <= 0:
+        return 0, ""
+
+    with db_tx():
+        if not _take_promo_slot(row["code"]):
+            return 0, ""
+        now = datetime.utcnow().isoformat()
+        db_exec(
+            "INSERT INTO promo_reservations(code,user_id,order_id,status,created_at,updated_at) "
+            "VALUES(?,?,?,'held',?,?)",
+            (row["code"], user_id, order_id, now, now),
+        )
+    return percent, row["code"]
 
 
-def promo_confirm_use(code: str):
+def confirm_promo_reservation(order_id: int, code: str) -> bool:
+    """
+    Резерв → подтверждённое использование. Повторный вызов ничего не меняет.
+    False — резерв истёк, а слот тем временем занял другой заказ: строка помечается
+    'over_limit' (слота за ней нет, release её не тронет), админу уходит предупреждение.
+    """
     if not code:
-        return
-    db_exec("UPDATE promo_codes SET confirmed_uses=confirmed_uses+1 WHERE code=?", (code,))
+        return False
+    with db_tx():
+        res = db_exec(
+            "SELECT * FROM promo_reservations WHERE order_id=? ORDER BY id DESC LIMIT 1",
+            (order_id,), fetchone=True
+        )
+        if res and res["status"] == "confirmed":
+            return True
+        if res and res["status"] == "over_limit":
+            return False
+        # резерв успел истечь — пробуем занять слот заново
+        if res and res["status"] != "held" and not _take_promo_slot(code):
+            db_exec(
+                "UPDATE promo_reservations SET status='over_limit', updated_at=? WHERE id=?",
+                (datetime.utcnow().isoformat(), res["id"]),
+            )
+            enqueue_message(
+                ADMIN_ID,
+                f"⚠️ Заказ #{order_id}: промокод <b>{html.escape(code)}</b> не подтверждён — "
+                "резерв истёк, а лимит использований уже выбран другими заказами.\n"
+                "Скидка в заказе осталась, комиссия партнёру не начислена. Реши вручную."
+            )
+            return False
+        if res:
+            db_exec(
+                "UPDATE promo_reservations SET status='confirmed', updated_at=? WHERE id=?",
+                (datetime.utcnow().isoformat(), res["id"]),
+            )
+        db_exec("UPDATE promo_codes SET confirmed_uses=confirmed_uses+1 WHERE code=?", (code,))
+    return True
+
+
+def release_promo_reservation(order_id: int, status: str = "released") -> bool:
+    """Возвращает слот промокода (отмена заказа или истёкший резерв). Слот есть только
+    у 'held' и 'confirmed' — истёкший или 'over_limit' резерв used не трогает."""
+    with db_tx():
+        res = db_exec(
+            "SELECT * FROM promo_reservations WHERE order_id=? AND status IN ('held','confirmed') "
+            "ORDER BY id DESC LIMIT 1",
+            (order_id,), fetchone=True
+        )
+        if not res:
+            return False
+        db_exec(
+            "UPDATE promo_reservations SET status=?, updated_at=? WHERE id=?",
+            (status, datetime.utcnow().isoformat(), res["id"]),
+        )
+        db_exec("UPDATE promo_codes SET used=used-1 WHERE code=? AND used>0", (res["code"],))
+        if res["status"] == "confirmed":
+            db_exec(
+                "UPDATE promo_codes SET confirmed_uses=confirmed_uses-1 WHERE code=? AND confirmed_uses>0",
+                (res["code"],),
+            )
+    return True
+
+
+@background_job(600)
+def expire_promo_reservations():
+    """Снимает резервы промокодов с отменённых и давно висящих новых заказов."""
+    cutoff = (datetime.utcnow() - timedelta(hours=PROMO_HOLD_TTL_HOURS)).isoformat()
+    q_marks = ",".join(["?"] * len(ORDER_CANCEL_STATUSES))
+    rows = db_exec(
+        f"""
+        SELECT r.order_id
+        FROM promo_reservations r
+        LEFT JOIN orders o ON o.id=r.order_id
+        WHERE r.status='held'
+          AND (o.id IS NULL
+               OR o.status IN ({q_marks})
+               OR (o.status='новый' AND r.created_at < ?))
+        LIMIT 500
+        """,
+        (*ORDER_CANCEL_STATUSES, cutoff), fetchall=True
+    )
+    for r in rows:
+        release_promo_reservation(r["order_id"], status="expired")
+    if rows:
+        print(f"promo reservations expired: {len(rows)}")
 
 
 def set_user_promo(user_id: int, code: str, percent: int):
-    db_exec("""
-        INSERT INTO user_promos(user_id, code, discount_percent, set_at)
-        VALUES(?,?,?,?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            code=excluded.code,
-            discount_percent=excluded.discount_percent,
-            set_at=excluded.set_at
-    """, (user_id, code, percent, datetime.utcnow().isoformat()))
+    REPO.promos.set_user_promo(user_id, code, percent)
 
 
 def clear_user_promo(user_id: int):
-    db_exec("DELETE FROM user_promos WHERE user_id=?", (user_id,))
+    REPO.promos.clear_user_promo(user_id)
 
 
 def get_user_promo(user_id: int) -> Tuple[int, str]:
-    row = db_exec("SELECT * FROM user_promos WHERE user_id=?", (user_id,), fetchone=True)
+    row = REPO.promos.user_promo(user_id)
     if not row:
         return 0, ""
     return int(row["discount_percent"] or 0), (row["code"] or "")
@@ -503,11 +2769,7 @@ def create_review_bonus_promo(user_id: int, review_id: int) -> str:
         code = f"{base}{i}"
         i += 1
 
-    db_exec("""
-        INSERT INTO promo_codes(code,discount_percent,max_uses,used,confirmed_uses,created_at)
-        VALUES(?,?,?,?,?,?)
-    """, (code, 5, 1, 0, 0, datetime.utcnow().isoformat()))
-
+    REPO.promos.add(code, 5, 1)
     return code
 
 
@@ -515,11 +2777,11 @@ def create_review_bonus_promo(user_id: int, review_id: int) -> str:
 def get_partner_by_code(code: str) -> Optional[sqlite3.Row]:
     if not code:
         return None
-    return db_exec("SELECT * FROM partners WHERE code=? AND is_active=1", (code.upper(),), fetchone=True)
+    return REPO.partners.by_code(code.upper())
 
 
 def get_partner(user_id: int) -> Optional[sqlite3.Row]:
-    return db_exec("SELECT * FROM partners WHERE user_id=?", (user_id,), fetchone=True)
+    return REPO.partners.get(user_id)
 
 
 def create_partner_code_for_user(user_id: int, username: str) -> str:
@@ -534,66 +2796,189 @@ def create_partner_code_for_user(user_id: int, username: str) -> str:
 
 
 def approve_partner_request(user_id: int):
-    u = db_exec("SELECT * FROM users WHERE user_id=?", (user_id,), fetchone=True)
+    u = REPO.users.get(user_id)
     username = u["username"] if u else None
 
     code = create_partner_code_for_user(user_id, username or "")
     discount_percent = 5
     commission_percent = 5
 
-    db_exec("""
-        INSERT INTO promo_codes(code,discount_percent,max_uses,used,confirmed_uses,created_at)
-        VALUES(?,?,?,?,?,?)
-        ON CONFLICT(code) DO NOTHING
-    """, (code, discount_percent, 0, 0, 0, datetime.utcnow().isoformat()))
+    REPO.promos.add(code, discount_percent, 0)
+    REPO.partners.upsert(user_id, username, code, discount_percent, commission_percent)
+    REPO.partners.decide_request(user_id, username, "approved")
 
-    db_exec("""
-        INSERT INTO partners(user_id,username,code,discount_percent,commission_percent,created_at)
-        VALUES(?,?,?,?,?,?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            username=excluded.username,
-            code=excluded.code,
-            discount_percent=excluded.discount_percent,
-            commission_percent=excluded.commission_percent,
-            is_active=1
-    """, (user_id, username, code, discount_percent, commission_percent, datetime.utcnow().isoformat()))
+    return code, discount_percent, commission_percent
 
-    db_exec("""
-        INSERT INTO partner_requests(user_id,username,status,requested_at,decided_at)
-        VALUES(?,?,?,?,?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            status='approved',
-            decided_at=excluded.decided_at
-    """, (user_id, username, "approved", datetime.utcnow().isoformat(), datetime.utcnow().isoformat()))
 
-    return code, discount_percent, commission_percent
+# агрегаты журнала: те же поля, что в partner_balances
+_LEDGER_SUMS = """
+    COALESCE(SUM(amount), 0) AS balance,
+    COALESCE(SUM(CASE WHEN kind!='payout' THEN amount END), 0) AS total_earned,
+    COALESCE(SUM(sales_amount), 0) AS total_sales,
+    COALESCE(SUM(CASE kind WHEN 'accrual' THEN 1 WHEN 'reversal' THEN -1 ELSE 0 END), 0) AS confirmed_uses,
+    COALESCE(SUM(CASE WHEN kind='payout' THEN -amount END), 0) AS total_paid,
+    MAX(id) AS last_entry_id
+"""
+_BALANCE_FIELDS = ("balance", "total_earned", "total_sales", "confirmed_uses", "total_paid")
+
+
+def _ledger_add(partner_id: int, kind: str, amount: int, sales_amount: int = 0, order_id: Optional[int] = None):
+    db_exec(
+        "INSERT INTO partner_ledger(partner_id,kind,amount,sales_amount,order_id,created_at) VALUES(?,?,?,?,?,?)",
+        (partner_id, kind, amount, sales_amount, order_id, datetime.utcnow().isoformat()),
+    )
+
+
+def get_partner_balance(partner_id: int) -> Dict[str, int]:
+    """Снапшот + хвост журнала после него. Хвост короткий — его регулярно сворачивает компакция."""
+    with db_tx():
+        snap = db_exec("SELECT * FROM partner_balances WHERE partner_id=?", (partner_id,), fetchone=True)
+        last_id = int(snap["last_entry_id"] or 0) if snap else 0
+        tail = db_exec(
+            f"SELECT {_LEDGER_SUMS} FROM partner_ledger WHERE partner_id=? AND id>?",
+            (partner_id, last_id), fetchone=True
+        )
+    return {f: (int(snap[f] or 0) if snap else 0) + int(tail[f] or 0) for f in _BALANCE_FIELDS}
+
+
+@background_job(3600)
+def compact_partner_ledger():
+    """Сворачивает хвост журнала каждого партнёра в partner_balances."""
+    with db_tx():
+        tails = db_exec(
+            f"""
+            SELECT l.partner_id, {_LEDGER_SUMS}
+            FROM partner_ledger l
+            LEFT JOIN partner_balances b ON b.partner_id=l.partner_id
+            WHERE l.id > COALESCE(b.last_entry_id, 0)
+            GROUP BY l.partner_id
+            """,
+            fetchall=True
+        )
+        now = datetime.utcnow().isoformat()
+        for t in tails:
+            db_exec(
+                """
+                INSERT INTO partner_balances(partner_id,balance,total_earned,total_sales,confirmed_uses,total_paid,last_entry_id,updated_at)
+                VALUES(?,?,?,?,?,?,?,?)
+                ON CONFLICT(partner_id) DO UPDATE SET
+                    balance=balance+excluded.balance,
+                    total_earned=total_earned+excluded.total_earned,
+                    total_sales=total_sales+excluded.total_sales,
+                    confirmed_uses=confirmed_uses+excluded.confirmed_uses,
+                    total_paid=total_paid+excluded.total_paid,
+                    last_entry_id=excluded.last_entry_id,
+                    updated_at=excluded.updated_at
+                """,
+                (t["partner_id"], *(t[f] for f in _BALANCE_FIELDS), t["last_entry_id"], now),
+            )
+    return len(tails)
+
+
+def accrue_partner_commission(order: sqlite3.Row) -> Optional[Tuple[sqlite3.Row, int, int]]:
+    """Начисление комиссии за подтверждённый заказ. Возвращает (партнёр, комиссия, сумма) или None."""
+    partner = get_partner_by_code(order["promo_code"])
+    if not partner:
+        return None
+    commission_percent = int(partner["commission_percent"] or 0)
+    final_total = int(order["final_total"] or order["total"] or 0)
+    commission = int(round(final_total * commission_percent / 100)) if commission_percent else 0
+    if commission <= 0:
+        return None
+
+    with db_tx():
+        # partner_paid — защёлка от двойного начисления по одному заказу
+        claimed = db_exec(
+            "UPDATE orders SET partner_commission=?, partner_paid=1 WHERE id=? AND partner_paid=0",
+            (commission, order["id"]), rowcount=True
+        )
+        if not claimed:
+            return None
+        _ledger_add(partner["user_id"], "accrual", commission, final_total, order["id"])
+    return partner, commission, final_total
+
+
+def reverse_partner_commission(order_id: int) -> Optional[Tuple[int, int]]:
+    """Сторно комиссии отменённого заказа. Возвращает (partner_id, сумма) или None."""
+    with db_tx():
+        o = get_order(order_id)
+        if not o or not int(o["partner_paid"] or 0):
+            return None
+        accrual = db_exec(
+            "SELECT * FROM partner_ledger WHERE order_id=? AND kind='accrual' ORDER BY id DESC LIMIT 1",
+            (order_id,), fetchone=True
+        )
+        if accrual:
+            partner_id = accrual["partner_id"]
+            amount, sales = int(accrual["amount"]), int(accrual["sales_amount"] or 0)
+        else:
+            # заказ подтверждён до появления журнала
+            partner = get_partner_by_code(o["promo_code"] or "")
+            if not partner:
+                return None
+            partner_id = partner["user_id"]
+            amount = int(o["partner_commission"] or 0)
+            sales = int(o["final_total"] or o["total"] or 0)
+
+        db_exec("UPDATE orders SET partner_paid=0 WHERE id=?", (order_id,))
+        _ledger_add(partner_id, "reversal", -amount, -sales, order_id)
+    return partner_id, amount
+
+
+def get_payable_partners() -> List[Tuple[sqlite3.Row, int]]:
+    compact_partner_ledger()
+    rows = db_exec(
+        """
+        SELECT p.*, b.balance AS ledger_balance
+        FROM partner_balances b JOIN partners p ON p.user_id=b.partner_id
+        WHERE b.balance>=?
+        ORDER BY b.balance DESC
+        """,
+        (PARTNER_PAYOUT_MIN,), fetchall=True
+    )
+    return [(r, int(r["ledger_balance"])) for r in rows]
+
+
+def settle_partner_payouts() -> List[Tuple[sqlite3.Row, int]]:
+    """Закрывает балансы всех партнёров от PARTNER_PAYOUT_MIN одной транзакцией."""
+    with db_tx():
+        payable = get_payable_partners()
+        for partner, amount in payable:
+            _ledger_add(partner["user_id"], "payout", -amount)
+    return payable
 
 
 def reject_partner_request(user_id: int):
-    db_exec("""
-        INSERT INTO partner_requests(user_id,username,status,requested_at,decided_at)
-        VALUES(?,?,?,?,?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            status='rejected',
-            decided_at=excluded.decided_at
-    """, (user_id, None, "rejected", datetime.utcnow().isoformat(), datetime.utcnow().isoformat()))
+    REPO.partners.decide_request(user_id, None, "rejected")
 
 
 # ================== ОТЗЫВЫ ==================
-def get_pending_reviews() -> List[sqlite3.Row]:
-    return db_exec("SELECT * FROM reviews WHERE is_approved=0 ORDER BY id ASC", fetchall=True)
+def get_next_pending_review(after_id: int = 0) -> Optional[sqlite3.Row]:
+    """Следующий отзыв в очереди модерации (keyset по id, по кругу)."""
+    row = REPO.reviews.next_pending(after_id)
+    if not row and after_id:
+        row = REPO.reviews.next_pending(0)
+    return row
+
+
+def count_pending_reviews() -> int:
+    return REPO.reviews.count_pending()
+
+
+def get_review(review_id: int) -> Optional[sqlite3.Row]:
+    return REPO.reviews.get(review_id)
 
 
 def get_approved_reviews_all() -> List[sqlite3.Row]:
-    return db_exec("SELECT * FROM reviews WHERE is_approved=1 ORDER BY id DESC", fetchall=True)
+    return REPO.reviews.approved()
 
 
 def approve_review(review_id: int):
-    db_exec("UPDATE reviews SET is_approved=1 WHERE id=?", (review_id,))
+    REPO.reviews.approve(review_id)
 
 
 def reject_review(review_id: int):
-    db_exec("DELETE FROM reviews WHERE id=?", (review_id,))
+    REPO.reviews.delete(review_id)
 
 
 # ================== БАННЕРЫ / ЛОГО ==================
@@ -605,11 +2990,57 @@ def set_banner(section: str, file_id: str):
     set_setting(f"banner_{section}", file_id)
 
 
+# ================== КЭШ РЕНДЕРА ==================
+# Клавиатуры разделов храним уже сериализованными (reply_markup принимает JSON-строку).
+# Ключ — имя функции + её входы; всё сбрасывается при set_setting и изменении каталога.
+RENDER_CACHE_MAX = 2000
+_RENDER_CACHE: Dict[tuple, Optional[str]] = {}
+_RENDER_GEN = [0]
+
+
+def invalidate_render_cache():
+    _RENDER_GEN[0] += 1
+    _RENDER_CACHE.clear()
+
+
+def render_cached(key: Callable = None):
+    """
+    Кэширует результат функции-клавиатуры как JSON. key(*args) — из чего складывается
+    ключ, по умолчанию сами аргументы. None от функции тоже кэшируется.
+    """
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args):
+            k = (fn.__name__, key(*args) if key else args)
+            if k in _RENDER_CACHE:
+                return _RENDER_CACHE[k]
+            gen = _RENDER_GEN[0]
+            markup = fn(*args)
+            value = markup.to_json() if markup is not None else None
+            # пока строили, каталог/настройки могли поменяться — такой результат не запоминаем
+            if gen == _RENDER_GEN[0]:
+                if len(_RENDER_CACHE) >= RENDER_CACHE_MAX:
+                    _RENDER_CACHE.clear()
+                _RENDER_CACHE[k] = value
+            return value
+        return wrapper
+    return deco
+
+
 # ================== UI / КНОПКИ ==================
 def back_btn(data="sec:menu"):
     return types.InlineKeyboardButton("⬅️ Назад", callback_data=data)
 
 
+def webapp_url() -> str:
+    """SHOP_URL + адрес API каталога, если бот его раздаёт."""
+    if not API_PUBLIC_URL:
+        return SHOP_URL
+    sep = "&" if "?" in SHOP_URL else "?"
+    return f"{SHOP_URL}{sep}api={quote(API_PUBLIC_URL, safe='')}"
+
+
+@render_cached(key=lambda user_id: user_id == ADMIN_ID)
 def main_menu(user_id: int):
     kb = types.InlineKeyboardMarkup()
 
@@ -618,7 +3049,7 @@ def main_menu(user_id: int):
         kb.add(
             types.InlineKeyboardButton(
                 "🛍 Открыть каталог",
-                web_app=types.WebAppInfo(url=SHOP_URL)
+                web_app=types.WebAppInfo(url=webapp_url())
             )
         )
 
@@ -650,8 +3081,12 @@ def main_menu(user_id: int):
     return kb
 
 
-def category_kb(cats):
-    """Категории 2 колонки."""
+@render_cached()
+def category_kb():
+    """Категории 2 колонки. None — каталог пуст."""
+    cats = get_categories()
+    if not cats:
+        return None
     kb = types.InlineKeyboardMarkup(row_width=2)
     buttons = [types.InlineKeyboardButton(f"• {c['name']}", callback_data=f"cat:{c['id']}") for c in cats]
     for i in range(0, len(buttons), 2):
@@ -676,12 +3111,16 @@ def product_nav_kb(cat_id: int, idx: int, total: int, prod_id: int):
 
 def size_kb(prod_id: int, sizes: List[str]):
     kb = types.InlineKeyboardMarkup(row_width=5)
+    sizes = in_stock_sizes(prod_id, sizes)
     for s in sizes:
         kb.add(types.InlineKeyboardButton(s, callback_data=f"size:{prod_id}:{s}"))
+    if not sizes:
+        kb.add(types.InlineKeyboardButton("Нет в наличии", callback_data="noop"))
     kb.add(back_btn("sec:catalog"))
     return kb
 
 
+@render_cached()
 def cart_kb():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("✅ Оформить заказ", callback_data="cart:checkout"))
@@ -690,12 +3129,14 @@ def cart_kb():
     return kb
 
 
+@render_cached()
 def favs_kb():
     kb = types.InlineKeyboardMarkup()
     kb.add(back_btn("sec:menu"))
     return kb
 
 
+@render_cached(key=lambda user_id=None: ())
 def profile_kb(user_id: int = None):
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🧾 Мои заказы", callback_data="prof:orders"))
@@ -738,6 +3179,30 @@ def review_pending_kb(review_id: int):
     return kb
 
 
+def review_queue_kb(review_id: int, photo_count: int = 0):
+    kb = types.InlineKeyboardMarkup(row_width=3)
+    kb.add(
+        types.InlineKeyboardButton("✅ Принять", callback_data=f"rvq:app:{review_id}"),
+        types.InlineKeyboardButton("❌ Отклонить", callback_data=f"rvq:rej:{review_id}"),
+        types.InlineKeyboardButton("⏭ Пропустить", callback_data=f"rvq:skip:{review_id}"),
+    )
+    if photo_count > 1:
+        # в карточке помещается только первое фото — остальные присылаем альбомом
+        kb.add(types.InlineKeyboardButton(f"🖼 Все фото ({photo_count})", callback_data=f"rvq:pics:{review_id}"))
+    kb.add(back_btn("sec:admin"))
+    return kb
+
+
+def partner_request_kb(user_id: int):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        types.InlineKeyboardButton("✅ Одобрить", callback_data=f"preq:ok:{user_id}"),
+        types.InlineKeyboardButton("❌ Отклонить", callback_data=f"preq:no:{user_id}")
+    )
+    return kb
+
+
+@render_cached()
 def admin_panel_kb():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("📥 Импорт товара", callback_data="adm:import_hint"))
@@ -748,7 +3213,10 @@ def admin_panel_kb():
     kb.add(types.InlineKeyboardButton("📝 Непринятые отзывы", callback_data="adm:reviews_pending"))
     kb.add(types.InlineKeyboardButton("🗑 Удалить категорию", callback_data="adm:cats_del"))
     kb.add(types.InlineKeyboardButton("📣 Рассылка", callback_data="adm:broadcast"))
+    kb.add(types.InlineKeyboardButton("🤝 Рефералы", callback_data="adm:refs"))
+    kb.add(types.InlineKeyboardButton("💸 Выплаты партнёрам", callback_data="adm:payouts"))
     kb.add(types.InlineKeyboardButton("📊 Статистика", callback_data="adm:stats"))
+    kb.add(types.InlineKeyboardButton("🔬 Профилирование", callback_data="adm:profile"))
     kb.add(back_btn("sec:menu"))
     return kb
 
@@ -789,6 +3257,7 @@ def send_subscribe_gate(chat_id: int):
 USER_REVIEW_INDEX: Dict[int, int] = {}
 
 
+@render_cached()
 def reviews_nav_kb(idx: int, total: int):
     kb = types.InlineKeyboardMarkup(row_width=2)
     prev_data = f"revnav:{idx-1}" if idx > 0 else "noop"
@@ -829,6 +3298,14 @@ def show_review(chat_id: int, user_id: int, idx: int):
 
 
 # ================== SMART SEND ==================
+CAPTION_MAX = 1024  # лимит Telegram на подпись к фото
+
+
+def caption_len(text: str) -> int:
+    """Длина HTML-текста так, как её считает Telegram: без тегов, в UTF-16."""
+    return len(html.unescape(re.sub(r"<[^>]+>", "", text)).encode("utf-16-le")) // 2
+
+
 def smart_send(chat_id: int, text: str, kb=None, origin_msg: types.Message = None, photo_id: str = None):
     try:
         if origin_msg and origin_msg.message_id:
@@ -1026,14 +3503,699 @@ def admin_import_product(message: types.Message):
     _finalize_admin_import(message.chat.id, caption, photos)
 
 
+# ================== МАССОВЫЙ ИМПОРТ ИЗ ЭКСПОРТА КАНАЛА ==================
+_JSON_DECODER = json.JSONDecoder()
+
+
+def iter_json_array(fp, key: str = "messages", chunk_size: int = 1 << 16):
+    """Потоково отдаёт элементы массива `key` (или массива верхнего уровня), не читая файл целиком."""
+    buf = ""
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buf, eof
+        if eof:
+            return False
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buf += chunk
+        return True
+
+    # ищем начало массива
+    key_re = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    pos = None
+    while pos is None:
+        stripped = buf.lstrip()
+        if stripped.startswith("["):
+            pos = len(buf) - len(stripped) + 1
+            break
+        m = key_re.search(buf)
+        if m:
+            pos = m.end()
+            break
+        if not fill():
+            return
+
+    buf = buf[pos:]
+    while True:
+        # пропускаем разделители между элементами
+        i = 0
+        while True:
+            while i < len(buf) and buf[i] in " \t\r\n,":
+                i += 1
+            if i < len(buf) or not fill():
+                break
+        buf = buf[i:]
+        if not buf or buf[0] == "]":
+            return
+
+        try:
+            item, end = _JSON_DECODER.raw_decode(buf)
+        except json.JSONDecodeError:
+            if not fill():
+                raise
+            continue
+        yield item
+        buf = buf[end:]
+
+
+def iter_export_posts(path: str):
+    """Посты из Telegram Desktop result.json или JSONL (по посту на строку)."""
+    with open(path, "r", encoding="utf-8") as fp:
+        if path.lower().endswith(".jsonl"):
+            for line in fp:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(fp)
+
+
+def _export_text(raw) -> str:
+    """text в экспорте — строка или список кусков со сущностями."""
+    if isinstance(raw, str):
+        return raw
+    if isinstance(raw, list):
+        return "".join(part if isinstance(part, str) else str(part.get("text", "")) for part in raw)
+    return ""
+
+
+def _normalize_export_post(raw: Dict) -> Optional[Dict]:
+    if raw.get("type", "message") != "message":
+        return None
+
+    photos: List[str] = []
+    for ref in (raw.get("photos") or []):
+        photos.append(str(ref))
+    photo = raw.get("photo")
+    if isinstance(photo, list) and photo:
+        photos.append(photo[-1]["file_id"])  # Bot API: размеры фото, последний — самый большой
+    elif isinstance(photo, str):
+        photos.append(photo)  # Telegram Desktop: путь к файлу рядом с result.json
+
+    return {
+        "id": str(raw.get("id") or raw.get("message_id") or ""),
+        "date": str(raw.get("date") or ""),
+        "group": raw.get("media_group_id"),
+        "text": _export_text(raw.get("text") or raw.get("caption") or ""),
+        "photos": photos,
+    }
+
+
+def iter_export_products(path: str):
+    """Склеивает части альбомов: по media_group_id, а в экспорте Desktop — соседние посты с одной датой."""
+    current = None
+    current_key = None
+    for raw in iter_export_posts(path):
+        post = _normalize_export_post(raw)
+        if not post:
+            continue
+        key = ("mg", post["group"]) if post["group"] else ("date", post["date"])
+        if current and key == current_key and (post["group"] or not (current["text"] and post["text"])):
+            current["photos"].extend(post["photos"])
+            if post["text"] and not current["text"]:
+                current["text"] = post["text"]
+            continue
+        if current:
+            yield current
+        current, current_key = post, key
+    if current:
+        yield current
+
+
+def _import_content_hash(text: str, photos: List[str]) -> str:
+    norm = re.sub(r"\s+", " ", text).strip().lower()
+    return hashlib.sha1((norm + "|" + "|".join(photos)).encode("utf-8")).hexdigest()
+
+
+def _upload_local_photo(path: str) -> str:
+    """Фото из экспорта Desktop — это файлы; чтобы получить file_id, один раз грузим их админу."""
+    with open(path, "rb") as f:
+        m = bot.send_photo(ADMIN_ID, f, disable_notification=True)
+    try:
+        bot.delete_message(ADMIN_ID, m.message_id)
+    except:
+        pass
+    return m.photo[-1].file_id
+
+
+def _resolve_import_photo(ref: str, base_dir: str, dry_run: bool) -> str:
+    local = os.path.join(base_dir, ref)
+    if os.path.isfile(local):
+        return local if dry_run else _upload_local_photo(local)
+    if "/" in ref or "." in ref:
+        # в file_id не бывает ни слэшей, ни точек — значит, это путь к файлу, которого нет
+        raise FileNotFoundError(f"нет файла {ref}")
+    return ref
+
+
+def import_channel_export(path: str, dry_run: bool = False) -> Dict:
+    """Массовый импорт товаров из экспорта канала. Возвращает отчёт."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    report = {"posts": 0, "imported": 0, "duplicates": 0, "failures": [], "missing_media": []}
+    seen = set()
+    batch: List[Tuple] = []
+
+    def flush():
+        if dry_run or not batch:
+            batch.clear()
+            return
+        with db_tx():
+            for args, source_key, content_hash in batch:
+                create_product(*args, source_key=source_key, content_hash=content_hash)
+        batch.clear()
+
+    for post in iter_export_products(path):
+        report["posts"] += 1
+        caption = post["text"].strip()
+        if not caption:
+            report["failures"].append((post["id"], "нет текста"))
+            continue
+
+        cat, title, description, price, is_pre = parse_post_to_product(caption)
+        if price <= 0:
+            report["failures"].append((post["id"], f"нет цены: {title[:40]}"))
+            continue
+
+        source_key = f"post:{post['id']}" if post["id"] else None
+        content_hash = _import_content_hash(caption, post["photos"])
+        dup = source_key in seen or content_hash in seen or db_exec(
+            "SELECT id FROM products WHERE source_key=? OR content_hash=? LIMIT 1",
+            (source_key, content_hash), fetchone=True
+        )
+        if dup:
+            report["duplicates"] += 1
+            continue
+        seen.update(k for k in (source_key, content_hash) if k)
+
+        try:
+            photos = [_resolve_import_photo(ref, base_dir, dry_run) for ref in post["photos"][:10]]
+        except FileNotFoundError:
+            # JSON прислали без папки экспорта: пост не битый, просто фото не здесь
+            seen.difference_update((source_key, content_hash))
+            report["missing_media"].append(post["id"])
+            continue
+        except Exception as e:
+            report["failures"].append((post["id"], f"фото: {e}"))
+            continue
+
+        batch.append(((cat, title, description, price, photos, is_pre), source_key, content_hash))
+        report["imported"] += 1
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+
+    flush()
+    return report
+
+
+def format_import_report(report: Dict, dry_run: bool, max_failures: int = 20) -> str:
+    text = (
+        f"{'🧪 Пробный прогон' if dry_run else '📥 Импорт завершён'}\n\n"
+        f"Постов: {report['posts']}\n"
+        f"{'Будет импортировано' if dry_run else 'Импортировано'}: {report['imported']}\n"
+        f"Дубликатов: {report['duplicates']}\n"
+        f"Ошибок разбора: {len(report['failures'])}\n"
+    )
+    missing = report.get("missing_media") or []
+    if missing:
+        text += (
+            f"Пропущено — нет файлов фото: {len(missing)} "
+            f"(посты {', '.join(missing[:10])}{'…' if len(missing) > 10 else ''})\n"
+            f"{IMPORT_CLI_HINT}\n"
+        )
+    for post_id, reason in report["failures"][:max_failures]:
+        text += f"• пост {post_id}: {reason}\n"
+    if len(report["failures"]) > max_failures:
+        text += f"… и ещё {len(report['failures']) - max_failures}\n"
+    return text
+
+
+@bot.message_handler(commands=["import_export"])
+def cmd_import_export(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    msg = bot.reply_to(
+        message,
+        "Пришли документом result.json из экспорта Telegram Desktop или .jsonl с постами.\n"
+        "Напиши в подписи <code>dry</code>, чтобы только проверить без записи."
+    )
+    bot.register_next_step_handler(msg, _admin_import_export_file)
+
+
+def _admin_import_export_file(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not message.document:
+        bot.reply_to(message, "Это не файл.")
+        return
+
+    if (message.document.file_size or 0) > BOT_DOWNLOAD_MAX:
+        bot.reply_to(message, f"Файл больше {BOT_DOWNLOAD_MAX // 1024 // 1024} МБ — бот его не скачает.\n"
+                              f"{IMPORT_CLI_HINT}")
+        return
+
+    dry_run = "dry" in (message.caption or "").lower()
+    suffix = ".jsonl" if (message.document.file_name or "").lower().endswith(".jsonl") else ".json"
+    file_info = bot.get_file(message.document.file_id)
+    with tempfile.NamedTemporaryFile("wb", suffix=suffix, delete=False) as tmp:
+        tmp.write(bot.download_file(file_info.file_path))
+    try:
+        report = import_channel_export(tmp.name, dry_run=dry_run)
+    except Exception as e:
+        bot.reply_to(message, f"Не смог разобрать файл: {e}")
+        return
+    finally:
+        os.remove(tmp.name)
+    bot.reply_to(message, format_import_report(report, dry_run))
+
+
+# ================== МЕДИА И КАТАЛОГ ДЛЯ WEBAPP ==================
+def _write_file_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def process_media_file(file_id: str) -> Dict[str, str]:
+    """Скачивает файл один раз, кладёт оригинал по sha256 и делает webp-превью."""
+    info = bot.get_file(file_id)
+    data = bot.download_file(info.file_path)
+    sha = hashlib.sha256(data).hexdigest()
+    ext = os.path.splitext(info.file_path or "")[1].lower() or ".jpg"
+
+    paths = {"orig_path": f"media/orig/{sha[:2]}/{sha}{ext}"}
+    orig_abs = os.path.join(WEBAPP_DIR, paths["orig_path"])
+    if not os.path.exists(orig_abs):
+        _write_file_atomic(orig_abs, data)
+
+    for name, size in MEDIA_THUMB_SIZES.items():
+        if Image is None:
+            paths[f"{name}_path"] = paths["orig_path"]
+            continue
+        rel = f"media/{sha[:2]}/{sha}_{name}.webp"
+        abs_path = os.path.join(WEBAPP_DIR, rel)
+        if not os.path.exists(abs_path):
+            im = Image.open(BytesIO(data))
+            im.thumbnail((size, size))
+            out = BytesIO()
+            im.convert("RGB").save(out, "WEBP", quality=80, method=4)
+            _write_file_atomic(abs_path, out.getvalue())
+        paths[f"{name}_path"] = rel
+
+    db_exec(
+        """
+        INSERT INTO media_files(file_id,sha256,orig_path,grid_path,detail_path,status,error,updated_at)
+        VALUES(?,?,?,?,?,'ok',NULL,?)
+        ON CONFLICT(file_id) DO UPDATE SET
+            sha256=excluded.sha256, orig_path=excluded.orig_path, grid_path=excluded.grid_path,
+            detail_path=excluded.detail_path, status='ok', error=NULL, updated_at=excluded.updated_at
+        """,
+        (file_id, sha, paths["orig_path"], paths["grid_path"], paths["detail_path"],
+         datetime.utcnow().isoformat()),
+    )
+    return paths
+
+
+def _product_file_ids() -> List[str]:
+    seen: Dict[str, None] = {}
+    for p in db_exec("SELECT photos_json FROM products", fetchall=True):
+        for fid in (json.loads(p["photos_json"]) if p["photos_json"] else []):
+            seen.setdefault(fid, None)
+    return list(seen)
+
+
+def sync_media() -> Dict[str, int]:
+    """Обрабатывает только новые file_id — на ограниченном пуле потоков."""
+    done = {r["file_id"] for r in db_exec("SELECT file_id FROM media_files WHERE status='ok'", fetchall=True)}
+    todo = [fid for fid in _product_file_ids() if fid not in done]
+    report = {"new": len(todo), "ok": 0, "failed": 0}
+    if not todo:
+        return report
+    ready = set()
+
+    with ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media") as pool:
+        futures = {fid: pool.submit(process_media_file, fid) for fid in todo}
+        for fid, fut in futures.items():
+            try:
+                fut.result()
+                report["ok"] += 1
+                ready.add(fid)
+            except Exception as e:
+                report["failed"] += 1
+                db_exec(
+                    "INSERT INTO media_files(file_id,status,error,updated_at) VALUES(?,'failed',?,?) "
+                    "ON CONFLICT(file_id) DO UPDATE SET status='failed', error=excluded.error, "
+                    "updated_at=excluded.updated_at",
+                    (fid, str(e)[:300], datetime.utcnow().isoformat()),
+                )
+    if ready:
+        touch_products_with_files(ready)
+    return report
+
+
+def touch_products_with_files(file_ids: set):
+    """Товары, у которых появились превью, попадут в /api/changes."""
+    ids = [
+        p["id"] for p in db_exec("SELECT id, photos_json FROM products", fetchall=True)
+        if file_ids.intersection(json.loads(p["photos_json"]) if p["photos_json"] else [])
+    ]
+    if not ids:
+        return
+    with db_tx():
+        ver = bump_catalog_version()
+        q_marks = ",".join(["?"] * len(ids))
+        db_exec(f"UPDATE products SET version=? WHERE id IN ({q_marks})", (ver, *ids))
+
+
+WEBAPP_PRODUCT_SQL = """
+    SELECT p.*, c.name AS category
+    FROM products p LEFT JOIN categories c ON c.id=p.category_id
+"""
+
+
+def media_url(rel_path: str) -> str:
+    """Файлы медиа раздаёт API бота (статический сайт их не получает) — в каталог идут полные адреса."""
+    return f"{API_PUBLIC_URL}/{rel_path}" if API_PUBLIC_URL else rel_path
+
+
+def webapp_products(rows: List[sqlite3.Row]) -> List[Dict]:
+    """Строки products (+category) → карточки WebApp. Медиа подтягиваются только для этих строк."""
+    file_ids = {}
+    for p in rows:
+        for fid in (json.loads(p["photos_json"]) if p["photos_json"] else []):
+            file_ids.setdefault(fid, None)
+    media = {}
+    fids = list(file_ids)
+    for i in range(0, len(fids), 500):
+        chunk = fids[i:i + 500]
+        q_marks = ",".join(["?"] * len(chunk))
+        for r in db_exec(
+            f"SELECT * FROM media_files WHERE status='ok' AND file_id IN ({q_marks})",
+            tuple(chunk), fetchall=True
+        ):
+            media[r["file_id"]] = r
+
+    stock = get_stock_map([p["id"] for p in rows])
+    out = []
+    for p in rows:
+        sizes = in_stock_sizes(p["id"], extract_sizes_from_text(p["description"] or ""), stock)
+        ready = [media[fid] for fid in (json.loads(p["photos_json"]) if p["photos_json"] else []) if fid in media]
+        out.append({
+            "id": p["id"],
+            "category_id": p["category_id"],
+            "title": p["title"],
+            "description": p["description"] or "",
+            "price": p["price"],
+            "category": p["category"] or "Разное",
+            "is_preorder": bool(p["is_preorder"]),
+            "sizes": sizes,
+            "sold_out": not sizes,
+            "photos": [media_url(m["detail_path"]) for m in ready],
+            "thumbs": [media_url(m["grid_path"]) for m in ready],
+        })
+    return out
+
+
+def build_webapp_catalog() -> List[Dict]:
+    return webapp_products(db_exec(WEBAPP_PRODUCT_SQL + " ORDER BY p.id DESC", fetchall=True))
+
+
+def export_webapp_catalog() -> int:
+    catalog = build_webapp_catalog()
+    data = json.dumps(catalog, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    _write_file_atomic(os.path.join(WEBAPP_DIR, "products.json"), data)
+    return len(catalog)
+
+
+@background_job(MEDIA_SYNC_INTERVAL)
+def publish_webapp_catalog():
+    report = sync_media()
+    count = export_webapp_catalog()
+    if report["new"]:
+        print(f"media sync: {report}, catalog: {count} products")
+
+
+# ================== HTTP API КАТАЛОГА ==================
+# Каталог — только чтение. Всё, что отдаёт API, однозначно задаётся версией каталога и строкой запроса,
+# поэтому ETag = версия + хэш запроса, и 304 отвечаем ещё до похода за товарами.
+def api_catalog(params: Dict[str, str]) -> Dict:
+    cats = db_exec(
+        """
+        SELECT c.id, c.name, COUNT(p.id) AS cnt
+        FROM categories c LEFT JOIN products p ON p.category_id=c.id
+        GROUP BY c.id ORDER BY c.name
+        """,
+        fetchall=True
+    )
+    return {"categories": [{"id": c["id"], "name": c["name"], "count": c["cnt"]} for c in cats]}
+
+
+def api_products(params: Dict[str, str]) -> Dict:
+    """Страница товаров (новые сверху), курсор — id последнего товара страницы."""
+    limit = max(1, min(int(params.get("limit") or API_PAGE_SIZE), API_PAGE_MAX))
+    where, args = [], []
+    if params.get("category"):
+        where.append("p.category_id=?")
+        args.append(int(params["category"]))
+    if params.get("cursor"):
+        where.append("p.id<?")
+        args.append(int(params["cursor"]))
+    sql = WEBAPP_PRODUCT_SQL
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    rows = db_exec(sql + " ORDER BY p.id DESC LIMIT ?", (*args, limit + 1), fetchall=True)
+    items = webapp_products(rows[:limit])
+    next_cursor = items[-1]["id"] if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def api_changes(params: Dict[str, str]) -> Dict:
+    """Что поменялось после версии since: изменённые товары целиком и id удалённых."""
+    since = int(params.get("since") or 0)
+    rows = db_exec(WEBAPP_PRODUCT_SQL + " WHERE p.version>? ORDER BY p.id DESC", (since,), fetchall=True)
+    deleted = db_exec("SELECT product_id FROM catalog_tombstones WHERE version>?", (since,), fetchall=True)
+    return {
+        "since": since,
+        "items": webapp_products(rows),
+        "deleted": [r["product_id"] for r in deleted],
+    }
+
+
+API_ROUTES: Dict[str, Callable[[Dict[str, str]], Dict]] = {
+    "/api/catalog": api_catalog,
+    "/api/products": api_products,
+    "/api/changes": api_changes,
+}
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def verify_webapp_init_data(init_data: str) -> Dict:
+    """Проверка подписи Telegram.WebApp.initData. Возвращает user из неё."""
+    fields = {k: v[-1] for k, v in parse_qs(init_data or "", keep_blank_values=True).items()}
+    received = fields.pop("hash", "")
+    check = "\n".join(f"{k}={fields[k]}" for k in sorted(fields))
+    secret = hmac.new(b"WebAppData", TOKEN.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    if not received or not hmac.compare_digest(expected, received):
+        raise ApiError(401, "bad init data")
+    if time.time() - int(fields.get("auth_date") or 0) > WEBAPP_AUTH_TTL:
+        raise ApiError(401, "init data expired")
+    try:
+        return json.loads(fields["user"])
+    except (KeyError, ValueError):
+        raise ApiError(401, "no user")
+
+
+def cart_payload(user_id: int) -> Dict:
+    items = [
+        {
+            "id": i["product_id"],
+            "size": i["size"],
+            "qty": i["qty"],
+            "title": i["title"],
+            "price": i["price"],
+        }
+        for i in get_cart(user_id)
+    ]
+    return {"items": items, "total": sum(i["price"] * i["qty"] for i in items)}
+
+
+def api_cart_sync(body: Dict) -> Dict:
+    """
+    {init_data, version, batch_id, ops:[...]} → версия корзины и, если она ушла
+    от клиентской, вся корзина с ценами сервера.
+    """
+    user = verify_webapp_init_data(body.get("init_data"))
+    user_id = int(user["id"])
+    ops = body.get("ops") or []
+    if (not isinstance(ops, list) or len(ops) > CART_SYNC_MAX_OPS
+            or not all(isinstance(op, dict) for op in ops)):
+        raise ApiError(400, "bad ops")
+
+    result = {"applied": 0, "rejected": []}
+    if ops:
+        result = apply_cart_ops(user_id, ops, batch_id=str(body.get("batch_id") or "")[:64] or None)
+    version = get_cart_version(user_id)
+    result["version"] = version
+    if ops or version != body.get("version"):
+        result["cart"] = cart_payload(user_id)
+    return result
+
+
+API_POST_ROUTES: Dict[str, Callable[[Dict], Dict]] = {
+    "/api/cart/sync": api_cart_sync,
+}
+
+# файлы из WEBAPP_DIR: медиа лежат по sha256 и не меняются, products.json — всегда перепроверять
+API_FILE_CACHE = {"/media/": "public, max-age=31536000, immutable", "/products.json": "no-cache"}
+API_FILE_TYPES = {".webp": "image/webp", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+                  ".json": "application/json; charset=utf-8"}
+
+
+def _etag_matches(header: Optional[str], tag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for cand in header.split(","):
+        cand = cand.strip()
+        if cand.startswith("W/"):
+            cand = cand[2:]
+        # сжатый вариант отличается суффиксом -gz, но версия та же
+        if cand.replace("-gz\"", "\"") == tag:
+            return True
+    return False
+
+
+class CatalogApiHandler(BaseHTTPRequestHandler):
+    server_version = "InkoCatalog/1"
+
+    def _cors(self):
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Headers", "If-None-Match, Content-Type")
+        self.send_header("Access-Control-Expose-Headers", "ETag, X-Catalog-Version")
+
+    def _send_json(self, code: int, payload: Dict, etag: Optional[str] = None, version: Optional[int] = None):
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        gz = len(body) >= API_GZIP_MIN and "gzip" in (self.headers.get("Accept-Encoding") or "")
+        if gz:
+            body = gzip.compress(body, compresslevel=5)
+        self.send_response(code)
+        self._cors()
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Vary", "Accept-Encoding")
+        if etag:
+            self.send_header("ETag", etag[:-1] + "-gz\"" if gz else etag)
+            self.send_header("Cache-Control", "no-cache")
+        if version is not None:
+            self.send_header("X-Catalog-Version", str(version))
+        if gz:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._cors()
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Max-Age", "86400")
+        self.end_headers()
+
+    def _send_file(self, url_path: str) -> bool:
+        cache = API_FILE_CACHE.get("/media/" if url_path.startswith("/media/") else url_path)
+        if cache is None:
+            return False
+        root = os.path.realpath(os.path.join(WEBAPP_DIR, "media" if url_path.startswith("/media/") else ""))
+        path = os.path.realpath(os.path.join(WEBAPP_DIR, url_path.lstrip("/")))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            self._send_json(404, {"error": "not found"})
+            return True
+        with open(path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self._cors()
+        ctype = API_FILE_TYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+        self.send_header("Content-Type", ctype)
+        self.send_header("Cache-Control", cache)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = API_ROUTES.get(url.path.rstrip("/"))
+        if not route:
+            if self._send_file(url.path):
+                return
+            return self._send_json(404, {"error": "not found"})
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        version = get_catalog_version()
+        etag = '"%d-%s"' % (version, hashlib.sha1(url.query.encode()).hexdigest()[:12])
+        if _etag_matches(self.headers.get("If-None-Match"), etag):
+            self.send_response(304)
+            self._cors()
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+
+        try:
+            payload = route(params)
+        except ValueError:
+            return self._send_json(400, {"error": "bad params"})
+        payload["version"] = version
+        self._send_json(200, payload, etag=etag, version=version)
+
+    def do_POST(self):
+        route = API_POST_ROUTES.get(urlsplit(self.path).path.rstrip("/"))
+        if not route:
+            return self._send_json(404, {"error": "not found"})
+        try:
+            size = int(self.headers.get("Content-Length") or 0)
+            if size > API_MAX_BODY:
+                raise ApiError(413, "too large")
+            try:
+                body = json.loads(self.rfile.read(size) or b"{}")
+            except ValueError:
+                raise ApiError(400, "bad json")
+            if not isinstance(body, dict):
+                raise ApiError(400, "bad json")
+            self._send_json(200, route(body))
+        except ApiError as e:
+            self._send_json(e.code, {"error": str(e)})
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_catalog_api(port: int = None) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("0.0.0.0", port if port is not None else API_PORT), CatalogApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="catalog-api", daemon=True).start()
+    return server
+
+
 # ================== РАЗДЕЛЫ ==================
 def open_catalog(chat_id: int):
-    cats = get_categories()
-    if not cats:
+    kb = category_kb()
+    if not kb:
         send_section_banner(chat_id, "catalog", "Каталог пуст.",
                             types.InlineKeyboardMarkup().add(back_btn("sec:menu")))
         return
-    send_section_banner(chat_id, "catalog", "<b>Категории:</b>", category_kb(cats))
+    send_section_banner(chat_id, "catalog", "<b>Категории:</b>", kb)
 
 
 USER_CAT_INDEX: Dict[Tuple[int, int], int] = {}
@@ -1157,6 +4319,121 @@ def open_profile(chat_id: int, user_id: int, origin_msg: types.Message = None):
     send_section_banner(chat_id, "profile", "<b>Профиль</b>\nВыбери раздел:", profile_kb(user_id), origin_msg=origin_msg)
 
 
+def _profile_back_kb():
+    return types.InlineKeyboardMarkup().add(back_btn("sec:profile"))
+
+
+def open_profile_orders(chat_id: int, user_id: int, before_id: Optional[int] = None,
+                        origin_msg: types.Message = None):
+    orders, next_cursor = get_user_orders_page(user_id, before_id)
+    if not orders:
+        send_section_banner(chat_id, "profile", "Заказов пока нет 🧾", _profile_back_kb(), origin_msg=origin_msg)
+        return
+
+    blocks = []
+    for o in orders:
+        lines = [f"<b>#{o['id']}</b> · {(o['created_at'] or '')[:10]} · <i>{o['status']}</i>"]
+        for it in o["items"][:3]:
+            lines.append(f"• {it['title'] or 'Товар удалён'} — {it['qty']} шт., {it['size']}")
+        if len(o["items"]) > 3:
+            lines.append(f"• … и ещё {len(o['items']) - 3}")
+        final = o["final_total"] or o["total"]
+        if o["discount_percent"]:
+            lines.append(f"Итого: <b>{final}{CURRENCY}</b> (−{o['discount_percent']}%, {o['promo_code']})")
+        else:
+            lines.append(f"Итого: <b>{final}{CURRENCY}</b>")
+        blocks.append("\n".join(lines))
+
+    header = "<b>🧾 Мои заказы</b>\n\n"
+    banner = get_banner("profile")
+    if banner:
+        # страница уйдёт подписью к баннеру: что не влезло в лимит — на следующую страницу
+        while len(blocks) > 1 and caption_len(header + "\n\n".join(blocks)) > CAPTION_MAX:
+            blocks.pop()
+            next_cursor = orders[len(blocks) - 1]["id"]
+    text = header + "\n\n".join(blocks)
+
+    kb = types.InlineKeyboardMarkup()
+    if next_cursor:
+        kb.add(types.InlineKeyboardButton("Ещё ➡️", callback_data=f"prof:orders:{next_cursor}"))
+    kb.add(back_btn("sec:profile"))
+    if banner and caption_len(text) > CAPTION_MAX:
+        # даже один заказ не влез в подпись — показываем текстом, без баннера
+        if origin_msg and origin_msg.photo:
+            try:
+                bot.delete_message(chat_id, origin_msg.message_id)
+            except:
+                pass
+            origin_msg = None
+        smart_send(chat_id, text, kb, origin_msg=origin_msg)
+        return
+    send_section_banner(chat_id, "profile", text, kb, origin_msg=origin_msg)
+
+
+def open_profile_promos(chat_id: int, user_id: int, origin_msg: types.Message = None):
+    percent, code = get_user_promo(user_id)
+    partner = get_partner(user_id)
+    lines = ["<b>🏷 Мои промокоды</b>\n"]
+    if code:
+        lines.append(f"Активный: <code>{code}</code> — скидка <b>{percent}%</b>")
+    else:
+        lines.append("Активного промокода нет. Ввести можно в меню «Промокод».")
+    if partner and partner["is_active"]:
+        lines.append(f"Партнёрский: <code>{partner['code']}</code> — для друзей −{partner['discount_percent']}%")
+    send_section_banner(chat_id, "profile", "\n".join(lines), _profile_back_kb(), origin_msg=origin_msg)
+
+
+def open_profile_refs(chat_id: int, user_id: int, origin_msg: types.Message = None):
+    row = REPO.users.get(user_id)
+    invited = int(row["ref_count"] or 0) if row else 0
+    converted = int(row["ref_converted"] or 0) if row else 0
+    text = (
+        "<b>🤝 Реферальная система</b>\n\n"
+        f"Твоя ссылка:\n<code>https://t.me/{bot.user.username}?start={user_id}</code>\n\n"
+        f"Приглашено: <b>{invited}</b> из {REFERRAL_CAP}\n"
+        f"Сделали заказ: <b>{converted}</b>"
+    )
+    send_section_banner(chat_id, "profile", text, _profile_back_kb(), origin_msg=origin_msg)
+
+
+def open_profile_partner(chat_id: int, user_id: int, origin_msg: types.Message = None):
+    partner = get_partner(user_id)
+    if not partner or not partner["is_active"]:
+        req = REPO.partners.request(user_id)
+        kb = types.InlineKeyboardMarkup()
+        if req and req["status"] == "pending":
+            text = "<b>🤝 Партнёрская программа</b>\n\nЗаявка отправлена, админ скоро ответит ⏳"
+        else:
+            text = (
+                "<b>🤝 Партнёрская программа</b>\n\n"
+                "Получи личный промокод: друзья получают скидку, "
+                "а ты — процент с каждой подтверждённой покупки."
+            )
+            kb.add(types.InlineKeyboardButton("📨 Подать заявку", callback_data="prof:partner_req"))
+        kb.add(back_btn("sec:profile"))
+        send_section_banner(chat_id, "profile", text, kb, origin_msg=origin_msg)
+        return
+
+    bal = get_partner_balance(user_id)
+    text = (
+        "<b>🤝 Партнёрский промокод</b>\n\n"
+        f"Код: <code>{partner['code']}</code>\n"
+        f"Скидка для друзей: <b>{partner['discount_percent']}%</b>\n"
+        f"Твоя комиссия: <b>{partner['commission_percent']}%</b>\n\n"
+        f"Подтверждённых покупок: <b>{bal['confirmed_uses']}</b>\n"
+        f"Продажи: <b>{bal['total_sales']}{CURRENCY}</b>\n"
+        f"Заработано: <b>{bal['total_earned']}{CURRENCY}</b>\n"
+        f"Выплачено: <b>{bal['total_paid']}{CURRENCY}</b>\n"
+        f"Баланс: <b>{bal['balance']}{CURRENCY}</b>"
+    )
+    send_section_banner(chat_id, "profile", text, _profile_back_kb(), origin_msg=origin_msg)
+
+
+def submit_partner_request(user_id: int, username: Optional[str]) -> bool:
+    """Новая заявка в партнёры. False — заявка уже ждёт решения."""
+    return REPO.partners.submit_request(user_id, username)
+
+
 def open_reviews(chat_id: int, user_id: int):
     show_review(chat_id, user_id, 0)
 
@@ -1213,13 +4490,77 @@ def open_admin_panel(chat_id: int, user_id: int, origin_msg: types.Message = Non
     send_section_banner(chat_id, "admin", "<b>Админ-панель</b>", admin_panel_kb(), origin_msg=origin_msg)
 
 
+# ================== РОУТЕР CALLBACK ==================
+# Один callback_query_handler на всё: callback_data разбирается один раз и уходит
+# в обработчик через словарь. Ключ — "prefix" или "prefix:action" (adm:cat_del),
+# остаток строки режется по ":" и приводится к типам из декоратора.
+# Двухуровневый ключ проверяется первым, поэтому adm:cats_del и adm:cat_del:5
+# не пересекаются. Стоимость маршрутизации — два поиска в словаре.
+class BadCallback(ValueError):
+    pass
+
+
+CALLBACK_ROUTES: Dict[str, Tuple[Callable, Tuple[type, ...], int, bool]] = {}
+
+
+def callback_route(route: str, *arg_types: type, required: Optional[int] = None, admin: bool = False):
+    """Последний str-аргумент забирает хвост целиком (в нём может быть ":")."""
+    def deco(fn):
+        assert route not in CALLBACK_ROUTES, route
+        need = len(arg_types) if required is None else required
+        CALLBACK_ROUTES[route] = (fn, arg_types, need, admin)
+        return fn
+    return deco
+
+
+def parse_callback(data: str) -> Tuple[Tuple[Callable, Tuple[type, ...], int, bool], tuple]:
+    head, _, rest = data.partition(":")
+    route = None
+    if rest:
+        action, _, tail = rest.partition(":")
+        route = CALLBACK_ROUTES.get(f"{head}:{action}")
+        if route:
+            rest = tail
+    if route is None:
+        route = CALLBACK_ROUTES.get(head)
+    if route is None:
+        raise BadCallback("unknown route")
+
+    _, arg_types, need, _ = route
+    parts = rest.split(":", len(arg_types) - 1) if rest and arg_types else ([rest] if rest else [])
+    if not need <= len(parts) <= len(arg_types):
+        raise BadCallback(f"expected {len(arg_types)} args, got {len(parts)}")
+    try:
+        args = tuple(t(p) for t, p in zip(arg_types, parts))
+    except ValueError:
+        raise BadCallback("bad arg type")
+    if any(a == "" for a in args):
+        raise BadCallback("empty arg")
+    return route, args
+
+
+@bot.callback_query_handler(func=lambda c: True)
+def cb_router(c: types.CallbackQuery):
+    try:
+        (fn, _, _, admin), args = parse_callback(c.data or "")
+    except BadCallback as e:
+        # старые кнопки из истории чата или подделанный callback_data
+        print(f"bad callback {c.data!r}: {e}")
+        bot.answer_callback_query(c.id, "Кнопка устарела, открой меню заново.")
+        return
+    if admin and c.from_user.id != ADMIN_ID:
+        bot.answer_callback_query(c.id, "Нет доступа.")
+        return
+    fn(c, *args)
+
+
 # ================== CALLBACKS ==================
-@bot.callback_query_handler(func=lambda c: c.data == "noop")
+@callback_route("noop")
 def cb_noop(c: types.CallbackQuery):
     bot.answer_callback_query(c.id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "sub:check")
+@callback_route("sub:check")
 def cb_sub_check(c: types.CallbackQuery):
     uid = c.from_user.id
     bot.answer_callback_query(c.id)
@@ -1236,9 +4577,8 @@ def cb_sub_check(c: types.CallbackQuery):
     bot.send_message(c.message.chat.id, "✅ Спасибо за подписку! Вот меню:", reply_markup=main_menu(uid))
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("sec:"))
-def cb_section(c: types.CallbackQuery):
-    sec = c.data.split(":", 1)[1]
+@callback_route("sec", str)
+def cb_section(c: types.CallbackQuery, sec: str):
     uid = c.from_user.id
     bot.answer_callback_query(c.id)
 
@@ -1252,7 +4592,7 @@ def cb_section(c: types.CallbackQuery):
             kb.add(
                 types.InlineKeyboardButton(
                     "🛍 Открыть каталог",
-                    web_app=types.WebAppInfo(url=SHOP_URL)
+                    web_app=types.WebAppInfo(url=webapp_url())
                 )
             )
             smart_send(
@@ -1290,7 +4630,50 @@ def cb_section(c: types.CallbackQuery):
         bot.register_next_step_handler(msg, search_products)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "promo:clear")
+@callback_route("prof:partner_req")
+def cb_profile_partner_req(c: types.CallbackQuery):
+    uid = c.from_user.id
+    if submit_partner_request(uid, c.from_user.username):
+        bot.answer_callback_query(c.id, "Заявка отправлена ✅")
+        try:
+            who = f"@{c.from_user.username} " if c.from_user.username else ""
+            bot.send_message(
+                ADMIN_ID,
+                f"🤝 Заявка в партнёры от {who}(<code>{uid}</code>)",
+                reply_markup=partner_request_kb(uid)
+            )
+        except Exception as e:
+            print("partner request notify fail:", e)
+    else:
+        bot.answer_callback_query(c.id, "Заявка уже на рассмотрении.")
+    open_profile_partner(c.message.chat.id, uid, origin_msg=c.message)
+
+
+@callback_route("prof:orders", int, required=0)
+def cb_profile_orders(c: types.CallbackQuery, before_id: Optional[int] = None):
+    bot.answer_callback_query(c.id)
+    open_profile_orders(c.message.chat.id, c.from_user.id, before_id, origin_msg=c.message)
+
+
+@callback_route("prof:promos")
+def cb_profile_promos(c: types.CallbackQuery):
+    bot.answer_callback_query(c.id)
+    open_profile_promos(c.message.chat.id, c.from_user.id, origin_msg=c.message)
+
+
+@callback_route("prof:refs")
+def cb_profile_refs(c: types.CallbackQuery):
+    bot.answer_callback_query(c.id)
+    open_profile_refs(c.message.chat.id, c.from_user.id, origin_msg=c.message)
+
+
+@callback_route("prof:partner")
+def cb_profile_partner(c: types.CallbackQuery):
+    bot.answer_callback_query(c.id)
+    open_profile_partner(c.message.chat.id, c.from_user.id, origin_msg=c.message)
+
+
+@callback_route("promo:clear")
 def cb_promo_clear(c: types.CallbackQuery):
     uid = c.from_user.id
     clear_user_promo(uid)
@@ -1314,47 +4697,38 @@ def handle_user_promo_input(message: types.Message, user_id: int):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("cat:"))
-def cb_open_category(c: types.CallbackQuery):
-    cat_id = int(c.data.split(":", 1)[1])
+@callback_route("cat", int)
+def cb_open_category(c: types.CallbackQuery, cat_id: int):
     uid = c.from_user.id
     bot.answer_callback_query(c.id)
     show_product(c.message.chat.id, uid, cat_id, 0)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("pnav:"))
-def cb_product_nav(c: types.CallbackQuery):
-    _, cat_id, idx = c.data.split(":")
-    cat_id = int(cat_id)
-    idx = int(idx)
+@callback_route("pnav", int, int)
+def cb_product_nav(c: types.CallbackQuery, cat_id: int, idx: int):
     uid = c.from_user.id
     bot.answer_callback_query(c.id)
     show_product(c.message.chat.id, uid, cat_id, idx)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("revnav:"))
-def cb_review_nav(c: types.CallbackQuery):
-    idx = int(c.data.split(":", 1)[1])
+@callback_route("revnav", int)
+def cb_review_nav(c: types.CallbackQuery, idx: int):
     uid = c.from_user.id
     bot.answer_callback_query(c.id)
     show_review(c.message.chat.id, uid, idx)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("cqty:"))
-def cb_cart_qty(c: types.CallbackQuery):
-    _, item_id, delta = c.data.split(":")
-    item_id = int(item_id)
-    delta = int(delta)
+@callback_route("cqty", int, int)
+def cb_cart_qty(c: types.CallbackQuery, item_id: int, delta: int):
     bot.answer_callback_query(c.id)
-    update_cart_item_qty(item_id, delta)
+    update_cart_item_qty(c.from_user.id, item_id, delta)
     open_cart(c.message.chat.id, c.from_user.id, origin_msg=c.message)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("cdel:"))
-def cb_cart_del(c: types.CallbackQuery):
-    item_id = int(c.data.split(":")[1])
+@callback_route("cdel", int)
+def cb_cart_del(c: types.CallbackQuery, item_id: int):
     bot.answer_callback_query(c.id)
-    db_exec("DELETE FROM cart_items WHERE id=?", (item_id,))
+    remove_cart_item(c.from_user.id, item_id)
     open_cart(c.message.chat.id, c.from_user.id, origin_msg=c.message)
 
 
@@ -1363,8 +4737,7 @@ def search_products(message: types.Message):
     if not text:
         bot.reply_to(message, "Пустой запрос.")
         return
-    rows = db_exec("SELECT * FROM products WHERE title LIKE ? ORDER BY id DESC",
-                   (f"%{text}%",), fetchall=True)
+    rows = REPO.catalog.search(text)
     if not rows:
         bot.reply_to(message, "Ничего не найдено.")
         return
@@ -1381,9 +4754,8 @@ def search_products(message: types.Message):
             bot.send_message(message.chat.id, caption, reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("prod:"))
-def cb_product(c: types.CallbackQuery):
-    prod_id = int(c.data.split(":", 1)[1])
+@callback_route("prod", int)
+def cb_product(c: types.CallbackQuery, prod_id: int):
     bot.answer_callback_query(c.id)
     p = get_product(prod_id)
     if not p:
@@ -1393,15 +4765,16 @@ def cb_product(c: types.CallbackQuery):
     bot.send_message(c.message.chat.id, "Выбери размер:", reply_markup=size_kb(prod_id, sizes))
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("size:"))
-def cb_choose_size(c: types.CallbackQuery):
-    _, prod_id, size = c.data.split(":")
-    prod_id = int(prod_id)
+@callback_route("size", int, str)
+def cb_choose_size(c: types.CallbackQuery, prod_id: int, size: str):
 
     p = get_product(prod_id)
     if not p:
         bot.answer_callback_query(c.id, "Товар не найден.")
         return
+    if not size_available(prod_id, size):
+        bot.answer_callback_query(c.id, f"Размер {size} закончился 😔", show_alert=True)
+        return
 
     add_to_cart(c.from_user.id, prod_id, size)
     bot.answer_callback_query(c.id, f"Добавлено ({size})")
@@ -1412,17 +4785,15 @@ def cb_choose_size(c: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("fav:"))
-def cb_fav(c: types.CallbackQuery):
-    prod_id = int(c.data.split(":", 1)[1])
+@callback_route("fav", int)
+def cb_fav(c: types.CallbackQuery, prod_id: int):
     added = toggle_favorite(c.from_user.id, prod_id)
     bot.answer_callback_query(c.id, "Добавлено ⭐️" if added else "Удалено")
 
 
 # ====== ЧЕКАУТ БЕЗ запроса промокода ======
-@bot.callback_query_handler(func=lambda c: c.data.startswith("cart:"))
-def cb_cart(c: types.CallbackQuery):
-    act = c.data.split(":", 1)[1]
+@callback_route("cart", str)
+def cb_cart(c: types.CallbackQuery, act: str):
     uid = c.from_user.id
     bot.answer_callback_query(c.id)
 
@@ -1435,6 +4806,65 @@ def cb_cart(c: types.CallbackQuery):
         _process_checkout_by_code(c.message.chat.id, uid)
 
 
+def _create_order_tx(user_id: int, items: List[sqlite3.Row], total: int,
+                     saved_code: Optional[str]) -> Tuple[int, int, str, int]:
+    discount_percent, promo_code = 0, ""
+    with db_tx():
+        order_id = REPO.orders.create(user_id, total)
+
+        short = []
+        for i in items:
+            held = take_stock(i["product_id"], i["size"], i["qty"])
+            if held == 0:
+                left = REPO.catalog.stock_qty(i["product_id"], i["size"])
+                short.append({"title": i["title"], "size": i["size"], "left": max(0, left)})
+                continue
+            REPO.orders.add_item(order_id, i["product_id"], i["size"], i["qty"], i["price"], held or 0)
+        if short:
+            raise OutOfStock(short)
+
+        if saved_code:
+            discount_percent, promo_code = reserve_promo(saved_code, user_id, order_id)
+            if not promo_code:
+                clear_user_promo(user_id)
+                discount_percent = 0
+
+        final_total = int(round(total * (100 - discount_percent) / 100)) if discount_percent else total
+        if promo_code:
+            REPO.orders.set_discount(order_id, discount_percent, final_total, promo_code)
+
+        clear_cart(user_id)
+        mark_first_order(user_id)
+        enqueue_message(
+            ADMIN_ID,
+            _order_admin_text(order_id, user_id, items, total, discount_percent, promo_code, final_total),
+            admin_order_actions_kb(order_id, user_id),
+        )
+    return order_id, discount_percent, promo_code, final_total
+
+
+def _order_admin_text(order_id: int, user_id: int, items: List[sqlite3.Row], total: int,
+                      discount_percent: int, promo_code: str, final_total: int) -> str:
+    order_lines = [
+        f"{i['title']} — {i['qty']} шт., {i['size']}, {i['price']}{CURRENCY}"
+        for i in items
+    ]
+    adm_text = (
+        f"🆕 <b>Новый заказ #{order_id}</b>\n"
+        f"Покупатель: <a href='tg://user?id={user_id}'>{user_id}</a>\n\n"
+        + "\n".join(order_lines)
+        + f"\n\nСумма: <b>{total}{CURRENCY}</b>\n"
+    )
+    if discount_percent:
+        adm_text += (
+            f"Скидка: {discount_percent}% по <code>{promo_code}</code>\n"
+            f"Итог: <b>{final_total}{CURRENCY}</b>\n"
+        )
+    else:
+        adm_text += f"Итог: <b>{final_total}{CURRENCY}</b>\n"
+    return adm_text
+
+
 def _process_checkout_by_code(chat_id: int, user_id: int):
     items = get_cart(user_id)
     if not items:
@@ -1444,34 +4874,24 @@ def _process_checkout_by_code(chat_id: int, user_id: int):
     total = sum(i["price"] * i["qty"] for i in items)
 
     saved_percent, saved_code = get_user_promo(user_id)
-    discount_percent = 0
-    promo_code = ""
-
-    if saved_code:
-        discount_percent, promo_code = apply_promo_use(saved_code)
-        if not promo_code:
-            clear_user_promo(user_id)
-            discount_percent = 0
-
-    final_total = int(round(total * (100 - discount_percent) / 100)) if discount_percent else total
 
-    db_exec(
-        """
-        INSERT INTO orders(user_id,status,total,discount_percent,final_total,promo_code,created_at,partner_commission,partner_paid)
-        VALUES (?,?,?,?,?,?,?,?,?)
-        """,
-        (user_id, "новый", total, discount_percent, final_total,
-         promo_code or None, datetime.utcnow().isoformat(), 0, 0),
-    )
-    order_id = db_exec("SELECT id FROM orders ORDER BY id DESC LIMIT 1", fetchone=True)["id"]
-
-    for i in items:
-        db_exec(
-            "INSERT INTO order_items(order_id,product_id,size,qty,price) VALUES (?,?,?,?,?)",
-            (order_id, i["product_id"], i["size"], i["qty"], i["price"]),
+    # заказ, списание склада, резерв промокода и очистка корзины — одной транзакцией;
+    # если какого-то размера не хватило, откатывается всё, корзина остаётся как была
+    try:
+        order_id, discount_percent, promo_code, final_total = _create_order_tx(user_id, items, total, saved_code)
+    except OutOfStock as e:
+        lines = [
+            f"• {i['title']} ({i['size']}) — " + (f"осталось {i['left']} шт." if i["left"] else "закончился")
+            for i in e.items
+        ]
+        bot.send_message(
+            chat_id,
+            "😔 Не хватает товара на складе:\n" + "\n".join(lines) + "\n\nПоправь корзину и оформи заново.",
+            reply_markup=types.InlineKeyboardMarkup().add(
+                types.InlineKeyboardButton("🧺 Корзина", callback_data="sec:cart")
+            ),
         )
-
-    clear_cart(user_id)
+        return
 
     user_text = (
         f"✅ Заказ <b>#{order_id}</b> оформлен!\n"
@@ -1490,110 +4910,83 @@ def _process_checkout_by_code(chat_id: int, user_id: int):
     bot.send_message(chat_id, user_text,
                      reply_markup=types.InlineKeyboardMarkup().add(back_btn("sec:menu")))
 
-    order_lines = [
-        f"{i['title']} — {i['qty']} шт., {i['size']}, {i['price']}{CURRENCY}"
-        for i in items
-    ]
-    adm_text = (
-        f"🆕 <b>Новый заказ #{order_id}</b>\n"
-        f"Покупатель: <a href='tg://user?id={user_id}'>{user_id}</a>\n\n"
-        + "\n".join(order_lines)
-        + f"\n\nСумма: <b>{total}{CURRENCY}</b>\n"
-    )
-    if discount_percent:
-        adm_text += (
-            f"Скидка: {discount_percent}% по <code>{promo_code}</code>\n"
-            f"Итог: <b>{final_total}{CURRENCY}</b>\n"
-        )
-    else:
-        adm_text += f"Итог: <b>{final_total}{CURRENCY}</b>\n"
-
-    bot.send_message(ADMIN_ID, adm_text,
-                     reply_markup=admin_order_actions_kb(order_id, user_id))
-
 
 # ================== АДМИН: ПОДТВЕРДИТЬ/ОТКЛОНИТЬ ==================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("aocf:"))
-def cb_admin_confirm(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
-    order_id = int(c.data.split(":", 1)[1])
-    o = get_order(order_id)
-    if not o:
-        bot.answer_callback_query(c.id, "Заказ не найден.")
-        return
-
-    set_order_status(order_id, "подтверждён")
-    if o["promo_code"]:
-        promo_confirm_use(o["promo_code"])
-
-    if o["promo_code"] and not int(o.get("partner_paid") or 0):
-        partner = get_partner_by_code(o["promo_code"])
-        if partner:
-            commission_percent = int(partner["commission_percent"] or 0)
-            final_total = int(o["final_total"] or o["total"] or 0)
-            commission = int(round(final_total * commission_percent / 100)) if commission_percent else 0
-
-            if commission > 0:
-                db_exec("""
-                    UPDATE partners
-                    SET balance = balance + ?,
-                        total_earned = total_earned + ?,
-                        total_sales = total_sales + ?,
-                        confirmed_uses = confirmed_uses + 1
-                    WHERE user_id=?
-                """, (commission, commission, final_total, partner["user_id"]))
-
-                db_exec("""
-                    UPDATE orders
-                    SET partner_commission=?, partner_paid=1
-                    WHERE id=?
-                """, (commission, order_id))
-
-                try:
-                    bot.send_message(
-                        partner["user_id"],
-                        "💸 По твоему промокоду подтверждена покупка!\n"
-                        f"Сумма после скидки: <b>{final_total}{CURRENCY}</b>\n"
-                        f"Твоя комиссия {commission_percent}%: <b>{commission}{CURRENCY}</b>\n"
-                        f"Баланс обновлён ✅"
-                    )
-                except:
-                    pass
-
-    bot.answer_callback_query(c.id, "Подтверждено.")
+@callback_route("aocf", int, admin=True)
+def cb_admin_confirm(c: types.CallbackQuery, order_id: int):
+
+    # статус, остатки, промокод, комиссия и уведомления — одной транзакцией;
+    # отвечаем Telegram уже после неё, не держа DB_LOCK на сетевом вызове
     try:
-        bot.send_message(o["user_id"], f"✅ Заказ #{order_id} подтверждён админом.")
-    except:
-        pass
+        with db_tx():
+            o = get_order(order_id)
+            if not o:
+                answer = "Заказ не найден."
+            elif o["status"] == "подтверждён":
+                answer = "Заказ уже подтверждён."
+            else:
+                if o["status"] in ORDER_CANCEL_STATUSES:
+                    retake_order_stock(order_id)
+                set_order_status(order_id, "подтверждён")
+                confirm_order_promo(o)
+                enqueue_message(o["user_id"], f"✅ Заказ #{order_id} подтверждён админом.")
+                answer = "Подтверждено."
+    except OutOfStock as e:
+        bot.answer_callback_query(c.id, "Не хватает остатков: " + _short_stock_text(e), show_alert=True)
+        return
+    bot.answer_callback_query(c.id, answer)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("aocn:"))
-def cb_admin_cancel(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
-    order_id = int(c.data.split(":", 1)[1])
-    o = get_order(order_id)
-    if not o:
-        bot.answer_callback_query(c.id, "Заказ не найден.")
-        return
+def _short_stock_text(e: OutOfStock) -> str:
+    return ", ".join(f"{i['title']} ({i['size']}) — {i['left']} шт." for i in e.items)
 
-    set_order_status(order_id, "отклонён")
-    bot.answer_callback_query(c.id, "Отклонено.")
-    try:
-        bot.send_message(o["user_id"], f"❌ Заказ #{order_id} отклонён.")
-    except:
-        pass
 
+@callback_route("aocn", int, admin=True)
+def cb_admin_cancel(c: types.CallbackQuery, order_id: int):
+    with db_tx():
+        o = get_order(order_id)
+        if o:
+            set_order_status(order_id, "отклонён")
+            release_order_stock(order_id)
+            release_promo_reservation(order_id)
+            notify_partner_reversal(order_id)
+            enqueue_message(o["user_id"], f"❌ Заказ #{order_id} отклонён.")
+    bot.answer_callback_query(c.id, "Отклонено." if o else "Заказ не найден.")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("msg:"))
-def cb_admin_msg_client(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
+
+def confirm_order_promo(o: sqlite3.Row):
+    """
+    Заказ принят (aocf или любой не-отменённый статус в ost) — резерв промокода
+    подтверждается, партнёру начисляется комиссия. Повторный вызов ничего не меняет.
+    """
+    if not o["promo_code"] or not confirm_promo_reservation(o["id"], o["promo_code"]):
+        return
+    accrued = accrue_partner_commission(o)
+    if accrued:
+        partner, commission, final_total = accrued
+        enqueue_message(
+            partner["user_id"],
+            "💸 По твоему промокоду подтверждена покупка!\n"
+            f"Сумма после скидки: <b>{final_total}{CURRENCY}</b>\n"
+            f"Твоя комиссия {partner['commission_percent']}%: <b>{commission}{CURRENCY}</b>\n"
+            f"Баланс: <b>{get_partner_balance(partner['user_id'])['balance']}{CURRENCY}</b> ✅"
+        )
+
+
+def notify_partner_reversal(order_id: int):
+    reversed_ = reverse_partner_commission(order_id)
+    if not reversed_:
         return
-    user_id = int(c.data.split(":", 1)[1])
+    partner_id, amount = reversed_
+    enqueue_message(
+        partner_id,
+        f"↩️ Заказ #{order_id} по твоему промокоду отменён.\n"
+        f"Комиссия <b>{amount}{CURRENCY}</b> списана с баланса."
+    )
+
+
+@callback_route("msg", int, admin=True)
+def cb_admin_msg_client(c: types.CallbackQuery, user_id: int):
     bot.answer_callback_query(c.id)
     msg = bot.send_message(ADMIN_ID, f"Напиши сообщение клиенту {user_id}:")
     bot.register_next_step_handler(msg, lambda m: _send_admin_message_to_user(m, user_id))
@@ -1610,30 +5003,33 @@ def _send_admin_message_to_user(message: types.Message, user_id: int):
         bot.reply_to(message, f"Не смог отправить: {e}")
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("ost:"))
-def cb_order_status(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Только для админа.")
+@callback_route("ost", int, str, admin=True)
+def cb_order_status(c: types.CallbackQuery, order_id: int, status: str):
+    try:
+        with db_tx():
+            prev = get_order(order_id)
+            if prev and prev["status"] in ORDER_CANCEL_STATUSES and status not in ORDER_CANCEL_STATUSES:
+                retake_order_stock(order_id)
+            set_order_status(order_id, status)
+            if status in ORDER_CANCEL_STATUSES:
+                release_order_stock(order_id)
+                release_promo_reservation(order_id)
+                notify_partner_reversal(order_id)
+            elif prev and (prev["status"] == "новый" or prev["status"] in ORDER_CANCEL_STATUSES):
+                # принят минуя aocf — иначе резерв промокода так и висит 'held'
+                confirm_order_promo(prev)
+            o = get_order(order_id)
+            if o:
+                enqueue_message(o["user_id"], f"🔔 Статус заказа #{order_id}: <b>{status}</b>")
+    except OutOfStock as e:
+        bot.answer_callback_query(c.id, "Не хватает остатков: " + _short_stock_text(e), show_alert=True)
         return
-    _, order_id, status = c.data.split(":", 2)
-    order_id = int(order_id)
-    set_order_status(order_id, status)
     bot.answer_callback_query(c.id, f"Статус: {status}")
 
-    o = get_order(order_id)
-    if o:
-        try:
-            bot.send_message(o["user_id"], f"🔔 Статус заказа #{order_id}: <b>{status}</b>")
-        except:
-            pass
-
 
 # ================== АДМИН: УДАЛЕНИЕ КАТЕГОРИЙ ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:cats_del")
+@callback_route("adm:cats_del", admin=True)
 def cb_adm_cats_del(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
 
     cats = get_categories()
@@ -1653,15 +5049,11 @@ def cb_adm_cats_del(c: types.CallbackQuery):
                kb, origin_msg=c.message)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("adm:cat_del:"))
-def cb_adm_cat_del_confirm(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
+@callback_route("adm:cat_del", int, admin=True)
+def cb_adm_cat_del_confirm(c: types.CallbackQuery, cat_id: int):
     bot.answer_callback_query(c.id)
 
-    cat_id = int(c.data.split(":")[-1])
-    cat = db_exec("SELECT * FROM categories WHERE id=?", (cat_id,), fetchone=True)
+    cat = REPO.catalog.category(cat_id)
     if not cat:
         bot.answer_callback_query(c.id, "Категория не найдена.", show_alert=True)
         return
@@ -1674,11 +5066,8 @@ def cb_adm_cat_del_confirm(c: types.CallbackQuery):
 
 
 # ================== АДМИН: IMPORT HINT ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:import_hint")
+@callback_route("adm:import_hint", admin=True)
 def cb_adm_import_hint(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
     txt = (
         "📥 <b>Импорт товара</b>\n\n"
@@ -1696,36 +5085,37 @@ def cb_adm_import_hint(c: types.CallbackQuery):
 
 
 # ================== АДМИН: БАННЕРЫ ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:banners")
+@callback_route("adm:banners", admin=True)
 def cb_adm_banners(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
+    smart_send(c.message.chat.id, "Выбери раздел для баннера:",
+               banners_kb(), origin_msg=c.message)
+
+
+BANNER_SECTIONS = [
+    ("catalog", "Каталог"),
+    ("search", "Поиск"),
+    ("cart", "Корзина"),
+    ("favs", "Избранное"),
+    ("profile", "Профиль"),
+    ("reviews", "Отзывы"),
+    ("promo", "Промокод"),
+    ("help", "Как пользоваться"),
+    ("admin", "Админ-панель"),
+]
+
+
+@render_cached()
+def banners_kb():
     kb = types.InlineKeyboardMarkup()
-    for sec, name in [
-        ("catalog", "Каталог"),
-        ("search", "Поиск"),
-        ("cart", "Корзина"),
-        ("favs", "Избранное"),
-        ("profile", "Профиль"),
-        ("reviews", "Отзывы"),
-        ("promo", "Промокод"),
-        ("help", "Как пользоваться"),
-        ("admin", "Админ-панель"),
-    ]:
+    for sec, name in BANNER_SECTIONS:
         kb.add(types.InlineKeyboardButton(name, callback_data=f"setb:{sec}"))
     kb.add(back_btn("sec:admin"))
-    smart_send(c.message.chat.id, "Выбери раздел для баннера:",
-               kb, origin_msg=c.message)
+    return kb
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("setb:"))
-def cb_setb(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
-    section = c.data.split(":", 1)[1]
+@callback_route("setb", str, admin=True)
+def cb_setb(c: types.CallbackQuery, section: str):
     bot.answer_callback_query(c.id)
     msg = bot.send_message(c.message.chat.id, f"Пришли одно фото для баннера {section}:")
     bot.register_next_step_handler(msg, lambda m: save_banner_photo(m, section))
@@ -1743,13 +5133,10 @@ def save_banner_photo(message: types.Message, section: str):
 
 
 # ================== АДМИН: ЗАКАЗЫ ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:orders")
+@callback_route("adm:orders", admin=True)
 def cb_adm_orders(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
-    rows = db_exec("SELECT * FROM orders ORDER BY id DESC LIMIT 20", fetchall=True)
+    rows = recent_orders(20)
     if not rows:
         smart_send(c.message.chat.id, "Заказов пока нет.",
                    types.InlineKeyboardMarkup().add(back_btn("sec:admin")),
@@ -1770,11 +5157,8 @@ def cb_adm_orders(c: types.CallbackQuery):
 
 
 # ================== АДМИН: ПРОМОКОДЫ ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:promos")
+@callback_route("adm:promos", admin=True)
 def cb_adm_promos(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("➕ Создать промокод", callback_data="adm:promo_new"))
@@ -1783,11 +5167,8 @@ def cb_adm_promos(c: types.CallbackQuery):
     smart_send(c.message.chat.id, "Промокоды:", kb, origin_msg=c.message)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "adm:promo_new")
+@callback_route("adm:promo_new", admin=True)
 def cb_adm_promo_new(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
     msg = bot.send_message(
         c.message.chat.id,
@@ -1813,24 +5194,14 @@ def admin_create_promo(message: types.Message):
         bot.reply_to(message, "Скидка и лимит должны быть числами.")
         return
 
-    db_exec("""
-        INSERT INTO promo_codes(code,discount_percent,max_uses,used,confirmed_uses,created_at)
-        VALUES(?,?,?,?,?,?)
-        ON CONFLICT(code) DO UPDATE SET
-            discount_percent=excluded.discount_percent,
-            max_uses=excluded.max_uses
-    """, (code, percent, max_uses, 0, 0, datetime.utcnow().isoformat()))
-
+    REPO.promos.add(code, percent, max_uses, update=True)
     bot.reply_to(message, f"✅ Промокод <code>{code}</code> создан.")
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "adm:promo_list")
+@callback_route("adm:promo_list", admin=True)
 def cb_adm_promo_list(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
-    rows = db_exec("SELECT * FROM promo_codes ORDER BY created_at DESC", fetchall=True)
+    rows = REPO.promos.all()
     if not rows:
         smart_send(c.message.chat.id, "Промокодов нет.",
                    types.InlineKeyboardMarkup().add(back_btn("sec:admin")),
@@ -1856,11 +5227,8 @@ def cb_adm_promo_list(c: types.CallbackQuery):
 
 
 # ================== АДМИН: РАССЫЛКА ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:broadcast")
+@callback_route("adm:broadcast", admin=True)
 def cb_adm_broadcast(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
     msg = bot.send_message(
         c.message.chat.id,
@@ -1875,28 +5243,30 @@ def admin_do_broadcast(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
 
-    users = db_exec("SELECT user_id FROM users", fetchall=True)
-    uids = [int(u["user_id"]) for u in users]
+    if not message.photo and not (message.text or "").strip():
+        return
 
-    sent = 0
-    fails = 0
+    # темп рассылки держит исходящий шлюз; отдельный поток с низким приоритетом,
+    # чтобы ответы покупателям шли вперёд неё
+    bot.reply_to(message, "📣 Рассылка запущена, отчёт пришлю по завершении.")
+    threading.Thread(target=_run_broadcast, args=(message,), name="broadcast", daemon=True).start()
 
-    for uid in uids:
-        try:
-            if message.photo:
-                file_id = message.photo[-1].file_id
-                caption = message.caption or ""
-                bot.send_photo(uid, file_id, caption=caption)
-            else:
-                text = message.text or ""
-                if not text.strip():
-                    continue
-                bot.send_message(uid, text)
 
-            sent += 1
-            time.sleep(0.05)
-        except:
-            fails += 1
+def _run_broadcast(message: types.Message):
+    uids = REPO.users.ids()
+
+    if message.photo:
+        file_id = message.photo[-1].file_id
+        caption = message.caption or ""
+        calls = [lambda uid=uid: bot.send_photo(uid, file_id, caption=caption) for uid in uids]
+    else:
+        calls = [lambda uid=uid: bot.send_message(uid, message.text) for uid in uids]
+
+    # параллельно, темп и бюджет держит исходящий шлюз
+    with send_priority(PRIO_BULK):
+        results = run_fan_out(calls)
+    fails = sum(1 for r in results if isinstance(r, Exception))
+    sent = len(results) - fails
 
     bot.reply_to(
         message,
@@ -1905,11 +5275,8 @@ def admin_do_broadcast(message: types.Message):
 
 
 # ================== АДМИН: ИНВАЙТ НА ОТЗЫВ (ПО ПЕРЕСЛАННОМУ СООБЩЕНИЮ) ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:review_invite")
+@callback_route("adm:review_invite", admin=True)
 def cb_adm_review_invite(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
     msg = bot.send_message(
         c.message.chat.id,
@@ -1936,11 +5303,7 @@ def admin_send_review_invite_from_forward(message: types.Message):
     uid = fwd.id
     username = fwd.username or ""
 
-    db_exec(
-        "INSERT INTO review_invites(user_id,invited_at,used) VALUES(?,?,0) "
-        "ON CONFLICT(user_id) DO UPDATE SET invited_at=excluded.invited_at, used=0",
-        (uid, datetime.utcnow().isoformat()),
-    )
+    REPO.reviews.invite(uid)
 
     invite_text = (
         "✍️ Админ приглашает тебя оставить отзыв.\n\n"
@@ -1965,88 +5328,617 @@ def admin_send_review_invite_from_forward(message: types.Message):
         
 
 # ================== АДМИН: НЕПРИНЯТЫЕ ОТЗЫВЫ ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:reviews_pending")
-def cb_adm_reviews_pending(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
+def review_card_caption(r: sqlite3.Row, photos: List[str], header: str) -> str:
+    txt = (r["text"] or "").strip()
+    if photos and len(txt) > 800:
+        # подпись к фото ограничена 1024 символами
+        txt = txt[:800] + "…"
+    caption = (
+        f"{header}\n"
+        f"От пользователя: <code>{r['user_id']}</code>\n\n"
+        f"{txt}"
+    )
+    if len(photos) > 1:
+        caption += f"\n\n📷 Фото в отзыве: {len(photos)}"
+    return caption
+
+
+def show_review_queue(chat_id: int, after_id: int = 0, origin_msg: types.Message = None):
+    """Очередь модерации: одна карточка, которая редактируется на месте."""
+    r = get_next_pending_review(after_id)
+    if not r:
+        smart_send(chat_id, "Непринятых отзывов нет ✅",
+                   types.InlineKeyboardMarkup().add(back_btn("sec:admin")),
+                   origin_msg=origin_msg)
         return
+
+    photos = json.loads(r["photos_json"]) if r["photos_json"] else []
+    caption = review_card_caption(
+        r, photos,
+        f"📝 <b>Отзыв #{r['id']}</b> · в очереди: <b>{count_pending_reviews()}</b>"
+    )
+
+    # текст нельзя отредактировать в фото и наоборот — такую карточку пересоздаём
+    if origin_msg and bool(origin_msg.photo) != bool(photos):
+        try:
+            bot.delete_message(chat_id, origin_msg.message_id)
+        except:
+            pass
+        origin_msg = None
+
+    smart_send(chat_id, caption, review_queue_kb(r["id"], len(photos)), origin_msg=origin_msg,
+               photo_id=photos[0] if photos else None)
+
+
+@callback_route("adm:reviews_pending", admin=True)
+def cb_adm_reviews_pending(c: types.CallbackQuery):
     bot.answer_callback_query(c.id)
+    show_review_queue(c.message.chat.id, origin_msg=c.message)
 
-    rows = get_pending_reviews()
-    if not rows:
-        smart_send(
-            c.message.chat.id,
-            "Непринятых отзывов нет ✅",
-            types.InlineKeyboardMarkup().add(back_btn("sec:admin")),
-            origin_msg=c.message
-        )
+
+@callback_route("rvq", str, int, admin=True)
+def cb_review_queue(c: types.CallbackQuery, act: str, rid: int):
+
+    r = get_review(rid) if act in ("app", "rej", "pics") else None
+    if act == "pics":
+        photos = json.loads(r["photos_json"]) if r and r["photos_json"] else []
+        bot.answer_callback_query(c.id)
+        if photos:
+            bot.send_media_group(c.message.chat.id, [InputMediaPhoto(pid) for pid in photos[:10]])
         return
 
-    for r in rows:
-        photos = json.loads(r["photos_json"]) if r["photos_json"] else []
-        txt = (r["text"] or "").strip()
-        caption = (
-            f"📝 <b>Отзыв #{r['id']}</b>\n"
-            f"От пользователя: <code>{r['user_id']}</code>\n\n"
-            f"{txt}"
+    # карточка могла устареть: отзыв уже приняли или отклонили с другого экрана
+    if act in ("app", "rej") and (not r or r["is_approved"]):
+        bot.answer_callback_query(c.id, "Отзыв уже обработан.")
+    elif act == "app":
+        approve_review_and_notify(r)
+        bot.answer_callback_query(c.id, "✅ Принято")
+    elif act == "rej":
+        reject_review_and_notify(r)
+        bot.answer_callback_query(c.id, "❌ Отклонено")
+    else:
+        bot.answer_callback_query(c.id)
+
+    show_review_queue(c.message.chat.id, after_id=rid, origin_msg=c.message)
+
+
+def approve_review_and_notify(r: sqlite3.Row):
+    """Публикация, бонусный промокод и сообщения автору — одной транзакцией."""
+    with db_tx():
+        approve_review(r["id"])
+        bonus_code = create_review_bonus_promo(r["user_id"], r["id"])
+        enqueue_message(
+            r["user_id"],
+            "🎁 Спасибо за отзыв! Дарю промокод на 5% (одноразовый):\n"
+            f"<code>{bonus_code}</code>\n\n"
+            "Введи его в меню «Промокод» — применится при следующей покупке."
         )
+        enqueue_message(r["user_id"], "✅ Твой отзыв опубликован. Спасибо!")
 
-        if photos:
-            media = [InputMediaPhoto(pid) for pid in photos[:10]]
-            media[-1].caption = caption
-            media[-1].parse_mode = "HTML"
-            bot.send_media_group(c.message.chat.id, media)
-            bot.send_message(c.message.chat.id, "Модерация:", reply_markup=review_pending_kb(r["id"]))
-        else:
-            bot.send_message(c.message.chat.id, caption, reply_markup=review_pending_kb(r["id"]))
 
+def reject_review_and_notify(r: sqlite3.Row):
+    with db_tx():
+        reject_review(r["id"])
+        enqueue_message(r["user_id"], "❌ Твой отзыв отклонён админом.")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("revapp:"))
-def cb_review_approve(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
+
+@callback_route("revapp", int, admin=True)
+def cb_review_approve(c: types.CallbackQuery, rid: int):
+    r = get_review(rid)
+    if not r or r["is_approved"]:
+        bot.answer_callback_query(c.id, "Отзыв уже обработан.")
         return
-    rid = int(c.data.split(":", 1)[1])
-    approve_review(rid)
+    approve_review_and_notify(r)
     bot.answer_callback_query(c.id, "✅ Принято")
     bot.send_message(c.message.chat.id, f"Отзыв #{rid} принят ✅",
                      reply_markup=types.InlineKeyboardMarkup().add(back_btn("sec:admin")))
 
-    r = db_exec("SELECT * FROM reviews WHERE id=?", (rid,), fetchone=True)
-    if r:
-        try:
-            bonus_code = create_review_bonus_promo(r["user_id"], rid)
-            bot.send_message(
-                r["user_id"],
-                "🎁 Спасибо за отзыв! Дарю промокод на 5% (одноразовый):\n"
-                f"<code>{bonus_code}</code>\n\n"
-                "Введи его в меню «Промокод» — применится при следующей покупке."
-            )
-        except Exception as e:
-            print("bonus promo send fail:", e)
-
-        try:
-            bot.send_message(r["user_id"], "✅ Твой отзыв опубликован. Спасибо!")
-        except:
-            pass
-
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("revrej:"))
-def cb_review_reject(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
+@callback_route("revrej", int, admin=True)
+def cb_review_reject(c: types.CallbackQuery, rid: int):
+    r = get_review(rid)
+    if not r or r["is_approved"]:
+        bot.answer_callback_query(c.id, "Отзыв уже обработан.")
         return
-    rid = int(c.data.split(":", 1)[1])
-    r = db_exec("SELECT * FROM reviews WHERE id=?", (rid,), fetchone=True)
-    reject_review(rid)
+    reject_review_and_notify(r)
     bot.answer_callback_query(c.id, "❌ Отклонено")
     bot.send_message(c.message.chat.id, f"Отзыв #{rid} отклонён ❌",
                      reply_markup=types.InlineKeyboardMarkup().add(back_btn("sec:admin")))
-    if r:
+
+
+# ================== АДМИН: ОСТАТКИ ==================
+# команды админа регистрируются до media_group_flush — он перехватывает любой текст
+STOCK_HELP = (
+    "Вставь таблицу остатков — по строке на товар или размер:\n"
+    "<code>12 M 3</code>\n"
+    "<code>12 S=3 M=0 L=5</code>\n"
+    "Первое число — ID товара, 0 — размер закончился, <code>-</code> — не учитывать размер.\n"
+    "Столбцы можно копировать прямо из таблицы."
+)
+
+
+@bot.message_handler(commands=["stock"])
+def cmd_stock(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    table = re.sub(r"^/stock(@\w+)?", "", message.text or "").strip()
+    if table:
+        _admin_apply_stock(message, table)
+        return
+    msg = bot.reply_to(message, STOCK_HELP)
+    bot.register_next_step_handler(msg, lambda m: _admin_apply_stock(m, m.text or ""))
+
+
+def _admin_apply_stock(message: types.Message, table: str):
+    if message.from_user.id != ADMIN_ID:
+        return
+    rows, errors = parse_stock_table(table)
+    if not rows:
+        bot.reply_to(message, "Не нашёл ни одной строки.\n\n" + STOCK_HELP)
+        return
+    report = set_stock_bulk(rows)
+    text = (
+        "📦 <b>Остатки обновлены</b>\n"
+        f"Записано: <b>{report['set']}</b>\n"
+        f"Снято с учёта: <b>{report['removed']}</b>\n"
+    )
+    if report["unknown"]:
+        text += f"Нет такого товара: <b>{report['unknown']}</b>\n"
+    if errors:
+        text += "\nНе понял строки:\n" + "\n".join(f"<code>{e[:60]}</code>" for e in errors[:20])
+    bot.reply_to(message, text)
+
+
+@bot.message_handler(commands=["payouts"])
+def cmd_payouts(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    open_payouts(message.chat.id)
+
+
+@bot.message_handler(commands=["startup"])
+def cmd_startup(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    gateway = " ".join(f"{k}={v}" for k, v in OUTBOUND.stats.items())
+    bot.reply_to(
+        message,
+        "⏱ <b>Старт</b>\n<code>" + format_startup_metrics().replace(" ", "\n") + "</code>\n"
+        "📤 <b>Шлюз</b>\n<code>" + gateway.replace(" ", "\n") + "</code>\n"
+        "🚦 <b>Очередь апдейтов</b>\n<code>" + format_queue_stats(SCHED) + "</code>"
+    )
+
+
+# ================== АДМИН: БЭКАПЫ ==================
+# Онлайн-копия через sqlite backup API с отдельного соединения. Перед копированием
+# открываем читающую транзакцию: в WAL она фиксирует снимок, поэтому шаги по
+# BACKUP_STEP_PAGES страниц копируют одну версию базы и не перезапускаются,
+# а писатели в основном соединении не ждут. Между шагами — короткая пауза.
+BACKUP_DIR = os.getenv("INKO_BACKUP_DIR") or os.path.join(BASE_DIR, "backups")
+BACKUP_KEEP = int(os.getenv("INKO_BACKUP_KEEP") or 7)
+BACKUP_INTERVAL = 6 * 3600
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_PAUSE = 0.005
+BACKUP_SEND_MAX = 49 * 1024 * 1024  # лимит Bot API на документ — 50 МБ
+BACKUP_REQUIRED_TABLES = {"users", "products", "orders", "order_items", "settings"}
+
+
+def make_backup(suffix: str = "") -> str:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    dest = os.path.join(BACKUP_DIR, f"store-{datetime.utcnow():%Y%m%d-%H%M%S}{suffix}.db")
+    tmp = dest + ".part"
+    src = sqlite3.connect(DB_PATH, isolation_level=None)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+        src.backup(dst, pages=BACKUP_STEP_PAGES, progress=lambda *_: time.sleep(BACKUP_STEP_PAUSE))
+        src.execute("COMMIT")
+        # снимок — один самодостаточный файл, без -wal рядом
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, dest)
+    return dest
+
+
+def list_backups() -> List[str]:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted((f for f in os.listdir(BACKUP_DIR) if f.startswith("store-") and f.endswith(".db")),
+                  reverse=True)
+
+
+def rotate_backups():
+    for name in list_backups()[BACKUP_KEEP:]:
+        os.remove(os.path.join(BACKUP_DIR, name))
+
+
+def check_backup_file(path: str) -> Optional[str]:
+    """None — файл годится для восстановления, иначе причина отказа."""
+    try:
+        c = sqlite3.connect(path)
         try:
-            bot.send_message(r["user_id"], "❌ Твой отзыв отклонён админом.")
-        except:
-            pass
+            res = c.execute("PRAGMA integrity_check").fetchone()[0]
+            if res != "ok":
+                return f"integrity_check: {res}"
+            tables = {r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            missing = BACKUP_REQUIRED_TABLES - tables
+            if missing:
+                return "нет таблиц: " + ", ".join(sorted(missing))
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                return f"схема v{version} новее, чем у бота (v{SCHEMA_VERSION})"
+        finally:
+            c.close()
+    except sqlite3.DatabaseError as e:
+        return f"не база SQLite: {e}"
+    return None
+
+
+def restore_backup(path: str) -> str:
+    """Заливает снимок в рабочую базу. Возвращает имя страховочной копии текущего состояния."""
+    err = check_backup_file(path)
+    if err:
+        raise ValueError(err)
+    safety = make_backup("-pre-restore")
+    src = sqlite3.connect(path)
+    try:
+        with DB_LOCK:
+            src.backup(conn)
+            _SETTINGS_CACHE.clear()
+            invalidate_render_cache()
+            migrate_db()
+    finally:
+        src.close()
+    return os.path.basename(safety)
+
+
+@background_job(BACKUP_INTERVAL)
+def scheduled_backup():
+    make_backup()
+    rotate_backups()
+
+
+def _send_backup(chat_id: int):
+    try:
+        path = make_backup()
+        rotate_backups()
+    except Exception as e:
+        bot.send_message(chat_id, f"❌ Бэкап не удался: {e}")
+        return
+    size = os.path.getsize(path)
+    if size > BACKUP_SEND_MAX:
+        bot.send_message(chat_id, f"💾 Бэкап <code>{os.path.basename(path)}</code> сохранён, "
+                                  f"но он больше 50 МБ ({size // 1024 // 1024} МБ) — не отправляю.")
+        return
+    with open(path, "rb") as f:
+        bot.send_document(chat_id, f, visible_file_name=os.path.basename(path),
+                          caption=f"💾 Бэкап базы, {size // 1024} КБ")
+
+
+@bot.message_handler(commands=["backup"])
+def cmd_backup(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    bot.reply_to(message, "💾 Делаю бэкап…")
+    threading.Thread(target=_send_backup, args=(message.chat.id,), name="backup", daemon=True).start()
+
+
+@bot.message_handler(commands=["backups"])
+def cmd_backups(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    names = list_backups()
+    if not names:
+        bot.reply_to(message, "Снимков пока нет. /backup — сделать сейчас.")
+        return
+    kb = types.InlineKeyboardMarkup()
+    for name in names:
+        size = os.path.getsize(os.path.join(BACKUP_DIR, name)) // 1024
+        kb.add(types.InlineKeyboardButton(f"♻️ {name[6:-3]} · {size} КБ", callback_data=f"bkr:{name}"))
+    bot.reply_to(message, "💾 <b>Снимки базы</b>\nВыбери, на какой откатиться:", reply_markup=kb)
+
+
+@callback_route("bkr", str, admin=True)
+def cb_backup_restore_ask(c: types.CallbackQuery, name: str):
+    if name not in list_backups():
+        bot.answer_callback_query(c.id, "Снимок не найден.")
+        return
+    bot.answer_callback_query(c.id)
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✅ Да, откатить", callback_data=f"bkok:{name}"))
+    kb.add(back_btn("sec:admin"))
+    smart_send(c.message.chat.id,
+               f"Откатить базу на <code>{name}</code>?\nТекущее состояние сохраню отдельным снимком.",
+               kb, origin_msg=c.message)
+
+
+@callback_route("bkok", str, admin=True)
+def cb_backup_restore(c: types.CallbackQuery, name: str):
+    if name not in list_backups():
+        bot.answer_callback_query(c.id, "Снимок не найден.")
+        return
+    bot.answer_callback_query(c.id)
+    _admin_restore(c.message.chat.id, os.path.join(BACKUP_DIR, name))
+
+
+@bot.message_handler(commands=["restore"])
+def cmd_restore(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    msg = bot.reply_to(message, "Пришли документом файл бэкапа (.db). Текущая база сохранится снимком.")
+    bot.register_next_step_handler(msg, _admin_restore_file)
+
+
+def _admin_restore_file(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not message.document:
+        bot.reply_to(message, "Это не файл.")
+        return
+    file_info = bot.get_file(message.document.file_id)
+    with tempfile.NamedTemporaryFile("wb", suffix=".db", delete=False) as tmp:
+        tmp.write(bot.download_file(file_info.file_path))
+    try:
+        _admin_restore(message.chat.id, tmp.name)
+    finally:
+        os.remove(tmp.name)
+
+
+def _admin_restore(chat_id: int, path: str):
+    try:
+        safety = restore_backup(path)
+    except ValueError as e:
+        bot.send_message(chat_id, f"❌ Файл не подходит: {e}")
+        return
+    bot.send_message(chat_id, f"✅ База восстановлена.\nСостояние до отката: <code>{safety}</code> (/backups)")
+
+
+# ================== АДМИН: ОБСЛУЖИВАНИЕ ==================
+@bot.message_handler(commands=["maint"])
+def cmd_maint(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if "now" not in (message.text or ""):
+        last = get_setting("maintenance_report")
+        text = format_maintenance_report(json.loads(last)) if last else "Обслуживание ещё не запускалось."
+        bot.reply_to(message, text + "\n\n/maint now — запустить сейчас")
+        return
+    bot.reply_to(message, "🧹 Запускаю обслуживание…")
+
+    def run():
+        bot.send_message(message.chat.id, format_maintenance_report(run_maintenance()))
+    threading.Thread(target=run, name="maintenance", daemon=True).start()
+
+
+# ================== АДМИН: ПРОФИЛИРОВАНИЕ ==================
+# Сэмплирующий профилировщик по запросу: /profile 200 — следующие 200 апдейтов,
+# /profile 30s — 30 секунд, /profile stop — закончить раньше.
+# Пока включён, отдельный поток раз в PROFILE_INTERVAL снимает стеки всех потоков
+# (sys._current_frames) и засчитывает те, что сейчас внутри хендлера. Время — настенное:
+# ожидание Bot API, DB_LOCK и сна тоже видно, а именно оно и делает бота «медленным».
+# Выключен — потока нет, в пути апдейта нет ни одной проверки.
+# В режиме INKO_WORKERS профилируется только процесс, которому досталась команда.
+PROFILE_INTERVAL = 0.005  # 200 выборок в секунду
+PROFILE_DEFAULT_UPDATES = 200
+PROFILE_MAX_SEC = 600
+PROFILE_TAIL_SEC = 5  # сколько ждать, пока доработают последние апдейты из N
+PROFILE_TOP = 15
+
+_PROFILER_LOCK = threading.Lock()
+PROFILER: Optional["StackSampler"] = None
+
+
+def _updates_done() -> int:
+    return sum(st["done"] for st in SCHED.stats.values())
+
+
+def _handler_codes() -> set:
+    """Код хендлеров: маршруты callback, message-хендлеры и экраны open_*/show_*.
+    Стек приписывается ближайшему к листу из них: show_product, а не cb_product_nav."""
+    fns = [route[0] for route in CALLBACK_ROUTES.values()]
+    fns += [h["function"] for h in bot.message_handlers]
+    fns += [fn for name, fn in globals().items()
+            if name.startswith(("open_", "show_")) and callable(fn) and hasattr(fn, "__code__")]
+    return {fn.__code__ for fn in fns}
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    def __init__(self, chat_id: int, updates: int = 0, seconds: float = PROFILE_MAX_SEC):
+        self.chat_id = chat_id
+        self.started = time.monotonic()
+        self.deadline = self.started + min(seconds, PROFILE_MAX_SEC)
+        # счётчик растёт до обработки, так что команда /profile в нём уже есть
+        self.done0 = _updates_done()
+        self.until_done = self.done0 + updates if updates else None
+        self._tail = None
+        self.handlers = _handler_codes()
+        self.stacks: Dict[tuple, int] = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(PROFILE_INTERVAL):
+            if time.monotonic() >= self.deadline:
+                break
+            if self.until_done is not None and _updates_done() >= self.until_done and self._tail_done():
+                break
+            self._sample(me)
+        _finish_profile(self)
+
+    def _tail_done(self) -> bool:
+        """N-й апдейт уже начат — ждём, пока начатые к этому моменту закончатся."""
+        with SCHED.cond:
+            if self._tail is None:
+                self._tail = set(SCHED.busy), time.monotonic() + PROFILE_TAIL_SEC
+            return not (self._tail[0] & SCHED.busy) or time.monotonic() >= self._tail[1]
+
+    def _sample(self, me: int):
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            for i, code in enumerate(stack):
+                if code in self.handlers:
+                    break
+            else:
+                continue  # поток не в хендлере: поллер, простаивающий пул, фоновые задачи
+            key = tuple(reversed(stack[:i + 1]))  # от хендлера к листу
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Формат flamegraph.pl / speedscope: «хендлер;функция;…;лист N»."""
+        lines = []
+        for key, n in sorted(self.stacks.items(), key=lambda kv: -kv[1]):
+            lines.append(";".join([key[0].co_name] + [_frame_label(c) for c in key[1:]]) + f" {n}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        per_handler: Dict[str, int] = {}
+        own: Dict[object, int] = {}
+        total: Dict[object, int] = {}
+        for key, n in self.stacks.items():
+            per_handler[key[0].co_name] = per_handler.get(key[0].co_name, 0) + n
+            own[key[-1]] = own.get(key[-1], 0) + n
+            for code in set(key):
+                total[code] = total.get(code, 0) + n
+
+        pct = lambda n: f"{n * 100 / max(self.samples, 1):.0f}%"
+        took = time.monotonic() - self.started
+        lines = [
+            f"🔬 <b>Профиль</b>: {took:.1f} с, апдейтов {_updates_done() - self.done0}, "
+            f"выборок в хендлерах {self.samples} (раз в {PROFILE_INTERVAL * 1000:.0f} мс)",
+        ]
+        if not self.samples:
+            return lines[0] + "\n\nХендлеры за это время не работали."
+        lines.append("\n<b>По хендлерам</b>:")
+        for name, n in sorted(per_handler.items(), key=lambda kv: -kv[1])[:PROFILE_TOP]:
+            lines.append(f"<code>{pct(n):>4} {html.escape(name)}</code>")
+        lines.append("\n<b>Топ функций</b> (сама / с вложенными):")
+        for code, n in sorted(own.items(), key=lambda kv: -kv[1])[:PROFILE_TOP]:
+            lines.append(f"<code>{pct(n):>4} / {pct(total[code]):>4} {html.escape(_frame_label(code))}</code>")
+        return "\n".join(lines)
+
+
+def start_profile(chat_id: int, updates: int = 0, seconds: float = PROFILE_MAX_SEC) -> bool:
+    """False — профилировщик уже работает."""
+    global PROFILER
+    with _PROFILER_LOCK:
+        if PROFILER:
+            return False
+        PROFILER = StackSampler(chat_id, updates, seconds)
+        PROFILER.start()
+    return True
+
+
+def stop_profile() -> bool:
+    with _PROFILER_LOCK:
+        if not PROFILER:
+            return False
+        PROFILER.stop()
+    return True
+
+
+def _finish_profile(sampler: StackSampler):
+    global PROFILER
+    with _PROFILER_LOCK:
+        PROFILER = None
+    try:
+        bot.send_message(sampler.chat_id, sampler.summary())
+        if sampler.samples:
+            name = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+            bot.send_document(sampler.chat_id, BytesIO(sampler.collapsed().encode()), visible_file_name=name,
+                              caption="🔥 Стеки для flame graph (flamegraph.pl, speedscope.app)")
+    except Exception as e:
+        print(f"profile report failed: {e}")
+
+
+def parse_profile_args(text: str) -> Tuple[int, float]:
+    """«200» — апдейтов, «30s» / «2m» — время. Пусто — PROFILE_DEFAULT_UPDATES."""
+    arg = (text or "").split(maxsplit=1)[1:]
+    arg = arg[0].strip().lower() if arg else ""
+    if not arg:
+        return PROFILE_DEFAULT_UPDATES, PROFILE_MAX_SEC
+    m = re.fullmatch(r"(\d+)\s*(s|с|m|м)?", arg)
+    if not m or not int(m.group(1)):
+        raise ValueError(arg)
+    n, unit = int(m.group(1)), m.group(2)
+    if unit is None:
+        return n, PROFILE_MAX_SEC
+    return 0, n * (60 if unit in ("m", "м") else 1)
+
+
+def profile_status() -> str:
+    p = PROFILER
+    if not p:
+        return ("🔬 Профилировщик выключен.\n\n"
+                "/profile 200 — следующие 200 апдейтов\n/profile 30s — 30 секунд\n"
+                f"Не дольше {PROFILE_MAX_SEC // 60} мин.")
+    left = (f"осталось апдейтов {max(0, p.until_done - _updates_done())}" if p.until_done is not None
+            else f"осталось {max(0.0, p.deadline - time.monotonic()):.0f} с")
+    return f"🔬 Профилировщик работает: {left}, выборок {p.samples}.\n/profile stop — закончить сейчас"
+
+
+def profiler_kb():
+    kb = types.InlineKeyboardMarkup()
+    if PROFILER:
+        kb.add(types.InlineKeyboardButton("⏹ Остановить и прислать", callback_data="adm:profile:stop"))
+    else:
+        kb.add(types.InlineKeyboardButton(f"▶️ {PROFILE_DEFAULT_UPDATES} апдейтов", callback_data="adm:profile:upd"),
+               types.InlineKeyboardButton("▶️ 60 секунд", callback_data="adm:profile:sec"))
+    kb.add(back_btn("sec:admin"))
+    return kb
+
+
+@bot.message_handler(commands=["profile"])
+def cmd_profile(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if "stop" in (message.text or ""):
+        if not stop_profile():
+            bot.reply_to(message, "Профилировщик и так выключен.")
+        return
+    if len((message.text or "").split()) < 2:
+        bot.reply_to(message, profile_status())
+        return
+    try:
+        updates, seconds = parse_profile_args(message.text)
+    except ValueError:
+        bot.reply_to(message, "Не понял. /profile 200 — апдейтов, /profile 30s — секунд.")
+        return
+    if not start_profile(message.chat.id, updates, seconds):
+        bot.reply_to(message, profile_status())
+        return
+    what = f"{updates} апдейтов" if updates else f"{seconds:.0f} с"
+    bot.reply_to(message, f"🔬 Профилирую {what}. Отчёт пришлю сюда.")
+
+
+@callback_route("adm:profile", str, required=0, admin=True)
+def cb_adm_profile(c: types.CallbackQuery, act: str = ""):
+    bot.answer_callback_query(c.id)
+    if act == "stop":
+        stop_profile()
+    elif act in ("upd", "sec"):
+        start_profile(c.message.chat.id, *((PROFILE_DEFAULT_UPDATES, PROFILE_MAX_SEC) if act == "upd" else (0, 60)))
+    smart_send(c.message.chat.id, profile_status(), profiler_kb(), origin_msg=c.message)
 
 
 # ================== ПРИЁМ ОТЗЫВОВ (ТОЛЬКО ПО ИНВАЙТУ, АЛЬБОМЫ OK) ==================
@@ -2055,8 +5947,7 @@ MG_CACHE: Dict[str, Dict] = {}
 
 @bot.message_handler(content_types=["photo"], func=lambda m: m.from_user and m.from_user.id != ADMIN_ID)
 def user_review_photo_or_album(message: types.Message):
-    inv = db_exec("SELECT * FROM review_invites WHERE user_id=?", (message.from_user.id,), fetchone=True)
-    if not inv or inv["used"] == 1:
+    if not REPO.reviews.open_invite(message.from_user.id):
         return
 
     if message.media_group_id:
@@ -2083,8 +5974,7 @@ def user_review_photo_or_album(message: types.Message):
 
 @bot.message_handler(content_types=["text"], func=lambda m: m.from_user and m.from_user.id != ADMIN_ID)
 def user_review_text_only(message: types.Message):
-    inv = db_exec("SELECT * FROM review_invites WHERE user_id=?", (message.from_user.id,), fetchone=True)
-    if not inv or inv["used"] == 1:
+    if not REPO.reviews.open_invite(message.from_user.id):
         return
 
     text = (message.text or "").strip()
@@ -2094,29 +5984,20 @@ def user_review_text_only(message: types.Message):
 
 
 def _save_user_review(user_id: int, text: str, photos: List[str], chat_id: int):
-    db_exec(
-        "INSERT INTO reviews(user_id,text,photos_json,is_approved,created_at) VALUES(?,?,?,?,?)",
-        (user_id, text, json.dumps(photos), 0, datetime.utcnow().isoformat())
-    )
-    db_exec("UPDATE review_invites SET used=1 WHERE user_id=?", (user_id,))
+    with db_tx():
+        review_id = REPO.reviews.add(user_id, text, photos)
+        REPO.reviews.use_invite(user_id)
 
     bot.send_message(chat_id, "✅ Спасибо! Отзыв отправлен админу на модерацию.",
                      reply_markup=types.InlineKeyboardMarkup().add(back_btn("sec:menu")))
 
-    rid = db_exec("SELECT id FROM reviews ORDER BY id DESC LIMIT 1", fetchone=True)["id"]
-    adm_caption = (
-        f"🆕 <b>Новый отзыв #{rid}</b>\n"
-        f"От пользователя: <code>{user_id}</code>\n\n"
-        f"{text}"
-    )
+    r = get_review(review_id)
+    adm_caption = review_card_caption(r, photos, f"🆕 <b>Новый отзыв #{r['id']}</b>")
+    # одна карточка вместо альбома + отдельного сообщения с кнопками
     if photos:
-        media = [InputMediaPhoto(pid) for pid in photos[:10]]
-        media[-1].caption = adm_caption
-        media[-1].parse_mode = "HTML"
-        bot.send_media_group(ADMIN_ID, media)
-        bot.send_message(ADMIN_ID, "Модерация:", reply_markup=review_pending_kb(rid))
+        bot.send_photo(ADMIN_ID, photos[0], caption=adm_caption, reply_markup=review_pending_kb(r["id"]))
     else:
-        bot.send_message(ADMIN_ID, adm_caption, reply_markup=review_pending_kb(rid))
+        bot.send_message(ADMIN_ID, adm_caption, reply_markup=review_pending_kb(r["id"]))
 
 
 # ================== FLUSH АЛЬБОМОВ (АДМИН+ОТЗЫВЫ) ==================
@@ -2141,8 +6022,7 @@ def media_group_flush(message: types.Message):
         for mg_id, data in list(MG_CACHE.items()):
             if data.get("photos") and now - float(data.get("last_ts", now)) > 1.5:
                 uid_sender = data["user_id"]
-                inv = db_exec("SELECT * FROM review_invites WHERE user_id=?", (uid_sender,), fetchone=True)
-                if inv and inv["used"] == 0:
+                if REPO.reviews.open_invite(uid_sender):
                     text = (data.get("caption") or "").strip() or "Без текста"
                     _save_user_review(uid_sender, text, data["photos"], data.get("chat_id", uid_sender))
                 auto_done.append(mg_id)
@@ -2152,28 +6032,15 @@ def media_group_flush(message: types.Message):
 
 
 # ================== АДМИН: СТАТИСТИКА ==================
-@bot.callback_query_handler(func=lambda c: c.data == "adm:stats")
+@callback_route("adm:stats", admin=True)
 def cb_adm_stats(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(c.id, "Нет доступа.")
-        return
     bot.answer_callback_query(c.id)
 
-    users = db_exec("SELECT COUNT(*) AS c FROM users", fetchone=True)["c"]
-    prods = db_exec("SELECT COUNT(*) AS c FROM products", fetchone=True)["c"]
-    orders = db_exec("SELECT COUNT(*) AS c FROM orders", fetchone=True)["c"]
-
-    revenue = db_exec(
-        "SELECT SUM(final_total) AS s FROM orders WHERE status='подтверждён'",
-        fetchone=True
-    )["s"] or 0
-
-    promo_totals = db_exec(
-        "SELECT SUM(used) AS u, SUM(confirmed_uses) AS c FROM promo_codes",
-        fetchone=True
-    )
-    used_sum = promo_totals["u"] or 0
-    conf_sum = promo_totals["c"] or 0
+    users = REPO.users.count()
+    prods = REPO.catalog.count_products()
+    orders = REPO.orders.count()
+    revenue = REPO.orders.revenue("подтверждён")
+    used_sum, conf_sum = REPO.promos.totals()
 
     text = (
         "<b>📊 Статистика:</b>\n\n"
@@ -2194,6 +6061,99 @@ def cb_adm_stats(c: types.CallbackQuery):
     )
 
 
+# ================== АДМИН: РЕФЕРАЛЫ ==================
+@callback_route("adm:refs", admin=True)
+def cb_adm_refs(c: types.CallbackQuery):
+    bot.answer_callback_query(c.id)
+
+    rows = get_referral_leaderboard()
+    if not rows:
+        text = "Рефералов пока нет."
+    else:
+        text = "<b>🤝 Топ рефереров:</b>\n\n"
+        for n, r in enumerate(rows, 1):
+            name = f"@{r['username']}" if r["username"] else f"<code>{r['user_id']}</code>"
+            invited = int(r["ref_count"] or 0)
+            converted = int(r["ref_converted"] or 0)
+            rate = round(converted * 100 / invited) if invited else 0
+            text += f"{n}. {name} — приглашено {invited}, купили {converted} ({rate}%)\n"
+
+    smart_send(
+        c.message.chat.id,
+        text,
+        types.InlineKeyboardMarkup().add(back_btn("sec:admin")),
+        origin_msg=c.message
+    )
+
+
+# ================== АДМИН: ЗАЯВКИ В ПАРТНЁРЫ ==================
+@callback_route("preq", str, int, admin=True)
+def cb_partner_request(c: types.CallbackQuery, act: str, uid: int):
+
+    if act == "ok":
+        code, discount_percent, commission_percent = approve_partner_request(uid)
+        bot.answer_callback_query(c.id, "Одобрено.")
+        smart_send(c.message.chat.id, f"✅ Партнёр <code>{uid}</code> одобрен, код <code>{code}</code>.",
+                   origin_msg=c.message)
+        user_text = (
+            "🎉 Ты стал партнёром Inko Shop!\n\n"
+            f"Твой промокод: <code>{code}</code>\n"
+            f"Скидка для друзей: <b>{discount_percent}%</b>\n"
+            f"Твоя комиссия: <b>{commission_percent}%</b>"
+        )
+    else:
+        reject_partner_request(uid)
+        bot.answer_callback_query(c.id, "Отклонено.")
+        smart_send(c.message.chat.id, f"❌ Заявка <code>{uid}</code> отклонена.", origin_msg=c.message)
+        user_text = "Заявка в партнёры отклонена."
+
+    try:
+        bot.send_message(uid, user_text)
+    except:
+        pass
+
+
+# ================== АДМИН: ВЫПЛАТЫ ПАРТНЁРАМ ==================
+def open_payouts(chat_id: int, origin_msg: types.Message = None):
+    payable = get_payable_partners()
+    kb = types.InlineKeyboardMarkup()
+    if not payable:
+        text = f"Нет партнёров с балансом от {PARTNER_PAYOUT_MIN}{CURRENCY}."
+    else:
+        total = sum(amount for _, amount in payable)
+        text = "<b>💸 К выплате:</b>\n\n"
+        for p, amount in payable:
+            name = f"@{p['username']}" if p["username"] else f"<code>{p['user_id']}</code>"
+            text += f"• {name} ({p['code']}) — <b>{amount}{CURRENCY}</b>\n"
+        text += f"\nИтого: <b>{total}{CURRENCY}</b>"
+        kb.add(types.InlineKeyboardButton("✅ Выплатить всем", callback_data="adm:payout_all"))
+    kb.add(back_btn("sec:admin"))
+    smart_send(chat_id, text, kb, origin_msg=origin_msg)
+
+
+@callback_route("adm:payouts", admin=True)
+def cb_adm_payouts(c: types.CallbackQuery):
+    bot.answer_callback_query(c.id)
+    open_payouts(c.message.chat.id, origin_msg=c.message)
+
+
+@callback_route("adm:payout_all", admin=True)
+def cb_adm_payout_all(c: types.CallbackQuery):
+    with db_tx():
+        paid = settle_partner_payouts()
+        for p, amount in paid:
+            enqueue_message(p["user_id"], f"💸 Тебе выплачено <b>{amount}{CURRENCY}</b>. Спасибо за партнёрство!")
+    bot.answer_callback_query(c.id, f"Выплачено партнёрам: {len(paid)}")
+
+    total = sum(amount for _, amount in paid)
+    smart_send(
+        c.message.chat.id,
+        f"✅ Выплаты проведены: {len(paid)} партнёр(ов), всего <b>{total}{CURRENCY}</b>.",
+        types.InlineKeyboardMarkup().add(back_btn("sec:admin")),
+        origin_msg=c.message
+    )
+
+
 # ================== ФОЛЛБЭК ==================
 @bot.message_handler(content_types=["text"])
 def fallback(message: types.Message):
@@ -2204,11 +6164,611 @@ def fallback(message: types.Message):
     bot.send_message(message.chat.id, "Нажми меню ниже 👇", reply_markup=main_menu(message.from_user.id))
 
 
+# ================== ХОЛОДНЫЙ СТАРТ ==================
+# На бесплатном Render сервис засыпает, и после пробуждения клиент ждёт всё, что
+# стоит до первого getUpdates. Там остаются только миграция (пропускается по
+# user_version) и запуск опроса; get_me, прогрев кэшей и снятие вебхука — потом.
+STARTUP_METRICS: Dict[str, float] = {}
+
+
+def startup_mark(name: str):
+    STARTUP_METRICS.setdefault(name, round((time.perf_counter() - STARTUP_T0) * 1000, 1))
+
+
+def format_startup_metrics() -> str:
+    return " ".join(f"{k}={v}ms" for k, v in STARTUP_METRICS.items())
+
+
+def warm_caches():
+    try:
+        me = bot.user  # get_me один раз, дальше из кэша telebot
+        print(f"✅ INKO SHOP Bot is running as @{me.username} (id {me.id})")
+    except Exception as e:
+        print("get_me fail:", e)
+    get_setting("logo_file_id")
+    get_catalog_version()
+    for sec, _ in BANNER_SECTIONS:
+        get_banner(sec)
+    main_menu(0)
+    main_menu(ADMIN_ID)
+    for kb in (category_kb, cart_kb, favs_kb, profile_kb, admin_panel_kb, banners_kb):
+        kb()
+    startup_mark("warm")
+
+
+# ================== ЖУРНАЛ АПДЕЙТОВ ==================
+# Вместо infinity_polling: пачка из getUpdates сначала пишется в update_journal
+# (INSERT OR IGNORE по update_id — дубли отсекаются), потом обрабатывается по одному.
+# pending → running → done/failed. Всё, что осталось pending, прогоняем при старте;
+# running на момент падения мог уже создать заказ — такой апдейт не повторяем.
+POLL_TIMEOUT = 60
+UPDATE_JOURNAL_KEEP_DAYS = 3
+
+
+def journal_updates(raw: List[Dict]) -> List[Tuple[int, Dict]]:
+    """Пишет пачку одной транзакцией, возвращает только новые апдейты."""
+    fresh = []
+    now = datetime.utcnow().isoformat()
+    with db_tx():
+        for u in raw:
+            if db_exec(
+                "INSERT OR IGNORE INTO update_journal(update_id,payload,user_id,prio,coalesce_key,received_at) "
+                "VALUES(?,?,?,?,?,?)",
+                (u["update_id"], json.dumps(u, ensure_ascii=False), update_user_id(u),
+                 UPDATE_CLASSES.index(update_class(u)), coalesce_key(u), now), rowcount=True
+            ):
+                fresh.append((u["update_id"], u))
+    return fresh
+
+
+def dispatch_journaled(update_id: int, data: Dict):
+    # журнал доигрывается целиком, сколько бы бот ни спал: заказы и отзывы не теряем,
+    # а ответ на протухший колбэк шлюз превращает в заглушку (OutboundGateway._answer_callback)
+    update = types.Update.de_json(data)
+    # в режиме воркеров аренда считается от начала обработки, а не от claim
+    db_exec("UPDATE update_journal SET status='running', attempts=attempts+1, lease_until=? WHERE update_id=?",
+            (time.time() + WORKER_LEASE_SEC, update_id))
+    try:
+        bot.process_new_updates([update])
+    except Exception as e:
+        print(f"update {update_id} fail:", e)
+        db_exec("UPDATE update_journal SET status='failed', error=?, done_at=? WHERE update_id=?",
+                (str(e)[:300], datetime.utcnow().isoformat(), update_id))
+        return
+    db_exec("UPDATE update_journal SET status='done', done_at=? WHERE update_id=?",
+            (datetime.utcnow().isoformat(), update_id))
+
+    if "first_update" not in STARTUP_METRICS:
+        startup_mark("first_update")
+        print("startup:", format_startup_metrics(), flush=True)
+
+
+def replay_update_journal() -> Dict[str, int]:
+    interrupted = db_exec(
+        "UPDATE update_journal SET status='interrupted', done_at=? WHERE status='running'",
+        (datetime.utcnow().isoformat(),), rowcount=True
+    )
+    pending = db_exec("SELECT update_id, payload FROM update_journal WHERE status='pending' ORDER BY update_id",
+                      fetchall=True)
+    for r in pending:
+        dispatch_journaled(r["update_id"], json.loads(r["payload"]))
+    return {"replayed": len(pending), "interrupted": interrupted}
+
+
+def _journal_offset() -> Optional[int]:
+    last = db_exec("SELECT MAX(update_id) AS m FROM update_journal", fetchone=True)["m"]
+    return last + 1 if last else None
+
+
+def poll_updates(offset: Optional[int], error_sleep: float) -> Tuple[List[Dict], float]:
+    """Один getUpdates. Возвращает (апдейты, пауза перед следующей ошибкой); при ошибке спит сам."""
+    try:
+        return apihelper.get_updates(TOKEN, offset=offset, timeout=POLL_TIMEOUT,
+                                     long_polling_timeout=POLL_TIMEOUT) or [], 0.25
+    except apihelper.ApiTelegramException as e:
+        if e.error_code == 409:
+            # на боте висит вебхук — снимаем его, только когда он реально мешает
+            print("getUpdates 409: removing webhook")
+            bot.remove_webhook()
+            return [], error_sleep
+        print("getUpdates fail:", e)
+    except Exception as e:
+        print("getUpdates fail:", e)
+    time.sleep(error_sleep)
+    return [], min(error_sleep * 2, 30)
+
+
+def poll_into_scheduler():
+    offset = _journal_offset()
+    error_sleep = 0.25
+    while True:
+        raw, error_sleep = poll_updates(offset, error_sleep)
+        if not raw:
+            continue
+        # с этим offset Telegram забудет пачку — она уже в журнале
+        offset = raw[-1]["update_id"] + 1
+        for update_id, data in journal_updates(raw):
+            SCHED.put(update_id, data)
+
+
+def run_polling():
+    report = replay_update_journal()
+    if report["replayed"] or report["interrupted"]:
+        print(f"update journal: {report}")
+    # опрос не ждёт обработку: пока разбирается пачка, свежий апдейт админа встаёт вперёд
+    threading.Thread(target=SCHED.run_forever, name="dispatch", daemon=True).start()
+    poll_into_scheduler()
+
+
+@maintenance_task
+def prune_update_journal() -> int:
+    return delete_in_batches("update_journal", "status!='pending' AND done_at<?",
+                             (_days_ago(UPDATE_JOURNAL_KEEP_DAYS),))
+
+
+# ================== ПРИОРИТЕТЫ АПДЕЙТОВ ==================
+# После поста в канале сотни людей разом жмут /start и листают каталог, а
+# подтверждение заказа админом и чекаут не должны стоять за этими свайпами.
+# Апдейт относится к одному из классов UPDATE_CLASSES (порядок = приоритет),
+# SCHED выдаёт обработчикам апдейт лучшего класса, но у одного пользователя —
+# строго по порядку прихода. Под нагрузкой колбэки дешёвых классов гасим:
+# отвечаем «подождите» без перерисовки (сообщения не гасим никогда).
+# Листание карусели (COALESCE_CALLBACKS) склеиваем: если за тапом ⬅️/➡️ в очереди
+# сразу стоит следующий тап по тому же сообщению, рисуем только последний —
+# в callback_data абсолютный индекс, промежуточные карточки никому не нужны.
+UPDATE_CLASSES = ("admin", "checkout", "nav", "other")
+CHECKOUT_CALLBACKS = {"cart", "size", "cqty", "cdel", "promo"}
+NAV_CALLBACKS = {"pnav", "revnav", "cat", "prod", "sec", "prof", "noop"}
+# класс -> (сколько колбэков может ждать в очереди, сколько секунд); None — без предела
+CLASS_BUDGETS: Dict[str, Tuple[Optional[int], Optional[float]]] = {
+    "admin": (None, None),
+    "checkout": (None, None),
+    "nav": (200, 4.0),
+    "other": (300, 8.0),
+}
+SHED_TEXT = "⏳ Подождите, бот сейчас перегружен…"
+COALESCE_CALLBACKS = {"pnav", "revnav"}
+
+
+def update_class(data: Dict) -> str:
+    if update_user_id(data) == ADMIN_ID:
+        return "admin"
+    if "pre_checkout_query" in data or "successful_payment" in (data.get("message") or {}):
+        return "checkout"
+    cq = data.get("callback_query")
+    if not cq:
+        return "other"
+    head = (cq.get("data") or "").split(":", 1)[0]
+    if head in CHECKOUT_CALLBACKS:
+        return "checkout"
+    if head in NAV_CALLBACKS:
+        return "nav"
+    return "other"
+
+
+def coalesce_key(data: Dict) -> Optional[str]:
+    """Ключ склейки: тип навигации + сообщение, которое она перерисовывает."""
+    cq = data.get("callback_query")
+    if not cq or not cq.get("message"):
+        return None
+    head = (cq.get("data") or "").split(":", 1)[0]
+    if head not in COALESCE_CALLBACKS:
+        return None
+    return f"{head}:{cq['message']['chat']['id']}:{cq['message']['message_id']}"
+
+
+class UpdateScheduler:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.users: Dict[int, deque] = {}  # user_id -> апдейты пользователя по порядку
+        self.busy = set()                  # пользователи, чей апдейт сейчас в обработке
+        self.ready: List[Tuple[int, int, int]] = []  # (приоритет головы, update_id, user_id)
+        self.queued = {cls: 0 for cls in UPDATE_CLASSES}
+        self.waits = {cls: deque(maxlen=500) for cls in UPDATE_CLASSES}
+        self.stats = {cls: {"done": 0, "shed": 0, "coalesced": 0} for cls in UPDATE_CLASSES}
+
+    def put(self, update_id: int, data: Dict, received: float = None):
+        cls = update_class(data)
+        uid = update_user_id(data)
+        key = coalesce_key(data)
+        limit = CLASS_BUDGETS[cls][0]
+        shed = superseded = None
+        with self.cond:
+            q = self.users.get(uid)
+            if key and q and q[-1][5] == key:
+                # тот же тап ещё не начат — подменяем его свежим, место в очереди сохраняем
+                superseded = q[-1]
+                q[-1] = superseded[:1] + (update_id, data) + superseded[3:]
+                self.stats[cls]["coalesced"] += 1
+            elif limit is not None and self.queued[cls] >= limit and "callback_query" in data:
+                self.stats[cls]["shed"] += 1
+                shed = True
+            else:
+                q = self.users.setdefault(uid, deque())
+                q.append((UPDATE_CLASSES.index(cls), update_id, data, cls, received or time.time(), key))
+                self.queued[cls] += 1
+                if len(q) == 1 and uid not in self.busy:
+                    heapq.heappush(self.ready, (q[0][0], update_id, uid))
+                    self.cond.notify()
+        if superseded:
+            supersede_update(superseded[1], superseded[2])
+        if shed:
+            shed_update(update_id, data)
+
+    def _take(self, timeout: Optional[float]):
+        with self.cond:
+            if not self.ready and not self.cond.wait_for(lambda: self.ready, timeout):
+                return None
+            _, _, uid = heapq.heappop(self.ready)
+            item = self.users[uid].popleft()
+            self.busy.add(uid)
+            self.queued[item[3]] -= 1
+            return uid, item
+
+    def _release(self, uid: int):
+        with self.cond:
+            self.busy.discard(uid)
+            q = self.users.get(uid)
+            if q:
+                heapq.heappush(self.ready, (q[0][0], q[0][1], uid))
+                self.cond.notify()
+            else:
+                self.users.pop(uid, None)
+
+    def run_one(self, timeout: Optional[float] = None) -> bool:
+        """Обрабатывает один апдейт. False — за timeout очередь так и не ожила."""
+        got = self._take(timeout)
+        if got is None:
+            return False
+        uid, (_, update_id, data, cls, received, _) = got
+        try:
+            wait = time.time() - received
+            self.waits[cls].append(wait)
+            max_wait = CLASS_BUDGETS[cls][1]
+            if max_wait is not None and wait > max_wait and "callback_query" in data:
+                self.stats[cls]["shed"] += 1
+                shed_update(update_id, data)
+            else:
+                self.stats[cls]["done"] += 1
+                dispatch_journaled(update_id, data)
+        finally:
+            self._release(uid)
+        return True
+
+    def run_forever(self):
+        while True:
+            self.run_one()
+
+    def pending(self) -> int:
+        with self.cond:
+            return sum(self.queued.values())
+
+
+def shed_update(update_id: int, data: Dict):
+    try:
+        bot.answer_callback_query(data["callback_query"]["id"], SHED_TEXT)
+    except Exception as e:
+        print(f"shed {update_id} answer fail:", e)
+    db_exec("UPDATE update_journal SET status='shed', done_at=? WHERE update_id=?",
+            (datetime.utcnow().isoformat(), update_id))
+
+
+def supersede_update(update_id: int, data: Dict):
+    """Промежуточный тап навигации: только снимаем «часики» с кнопки."""
+    try:
+        bot.answer_callback_query(data["callback_query"]["id"])
+    except Exception as e:
+        print(f"coalesce {update_id} answer fail:", e)
+    db_exec("UPDATE update_journal SET status='coalesced', done_at=? WHERE update_id=?",
+            (datetime.utcnow().isoformat(), update_id))
+
+
+def format_queue_stats(sched: "UpdateScheduler") -> str:
+    lines = []
+    for cls in UPDATE_CLASSES:
+        waits = sorted(sched.waits[cls])
+        st = sched.stats[cls]
+        if waits:
+            p50, p95 = waits[len(waits) // 2], waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+            wait = f"ожидание p50 {p50 * 1000:.0f} / p95 {p95 * 1000:.0f} мс"
+        else:
+            wait = "ожидание —"
+        lines.append(f"{cls}: {st['done']} шт., {wait}, погашено {st['shed']}, склеено {st['coalesced']}")
+    return "\n".join(lines)
+
+
+SCHED = UpdateScheduler()
+
+
+# ================== ПУЛ ПОТОКОВ ДЛЯ ХЕНДЛЕРОВ ==================
+# INKO_ENGINE=threads: это не AsyncTeleBot, а пул потоков. getUpdates и журнал
+# живут на asyncio-петле, хендлеры — те же синхронные функции, их гоняет пул
+# через SCHED. Апдейты одного пользователя идут строго по порядку, разные
+# пользователи — параллельно.
+# Выигрыш только на ожидании Bot API: пока один поток ждёт ответа Telegram,
+# другие работают. Всё, что под DB_LOCK (каждый db_exec/db_tx), по-прежнему идёт
+# по одному, так что хендлер, упёршийся в базу, быстрее не станет — цифры для
+# обоих случаев даёт `bench.py --engine`. Старое значение async — синоним threads.
+ENGINE = {"async": "threads"}.get(os.getenv("INKO_ENGINE", "sync"), os.getenv("INKO_ENGINE", "sync"))
+HANDLER_THREADS = int(os.getenv("INKO_HANDLER_THREADS") or 16)
+SEND_CONCURRENCY = 8  # одновременных отправок в рассылке и outbox
+ASYNC_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_SEND_POOL = ThreadPoolExecutor(SEND_CONCURRENCY, thread_name_prefix="send")
+
+_UPDATE_USER_KEYS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                     "shipping_query", "pre_checkout_query", "my_chat_member", "chat_member", "chat_join_request")
+
+
+def update_user_id(data: Dict) -> int:
+    for key in _UPDATE_USER_KEYS:
+        part = data.get(key)
+        if part and part.get("from"):
+            return int(part["from"]["id"])
+    return 0
+
+
+async def fan_out(calls: List[Callable], limit: int = SEND_CONCURRENCY) -> list:
+    """Запускает вызовы параллельно, не больше limit сразу. Исключения возвращаются как результат."""
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(limit)
+    prio = getattr(_SEND_CTX, "prio", PRIO_REPLY)
+
+    def with_prio(fn):
+        _SEND_CTX.prio = prio
+        return fn()
+
+    async def one(fn):
+        async with sem:
+            try:
+                return await loop.run_in_executor(_SEND_POOL, with_prio, fn)
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*(one(fn) for fn in calls))
+
+
+def run_fan_out(calls: List[Callable], limit: int = SEND_CONCURRENCY) -> list:
+    """fan_out из обычного потока: на петле движка, если она запущена, иначе на своей."""
+    if not calls:
+        return []
+    if ASYNC_LOOP is not None and ASYNC_LOOP.is_running():
+        # приоритет потока-отправителя передаём через замыкание: в петле свой _SEND_CTX
+        prio = getattr(_SEND_CTX, "prio", PRIO_REPLY)
+
+        async def run():
+            with send_priority(prio):
+                return await fan_out(calls, limit)
+        return asyncio.run_coroutine_threadsafe(run(), ASYNC_LOOP).result()
+    return asyncio.run(fan_out(calls, limit))
+
+
+async def run_polling_threads():
+    global ASYNC_LOOP
+    loop = asyncio.get_running_loop()
+    ASYNC_LOOP = loop
+    db_pool = ThreadPoolExecutor(1, thread_name_prefix="db")
+    handlers_pool = ThreadPoolExecutor(HANDLER_THREADS, thread_name_prefix="upd")
+    poll_pool = ThreadPoolExecutor(1, thread_name_prefix="poll")
+
+    report = await loop.run_in_executor(db_pool, replay_update_journal)
+    if report["replayed"] or report["interrupted"]:
+        print(f"update journal: {report}")
+
+    async def consume():
+        while True:
+            await loop.run_in_executor(handlers_pool, SCHED.run_one, 1.0)
+
+    # ссылки держим до конца: петля хранит задачи слабо
+    consumers = [loop.create_task(consume()) for _ in range(HANDLER_THREADS)]
+
+    offset = await loop.run_in_executor(db_pool, _journal_offset)
+    error_sleep = 0.25
+    while True:
+        raw, error_sleep = await loop.run_in_executor(poll_pool, poll_updates, offset, error_sleep)
+        if not raw:
+            continue
+        offset = raw[-1]["update_id"] + 1
+        for update_id, data in await loop.run_in_executor(db_pool, journal_updates, raw):
+            SCHED.put(update_id, data)
+
+
+# ================== НЕСКОЛЬКО ПРОЦЕССОВ ==================
+# INKO_WORKERS=N: основной процесс только опрашивает getUpdates и пишет журнал
+# (плюс фоновые задачи, outbox и API каталога), апдейты разбирают N процессов
+# `main.py worker k N`. Воркер k берёт строки с user_id % N == k — все апдейты
+# пользователя идут через один процесс по порядку, там же живут его next_step и альбомы.
+# Взятая строка — claimed с арендой (при старте обработки она продлевается): если аренда
+# истекла и воркер-владелец мёртв, непочатая строка возвращается в pending, начатая
+# (running) становится interrupted — как при рестарте.
+# Кэши в памяти у каждого процесса свои; их сбрасывает смена catalog_version
+# или settings_version в базе.
+WORKERS = int(os.getenv("INKO_WORKERS") or 0)
+WORKER_BATCH = 10
+WORKER_LEASE_SEC = 120
+WORKER_IDLE_MAX = 0.5
+_SHARED_VERSIONS: List[Optional[tuple]] = [None]
+
+
+def sync_shared_caches():
+    """Сбрасывает кэши процесса, если другой процесс поменял каталог или настройки."""
+    rows = db_exec("SELECT key, value FROM settings WHERE key IN ('catalog_version','settings_version')",
+                   fetchall=True)
+    seen = tuple(sorted((r["key"], r["value"]) for r in rows))
+    if seen == _SHARED_VERSIONS[0]:
+        return
+    with DB_LOCK:
+        if _SHARED_VERSIONS[0] is not None:
+            _SETTINGS_CACHE.clear()
+            invalidate_render_cache()
+        _SHARED_VERSIONS[0] = seen
+
+
+def claim_updates(shard: int, shards: int, token: str) -> List[sqlite3.Row]:
+    """Берёт по приоритету только «головы»: апдейт, перед которым у пользователя ничего не ждёт."""
+    with db_tx():
+        db_exec(
+            """
+            UPDATE update_journal SET status='claimed', worker=?, lease_until=?
+            WHERE update_id IN (
+                SELECT j.update_id FROM update_journal j
+                WHERE j.status='pending' AND j.user_id % ? = ?
+                  AND NOT EXISTS (SELECT 1 FROM update_journal e
+                                  WHERE e.user_id=j.user_id AND e.update_id<j.update_id
+                                    AND e.status IN ('pending','claimed','running'))
+                ORDER BY j.prio, j.update_id LIMIT ?)
+            """,
+            (token, time.time() + WORKER_LEASE_SEC, shards, shard, WORKER_BATCH)
+        )
+        return db_exec("SELECT update_id, payload, user_id, coalesce_key, received_at FROM update_journal "
+                       "WHERE status='claimed' AND worker=? ORDER BY prio, update_id", (token,), fetchall=True)
+
+
+def _next_pending_key(user_id: int, update_id: int) -> Optional[str]:
+    row = db_exec("SELECT coalesce_key FROM update_journal WHERE user_id=? AND update_id>? AND status='pending' "
+                  "ORDER BY update_id LIMIT 1", (user_id, update_id), fetchone=True)
+    return row["coalesce_key"] if row else None
+
+
+def recover_shard(shard: int, shards: int):
+    """Старт воркера: хвост прошлого процесса этого шарда — как replay_update_journal."""
+    with db_tx():
+        db_exec("UPDATE update_journal SET status='interrupted', done_at=? "
+                "WHERE status='running' AND user_id % ? = ?", (datetime.utcnow().isoformat(), shards, shard))
+        db_exec("UPDATE update_journal SET status='pending', worker=NULL "
+                "WHERE status='claimed' AND user_id % ? = ?", (shards, shard))
+
+
+def _worker_pid(token: Optional[str]) -> Optional[int]:
+    try:
+        return int((token or "").split(":")[0])
+    except ValueError:
+        return None
+
+
+def reap_expired_leases(live_pids: List[int]) -> int:
+    """
+    Забирает строки с истёкшей арендой, только если процесс-владелец уже мёртв:
+    живой воркер доделает свои сам, даже если обработчик идёт дольше аренды.
+    """
+    now = time.time()
+    with db_tx():
+        rows = db_exec("SELECT update_id, status, worker FROM update_journal "
+                       "WHERE status IN ('claimed','running') AND lease_until<?", (now,), fetchall=True)
+        n = 0
+        for r in rows:
+            if _worker_pid(r["worker"]) in live_pids:
+                continue
+            if r["status"] == "claimed":
+                db_exec("UPDATE update_journal SET status='pending', worker=NULL "
+                        "WHERE update_id=? AND status='claimed'", (r["update_id"],))
+            else:
+                db_exec("UPDATE update_journal SET status='interrupted', done_at=? "
+                        "WHERE update_id=? AND status='running'", (datetime.utcnow().isoformat(), r["update_id"]))
+            n += 1
+    return n
+
+
+def run_worker(shard: int, shards: int):
+    parent = os.getppid()
+    token = f"{os.getpid()}:{shard}"
+    # глобальный лимит Bot API один на бота — делим его с соседями и outbox поллера
+    share = SEND_GLOBAL_RATE / (shards + 1)
+    OUTBOUND.glob = TokenBucket(share, share)
+    recover_shard(shard, shards)
+    print(f"worker {shard}/{shards} pid {os.getpid()}", flush=True)
+    idle = 0.05
+    while True:
+        rows = claim_updates(shard, shards, token)
+        if not rows:
+            if os.getppid() != parent:
+                return  # поллер умер — выходим, новый поднимет своих воркеров
+            time.sleep(idle)
+            idle = min(idle * 2, WORKER_IDLE_MAX)
+            continue
+        idle = 0.05
+        for r in rows:
+            data = json.loads(r["payload"])
+            if r["coalesce_key"] and _next_pending_key(r["user_id"], r["update_id"]) == r["coalesce_key"]:
+                SCHED.stats[update_class(data)]["coalesced"] += 1
+                supersede_update(r["update_id"], data)
+                continue
+            # возраст считаем от записи в журнал: столько апдейт уже прождал в общей очереди
+            age = (datetime.utcnow() - datetime.fromisoformat(r["received_at"])).total_seconds()
+            SCHED.put(r["update_id"], data, time.time() - age)
+        while SCHED.pending():
+            sync_shared_caches()
+            SCHED.run_one()
+
+
+def _spawn_worker(shard: int) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", str(shard), str(WORKERS)])
+
+
+def _supervise_workers(procs: Dict[int, subprocess.Popen]):
+    tick = 0
+    while True:
+        time.sleep(1)
+        tick += 1
+        try:
+            sync_shared_caches()
+            for shard, p in procs.items():
+                if p.poll() is not None:
+                    print(f"worker {shard} exited with {p.returncode}, restarting")
+                    procs[shard] = _spawn_worker(shard)
+            if tick % 10 == 0:
+                reap_expired_leases([p.pid for p in procs.values() if p.poll() is None])
+        except Exception as e:
+            print("supervisor fail:", e)
+
+
+def run_poller():
+    procs = {shard: _spawn_worker(shard) for shard in range(WORKERS)}
+    threading.Thread(target=_supervise_workers, args=(procs,), name="workers", daemon=True).start()
+
+    offset = _journal_offset()
+    error_sleep = 0.25
+    while True:
+        raw, error_sleep = poll_updates(offset, error_sleep)
+        if not raw:
+            continue
+        offset = raw[-1]["update_id"] + 1
+        journal_updates(raw)
+
+
+startup_mark("import")
+
+
 # ================== RUN ==================
 if __name__ == "__main__":
-    init_db()
-    ensure_columns()
-    me = bot.get_me()
-    print(f"✅ INKO SHOP Bot is running as @{me.username} (id {me.id})")
-    bot.remove_webhook()
-    bot.infinity_polling(timeout=60, long_polling_timeout=60, skip_pending=True)
+    migrate_db()
+    startup_mark("db")
+
+    # python main.py import-export result.json [--dry-run]
+    if len(sys.argv) > 2 and sys.argv[1] == "import-export":
+        dry = "--dry-run" in sys.argv
+        print(format_import_report(import_channel_export(sys.argv[2], dry_run=dry), dry))
+        sys.exit(0)
+
+    # python main.py media-sync — скачать новые фото и пересобрать products.json
+    if len(sys.argv) > 1 and sys.argv[1] == "media-sync":
+        print(sync_media(), "products:", export_webapp_catalog())
+        sys.exit(0)
+
+    # python main.py worker K N — процесс-обработчик шарда K (запускает run_poller)
+    if len(sys.argv) > 3 and sys.argv[1] == "worker":
+        run_worker(int(sys.argv[2]), int(sys.argv[3]))
+        sys.exit(0)
+
+    start_background_jobs()
+    start_outbox_sender()
+    if API_PORT:
+        start_catalog_api()
+        print(f"✅ catalog API on :{API_PORT}")
+    threading.Thread(target=warm_caches, name="warmup", daemon=True).start()
+    startup_mark("ready")
+    if WORKERS:
+        run_poller()
+    elif ENGINE == "threads":
+        asyncio.run(run_polling_threads())
+    else:
+        run_polling()
@@ -44,28 +44,88 @@
   function qsa(sel, root = document) { return [...root.querySelectorAll(sel)]; }
 
   // ---------- data ----------
-  async function loadProducts() {
-    // cache-buster
-    const url = "./products.json?ts=" + Date.now();
-    const res = await fetch(url);
-    const data = await res.json();
+  // адрес API каталога бот передаёт в ?api=..., без него читаем статичный products.json
+  const API_BASE = (new URLSearchParams(location.search).get("api") || "").replace(/\/$/, "");
+  const API_PAGE = 40;
+  const CATALOG_KEY = "inko_catalog"; // {version, items} — последний загруженный каталог
+
+  async function getJson(url) {
+    // no-cache: браузер сам пришлёт If-None-Match и на 304 отдаст тело из своего кэша
+    const res = await fetch(url, { cache: "no-cache" });
+    if (!res.ok) throw new Error(url + " → " + res.status);
+    return res.json();
+  }
 
-    // нормализуем
-    state.products = (Array.isArray(data) ? data : []).map(p => ({
+  function normalizeProduct(p) {
+    return {
       id: Number(p.id),
       title: p.title || "Без названия",
       description: p.description || "",
       price: Number(p.price || 0),
       category: (p.category || "Разное").trim(),
       photos: Array.isArray(p.photos) ? p.photos : (p.photos_json ? safeJson(p.photos_json, []) : []),
+      thumbs: Array.isArray(p.thumbs) ? p.thumbs : [],
       is_preorder: !!p.is_preorder,
-      sizes: Array.isArray(p.sizes) ? p.sizes : extractSizes(p.description || "")
-    }));
+      sizes: Array.isArray(p.sizes) ? p.sizes : extractSizes(p.description || ""),
+      sold_out: !!p.sold_out
+    };
+  }
 
+  function setProducts(list) {
+    state.products = list.map(normalizeProduct);
     state.categories = uniq(["all", ...state.products.map(p => p.category)]);
     applyFilters();
   }
 
+  function saveCatalog(version, items) {
+    try { saveLS(CATALOG_KEY, { version, items }); } catch { /* переполнен localStorage — обойдёмся */ }
+  }
+
+  async function loadProducts() {
+    if (!API_BASE) {
+      const data = await getJson("./products.json");
+      setProducts(Array.isArray(data) ? data : []);
+      return;
+    }
+
+    const cached = loadLS(CATALOG_KEY, null);
+    if (cached && Array.isArray(cached.items)) {
+      setProducts(cached.items); // сразу показываем прошлый каталог
+      try {
+        await syncChanges(cached);
+        return;
+      } catch (e) {
+        console.error(e);
+      }
+    }
+    await loadPages();
+  }
+
+  // повторный визит: только то, что поменялось после сохранённой версии
+  async function syncChanges(cached) {
+    const d = await getJson(`${API_BASE}/api/changes?since=${cached.version}`);
+    if (d.version === cached.version) return;
+    if (d.version < cached.version) throw new Error("каталог пересоздан — грузим заново");
+    const gone = new Set([...d.deleted, ...d.items.map(p => p.id)]);
+    const items = [...d.items, ...cached.items.filter(p => !gone.has(p.id))].sort((a, b) => b.id - a.id);
+    saveCatalog(d.version, items);
+    setProducts(items);
+  }
+
+  // первый визит: первая страница рисуется сразу, остальные догружаются следом
+  async function loadPages() {
+    let items = [], cursor = null, version = null;
+    do {
+      const d = await getJson(`${API_BASE}/api/products?limit=${API_PAGE}` + (cursor ? `&cursor=${cursor}` : ""));
+      // берём версию первой страницы: всё, что поменяется во время загрузки, придёт через /api/changes
+      if (version === null) version = d.version;
+      items = items.concat(d.items);
+      cursor = d.next_cursor;
+      setProducts(items);
+    } while (cursor);
+    saveCatalog(version, items);
+  }
+
   function safeJson(str, def) {
     try { return JSON.parse(str); } catch { return def; }
   }
@@ -95,27 +155,21 @@
 
   // ---------- cart/favs ----------
   function addToCart(prodId, size) {
-    const idx = state.cart.findIndex(i => i.id === prodId && i.size === size);
-    if (idx >= 0) state.cart[idx].qty += 1;
-    else state.cart.push({ id: prodId, size, qty: 1 });
-    saveLS("inko_cart", state.cart);
+    pushCartOp({ op: "add", product_id: prodId, size, qty: 1 });
     toast("Добавлено в корзину");
     renderHeaderCounters();
   }
 
   function changeQty(prodId, size, delta) {
-    const idx = state.cart.findIndex(i => i.id === prodId && i.size === size);
-    if (idx < 0) return;
-    state.cart[idx].qty += delta;
-    if (state.cart[idx].qty <= 0) state.cart.splice(idx, 1);
-    saveLS("inko_cart", state.cart);
+    const it = state.cart.find(i => i.id === prodId && i.size === size);
+    if (!it) return;
+    pushCartOp({ op: "set", product_id: prodId, size, qty: it.qty + delta });
     render();
     renderHeaderCounters();
   }
 
   function clearCart() {
-    state.cart = [];
-    saveLS("inko_cart", state.cart);
+    pushCartOp({ op: "clear" });
     render();
     renderHeaderCounters();
   }
@@ -128,17 +182,110 @@
     renderHeaderCounters();
   }
 
+  // цена из ответа сервера важнее цены из каталога
+  function cartPrice(it) {
+    const p = state.products.find(x => x.id === it.id);
+    return it.price ?? p?.price ?? 0;
+  }
+
   function cartTotal() {
     let sum = 0;
-    for (const it of state.cart) {
-      const p = state.products.find(x => x.id === it.id);
-      if (p) sum += p.price * it.qty;
-    }
+    for (const it of state.cart) sum += cartPrice(it) * it.qty;
     return sum;
   }
 
+  // ---------- cart sync ----------
+  // изменения копятся в очереди и уходят пачкой; ответ сервера — его корзина
+  // с его ценами, поверх которой заново применяются ещё не отправленные изменения
+  const CART_SYNC_KEY = "inko_cart_sync"; // {version, ops, batch}
+  const CART_SYNC_DELAY = 600;
+  const cartSync = loadLS(CART_SYNC_KEY, null) || {
+    version: 0,
+    batch: null,
+    // корзина, собранная до синхронизации, уезжает на сервер первой пачкой
+    ops: state.cart.map(i => ({ op: "add", product_id: i.id, size: i.size, qty: i.qty })),
+  };
+  let cartSyncTimer = null;
+  let cartSyncBusy = null;
+
+  function canSyncCart() {
+    return !!(API_BASE && TG?.initData);
+  }
+
+  function applyCartOp(cart, op) {
+    if (op.op === "clear") return [];
+    const cur = cart.find(i => i.id === op.product_id && i.size === op.size);
+    const qty = op.op === "add" ? (cur?.qty || 0) + op.qty : op.op === "set" ? op.qty : 0;
+    if (qty <= 0) return cart.filter(i => i !== cur);
+    if (cur) return cart.map(i => (i === cur ? { ...i, qty } : i));
+    return [...cart, { id: op.product_id, size: op.size, qty }];
+  }
+
+  function pushCartOp(op) {
+    state.cart = applyCartOp(state.cart, op);
+    saveLS("inko_cart", state.cart);
+    cartSync.ops.push(op);
+    saveLS(CART_SYNC_KEY, cartSync);
+    scheduleCartSync();
+  }
+
+  function scheduleCartSync() {
+    if (!canSyncCart()) return;
+    clearTimeout(cartSyncTimer);
+    cartSyncTimer = setTimeout(syncCart, CART_SYNC_DELAY);
+  }
+
+  function syncCart() {
+    if (!canSyncCart()) return Promise.resolve();
+    clearTimeout(cartSyncTimer);
+    if (!cartSyncBusy) {
+      cartSyncBusy = doSyncCart().finally(() => { cartSyncBusy = null; });
+    }
+    return cartSyncBusy;
+  }
+
+  async function doSyncCart() {
+    // id пачки сохраняем до отправки: если ответ потеряется, повтор сервер не применит второй раз
+    if (!cartSync.batch && cartSync.ops.length) {
+      cartSync.batch = { id: Date.now().toString(36) + Math.random().toString(36).slice(2), count: cartSync.ops.length };
+      saveLS(CART_SYNC_KEY, cartSync);
+    }
+    const sending = cartSync.batch ? cartSync.ops.slice(0, cartSync.batch.count) : [];
+    let d;
+    try {
+      const res = await fetch(`${API_BASE}/api/cart/sync`, {
+        method: "POST",
+        headers: { "Content-Type": "text/plain" }, // «простой» запрос — без CORS preflight
+        body: JSON.stringify({
+          init_data: TG.initData,
+          version: cartSync.version,
+          batch_id: cartSync.batch?.id,
+          ops: sending,
+        }),
+      });
+      if (!res.ok) throw new Error("cart sync → " + res.status);
+      d = await res.json();
+    } catch (e) {
+      console.error(e);
+      return;
+    }
+
+    cartSync.ops = cartSync.ops.slice(sending.length);
+    cartSync.batch = null;
+    cartSync.version = d.version;
+    saveLS(CART_SYNC_KEY, cartSync);
+    if (d.cart) {
+      const server = d.cart.items.map(i => ({ id: i.id, size: i.size, qty: i.qty, price: i.price, title: i.title }));
+      state.cart = cartSync.ops.reduce(applyCartOp, server);
+      saveLS("inko_cart", state.cart);
+      render();
+      renderHeaderCounters();
+    }
+    if (cartSync.ops.length) scheduleCartSync();
+  }
+
   // ---------- telegram send ----------
-  function sendCheckout() {
+  async function sendCheckout() {
     if (!TG) {
       alert("Открой витрину через Telegram бот");
       return;
@@ -147,6 +294,7 @@
       toast("Корзина пустая");
       return;
     }
+    await syncCart();
     const payload = {
       action: "checkout",
       cart: state.cart,
@@ -275,19 +423,20 @@
 
   function renderCard(p) {
     const card = el("div", "card");
-    const imgUrl = (p.photos && p.photos[0]) ? p.photos[0] : "";
+    // в сетке — лёгкое превью, полноразмерное фото только в «Подробнее»
+    const imgUrl = p.thumbs[0] || p.photos[0] || "";
     card.innerHTML = `
       <div class="imgwrap">
-        ${imgUrl ? `<img src="${imgUrl}" alt="">` : `<div class="noimg">Нет фото</div>`}
+        ${imgUrl ? `<img src="${imgUrl}" alt="" loading="lazy">` : `<div class="noimg">Нет фото</div>`}
         ${p.is_preorder ? `<div class="tag">предзаказ</div>` : ""}
         <button class="favbtn ${state.favs.has(p.id)?"on":""}" title="В избранное">★</button>
       </div>
       <div class="cardbody">
         <div class="ctitle">${escapeHtml(p.title)}</div>
         <div class="cprice">${money(p.price)}</div>
-        <div class="csizes">Размеры: ${p.sizes.join(" / ")}</div>
+        <div class="csizes">${p.sold_out ? "Нет в наличии" : "Размеры: " + p.sizes.join(" / ")}</div>
         <div class="actions">
-          <button class="buybtn">В корзину</button>
+          <button class="buybtn" ${p.sold_out ? "disabled" : ""}>В корзину</button>
           <button class="morebtn">Подробнее</button>
         </div>
       </div>
@@ -336,9 +485,9 @@
       <div class="mprice">${money(p.price)}</div>
       <div class="mcat">Категория: <b>${escapeHtml(p.category)}</b></div>
       <div class="mdesc">${escapeHtml(p.description).replace(/\n/g,"<br>")}</div>
-      <div class="mtext">Размеры: ${p.sizes.join(" / ")}</div>
+      <div class="mtext">${p.sold_out ? "Нет в наличии" : "Размеры: " + p.sizes.join(" / ")}</div>
       <div class="mfooter">
-        <button class="mbuy">В корзину</button>
+        <button class="mbuy" ${p.sold_out ? "disabled" : ""}>В корзину</button>
         <button class="mclose">Закрыть</button>
       </div>
     `;
@@ -356,12 +505,13 @@
 
     for (const it of state.cart) {
       const p = state.products.find(x => x.id === it.id);
-      if (!p) continue;
+      const title = p?.title || it.title;
+      if (!title) continue;
 
       const row = el("div", "cartrow");
       row.innerHTML = `
-        <div class="carttitle">${escapeHtml(p.title)} <span class="cartsize">(${it.size})</span></div>
-        <div class="cartprice">${money(p.price * it.qty)}</div>
+        <div class="carttitle">${escapeHtml(title)} <span class="cartsize">(${it.size})</span></div>
+        <div class="cartprice">${money(cartPrice(it) * it.qty)}</div>
         <div class="cartqty">
           <button class="qbtn" data-d="-1">−</button>
           <span class="qnum">${it.qty}</span>
@@ -449,6 +599,10 @@
 
   // ---------- start ----------
   document.addEventListener("DOMContentLoaded", async () => {
+    syncCart();
+    document.addEventListener("visibilitychange", () => {
+      if (document.visibilityState === "hidden") syncCart();
+    });
     try {
       await loadProducts();
     } catch (e) {